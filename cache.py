@@ -0,0 +1,110 @@
+# A simple, size bounded, on disk cache used to persist data between
+# SimDem runs. Each cache lives in its own directory under
+# SIMDEM_TEMP_DIR/cache.
+
+import hashlib
+import os
+import pickle
+import tempfile
+
+import config
+
+# The pickle protocol entries are written with. Caches are shared by
+# every interpreter SimDem is run with, so this must be one the oldest
+# supported Python can read.
+PICKLE_PROTOCOL = 4
+
+def get_cache_dir(name):
+    """Return the directory in which the cache called `name` is stored."""
+    return os.path.join(os.path.expanduser(config.SIMDEM_TEMP_DIR), "cache", name)
+
+def hash_bytes(data):
+    """Return a hex digest identifying the supplied bytes."""
+    return hashlib.sha256(data).hexdigest()
+
+class DiskCache(object):
+    """Stores picklable values on disk, one file per key. When the total
+    size of the cache exceeds `max_bytes` the least recently used
+    entries are evicted.
+
+    Entries are written atomically so that a cache can be shared by
+    concurrent SimDem processes. Any error reading an entry is treated
+    as a miss, and the entry deleted.
+    """
+
+    def __init__(self, name, max_bytes):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.directory = get_cache_dir(name)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".pickle")
+
+    def get(self, key):
+        """Return the value stored for `key`, or None if there isn't one."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except OSError:
+            return None
+        except Exception:
+            # Corrupt, or written by an incompatible version of SimDem
+            # or Python
+            self.delete(key)
+            return None
+        try:
+            # Record the access for least recently used eviction
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def set(self, key, value):
+        """Store `value` for `key`, then evict entries if the cache has
+        grown too large."""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, PICKLE_PROTOCOL)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            return
+        self.evict()
+
+    def delete(self, key):
+        """Remove any value stored for `key`."""
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is no
+        larger than `max_bytes`."""
+        entries = []
+        total = 0
+        try:
+            # os.scandir is only a context manager from Python 3.6, the
+            # iterator is closed once it is exhausted
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".pickle"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+        except OSError:
+            return
+
+        if total <= self.max_bytes:
+            return
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
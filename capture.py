@@ -0,0 +1,157 @@
+# Capture of the output of commands.
+#
+# Output is collected in memory until it grows beyond
+# `config.output_spill_size` characters, from then on it is written to
+# a file under SIMDEM_TEMP_DIR/output instead. Spilled output is scored
+# through a memory mapped view of the file, see `similarity.py`, and
+# test reports carry an excerpt of it along with the path of the file.
+# This keeps the memory used by SimDem bounded however much a command
+# prints.
+
+import os
+import re
+import tempfile
+import weakref
+
+import config
+
+# The same escape sequences that `Demo.strip_ansi` removes
+ANSI_PATTERN = re.compile(r'\x1b[^m]*m')
+
+# The longest escape sequence held back when it is split between two
+# chunks of output
+MAX_ESCAPE_LENGTH = 32
+
+def get_output_dir():
+    """Return the directory in which spilled output is written."""
+    return os.path.join(os.path.expanduser(config.SIMDEM_TEMP_DIR), "output")
+
+def normalize(text):
+    """Remove ANSI escape sequences and convert line endings to "\\n"."""
+    return ANSI_PATTERN.sub("", text).replace("\r\n", "\n")
+
+class Capture(object):
+    """Collects the output of a command, written in chunks with `write`.
+    Once more than `spill_size` characters have been written, if
+    `spill_size` is not 0, the output is moved to a file in
+    `directory`. Call `close` to get the output."""
+
+    def __init__(self, spill_size=None, directory=None):
+        if spill_size is None:
+            spill_size = config.output_spill_size
+        if directory is None:
+            directory = get_output_dir()
+        self.spill_size = spill_size
+        self.directory = directory
+        self.path = None
+        self._chunks = []
+        self._size = 0
+        self._file = None
+        self._pending = ""
+        self._length = 0
+
+    def write(self, text):
+        """Add a chunk of output."""
+        if self._file is not None:
+            self._write_file(text)
+            return
+        self._chunks.append(text)
+        self._size += len(text)
+        if self.spill_size and self._size > self.spill_size:
+            self._spill()
+
+    def _spill(self):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(".log", "output-", self.directory)
+        self._file = os.fdopen(fd, "w", encoding="utf-8", newline="")
+        text = "".join(self._chunks)
+        self._chunks = None
+        self._write_file(text)
+
+    def _write_file(self, text):
+        text = self._pending + text
+        # Hold back anything that may be changed by the next chunk, an
+        # incomplete escape sequence or a "\r" that precedes a "\n"
+        cut = len(text)
+        escape = text.rfind("\x1b", max(0, cut - MAX_ESCAPE_LENGTH))
+        if escape >= 0 and "m" not in text[escape:]:
+            cut = escape
+        if cut > 0 and text[cut - 1] == "\r":
+            cut -= 1
+        self._pending = text[cut:]
+        self._write_normalized(text[:cut])
+
+    def _write_normalized(self, text):
+        text = normalize(text)
+        self._file.write(text)
+        self._length += len(text)
+
+    def close(self):
+        """Return the output, as a string if it was kept in memory,
+        otherwise as a SpilledOutput."""
+        if self._file is None:
+            return "".join(self._chunks)
+        self._write_normalized(self._pending)
+        self._pending = ""
+        self._file.close()
+        self._file = None
+        return SpilledOutput(self.path, self._length)
+
+class SpilledOutput(object):
+    """The output of a command that was written to the file at `path`.
+    ANSI escape sequences have been removed from the text in the file
+    and line endings are "\\n". `len()` gives its length in characters.
+
+    The file is deleted once this object is no longer used, unless
+    `keep` is called."""
+
+    def __init__(self, path, length):
+        self.path = path
+        self.length = length
+        self._finalizer = weakref.finalize(self, os.remove, path)
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        return self.excerpt()
+
+    def keep(self):
+        """Keep the file once this object is no longer used, for example
+        because its path is included in a test report."""
+        self._finalizer.detach()
+
+    def open(self):
+        """Return a read only, memory mapped, view of the file. The view
+        is a bytes like object and a context manager."""
+        import mmap
+        with open(self.path, "rb") as file:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, start=0, end=None):
+        """Return the text between the byte offsets `start` and `end`."""
+        with self.open() as view:
+            return view[start:end].decode("utf-8", "replace")
+
+    def lines(self):
+        """Yield a (start, end, line) tuple for each line of the output,
+        the line includes its line ending, `start` and `end` are its
+        byte offsets in the file."""
+        with self.open() as view:
+            start = 0
+            while start < len(view):
+                end = view.find(b"\n", start) + 1 or len(view)
+                yield start, end, view[start:end].decode("utf-8", "replace")
+                start = end
+
+    def excerpt(self, size=None):
+        """Return the start and end of the output, each of about `size`
+        characters, `config.output_excerpt_size` by default."""
+        if size is None:
+            size = config.output_excerpt_size
+        with self.open() as view:
+            if len(view) <= 2 * size:
+                return view[:].decode("utf-8", "replace")
+            head = view[:size].decode("utf-8", "ignore")
+            tail = view[-size:].decode("utf-8", "ignore")
+        return head + "\n... " + str(self.length - len(head) - len(tail)) + " characters omitted, see " + self.path + " ...\n" + tail
@@ -0,0 +1,221 @@
+# Recording and replaying of shell interactions.
+#
+# When recording, every command run in the shell is stored in a
+# cassette along with its output, exit code and duration. When
+# replaying, the recorded results are served from the cassette without
+# starting a shell at all. This allows changes to the parsing, variable
+# handling, scoring and reporting of documents to be tested in seconds
+# without access to the infrastructure the documents create.
+#
+# Commands are keyed by the document being run, the index of the
+# command within that document and the command text with the
+# variables it uses expanded. Cassettes are gzipped JSON files.
+#
+# While recording, streamed output is collected by a `capture.Capture`,
+# so large output is spilled to a file rather than held in memory, and
+# is copied from the file into the cassette when it is saved. Spilled
+# output is recorded as it was spilled, without ANSI escape sequences.
+
+import atexit
+import gzip
+import json
+import os
+
+import capture
+import config
+import shell
+
+# Number of characters of spilled output copied into a cassette at a
+# time
+SAVE_CHUNK_SIZE = 64 * 1024
+
+FORMAT_VERSION = 1
+
+class Cassette(object):
+    """A collection of recorded commands, see the module documentation.
+    Each entry is an (output, exit_code, duration, timed_out) tuple.
+    While recording `output` may be a `capture.SpilledOutput`."""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.steps = {}
+
+    def next_key(self, document, command):
+        """Return the key of the next command run for `document`."""
+        step = self.steps.get(document, 0)
+        self.steps[document] = step + 1
+        return document, step, command
+
+    def record(self, key, output, exit_code, duration, timed_out=False):
+        self.entries[key] = (output, exit_code, duration, timed_out)
+
+    def get(self, key):
+        """Return the entry recorded for `key`, or None."""
+        return self.entries.get(key)
+
+    def load(self):
+        """Load the cassette from `self.path`."""
+        with gzip.open(self.path, "rt", encoding="utf-8") as file:
+            data = json.load(file)
+        if data.get("version") != FORMAT_VERSION:
+            raise ValueError("Unsupported cassette version in " + self.path)
+        for document, commands in data["documents"].items():
+            for step, command, output, exit_code, duration, timed_out in commands:
+                self.entries[(document, step, command)] = (output, exit_code, duration, timed_out)
+
+    def save(self):
+        """Write the cassette to `self.path`. Entries are grouped by
+        document so that each document name is stored once. Spilled
+        output is copied from its file a chunk at a time, and the file
+        is then removed."""
+        documents = {}
+        for (document, step, command), entry in sorted(self.entries.items(), key=lambda item: (item[0][0], item[0][1])):
+            documents.setdefault(document, []).append([step, command] + list(entry))
+        spilled = []
+        with gzip.open(self.path, "wt", encoding="utf-8") as file:
+            file.write('{"version":' + json.dumps(FORMAT_VERSION) + ',"documents":{')
+            for i, (document, commands) in enumerate(documents.items()):
+                file.write(("," if i else "") + json.dumps(document) + ":[")
+                for j, (step, command, output, exit_code, duration, timed_out) in enumerate(commands):
+                    file.write(("," if j else "") + "[" + json.dumps(step) + "," + json.dumps(command) + ",")
+                    if isinstance(output, capture.SpilledOutput):
+                        self.write_spilled(file, output)
+                        spilled.append(output.path)
+                    else:
+                        file.write(json.dumps(output))
+                    file.write("," + ",".join(json.dumps(value) for value in (exit_code, duration, timed_out)) + "]")
+                file.write("]")
+            file.write("}}")
+        for path in spilled:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def write_spilled(self, file, output):
+        """Write `output`, a `capture.SpilledOutput`, to `file` as a
+        JSON string."""
+        file.write('"')
+        with open(output.path, encoding="utf-8", errors="replace", newline="") as spilled:
+            while True:
+                text = spilled.read(SAVE_CHUNK_SIZE)
+                if not text:
+                    break
+                file.write(json.dumps(text)[1:-1])
+        file.write('"')
+
+class RecordingShell(shell.BaseShell):
+    """Wraps a shell and records every command run in it in a cassette.
+    `get_key(command)` returns the (document, command) pair under which
+    to record a command, see `Cassette.next_key`.
+
+    Batches are run one command at a time, so that every command is
+    recorded in the same way it will be replayed."""
+
+    def __init__(self, wrapped, cassette, get_key):
+        self.wrapped = wrapped
+        self.cassette = cassette
+        self.get_key = get_key
+        self.env = wrapped.env
+        self.startup_time = wrapped.startup_time
+
+    @property
+    def is_alive(self):
+        return self.wrapped.is_alive
+
+    def run_command(self, command, timeout=-1, on_output=None):
+        key = self.cassette.next_key(*self.get_key(command))
+        self.is_used = True
+        self.command_count += 1
+        if on_output is None:
+            # The output is returned as a string, so it is in memory
+            # anyway
+            try:
+                output = self.wrapped.run_command(command, timeout)
+            except shell.CommandTimeout as e:
+                self.cassette.record(key, e.output or "", None, e.duration, True)
+                raise
+            self.exit_code = self.wrapped.exit_code
+            self.duration = self.wrapped.duration
+            self.cassette.record(key, output, self.exit_code, self.duration)
+            return output
+
+        # Streamed output is collected like the UI collects it, it may
+        # be spilled to a file
+        output = capture.Capture()
+
+        def record_output(text):
+            output.write(text)
+            on_output(text)
+
+        try:
+            self.wrapped.run_command(command, timeout, record_output)
+        except shell.CommandTimeout as e:
+            if e.output:
+                output.write(e.output)
+            self.cassette.record(key, self.close_capture(output), None, e.duration, True)
+            raise
+        self.exit_code = self.wrapped.exit_code
+        self.duration = self.wrapped.duration
+        self.cassette.record(key, self.close_capture(output), self.exit_code, self.duration)
+        return None
+
+    def close_capture(self, output):
+        """Return the output collected by `output`, a `capture.Capture`.
+        A spilled output file is kept until the cassette is saved."""
+        output = output.close()
+        if isinstance(output, capture.SpilledOutput):
+            output.keep()
+        return output
+
+    def close(self):
+        self.wrapped.close()
+
+class CassetteShell(shell.BaseShell):
+    """A shell that runs nothing, instead the results of commands are
+    served from a cassette. `get_key` is as for RecordingShell.
+    Commands that were not recorded output an error and exit with code
+    127, as a shell would for a command that was not found."""
+
+    def __init__(self, cassette, get_key):
+        self.cassette = cassette
+        self.get_key = get_key
+        self.env = {}
+        self.startup_time = 0
+
+    def reset(self, directory, env):
+        pass
+
+    def run_command(self, command, timeout=-1, on_output=None):
+        key = self.cassette.next_key(*self.get_key(command))
+        self.is_used = True
+        self.command_count += 1
+        entry = self.cassette.get(key)
+        if entry is None:
+            entry = ("SimDem: command not found in cassette " + self.cassette.path + ": " + command + "\n", 127, 0, False)
+        output, self.exit_code, self.duration, timed_out = entry
+        if on_output is not None:
+            shell.stream(on_output, output)
+            output = None if not timed_out else ""
+        if timed_out:
+            raise shell.CommandTimeout(command, output, self.duration)
+        return output
+
+    def close(self):
+        pass
+
+_cassette = None
+
+def get_cassette():
+    """Get the cassette for this process, as configured with
+    `config.cassette_mode` and `config.cassette_path`, creating it if
+    necessary. A recorded cassette is saved when SimDem exits."""
+    global _cassette
+    if _cassette is None:
+        _cassette = Cassette(config.cassette_path)
+        if config.cassette_mode == "replay":
+            _cassette.load()
+        else:
+            atexit.register(_cassette.save)
+    return _cassette
@@ -1,28 +1,63 @@
 # A console based UI for SimDem.
 
-import difflib
 import os
-import pexpect
-import pexpect.replwrap
 import random
-import re
 import time
 import sys
-import colorama
+import capture
 import config
-colorama.init(strip=None)
-
-PEXPECT_PROMPT = u'[PEXPECT_PROMPT>'
-PEXPECT_CONTINUATION_PROMPT = u'[PEXPECT_PROMPT+'
+import execution_log
+import shell
+import variables
+
+_colorama = None
+
+def get_colorama():
+    """Return the colorama module, importing and initialising it on
+    first use, so that runs that print nothing in colour, such as script
+    mode, don't pay for it."""
+    global _colorama
+    if _colorama is None:
+        import colorama
+        colorama.init(strip=None)
+        _colorama = colorama
+    return _colorama
+
+class LazyColorama(object):
+    """Stands in for the colorama module, which is only imported when one
+    of its attributes is first used, see `get_colorama`."""
+
+    def __getattr__(self, name):
+        return getattr(get_colorama(), name)
+
+colorama = LazyColorama()
+
+class InputCancelled(Exception):
+    """Raised when waiting for input is abandoned, for example by the
+    web UI when no input arrived from the browser in time or the
+    browser disconnected."""
+    pass
 
 class Ui(object):
     _shell = None
+    _execution_log = None
     demo = None
-    execution_log = ""
+    exit_code = None
 
     def __init__(self):
         pass
 
+    @property
+    def execution_log(self):
+        """The text displayed so far, see `get_execution_log`."""
+        return self.get_execution_log().getvalue()
+
+    def get_execution_log(self):
+        """Return the log of everything displayed by this Ui."""
+        if self._execution_log is None:
+            self._execution_log = execution_log.create()
+        return self._execution_log
+
     def prompt(self):
         """Display the prompt for the user. This is intended to indicate that
         the user is expected to take an action at this point.
@@ -36,6 +71,11 @@ class Ui(object):
     def results(self, text):
         """Display the results of a command execution"""
         self.display(text, colorama.Fore.GREEN + colorama.Style.BRIGHT, True)
+
+    def output(self, text):
+        """Display a chunk of the output of a command while it is running.
+        Unlike `results` no new line is started."""
+        self.display(text, colorama.Fore.GREEN + colorama.Style.BRIGHT)
         
     def heading(self, text):
         """Display a heading"""
@@ -103,22 +143,14 @@ to select it) and a title (to be displayed).
         new_line is set to True.
 
         """
-        self.execution_log += color
-        if self.demo.output_format == "log":
-            print(color, end="")
-        
-        self.execution_log += text
-        if self.demo.output_format == "log":
-            print(text, end="", flush=True)
-        
         if new_line:
-            self.execution_log += colorama.Style.RESET_ALL + "\n"
-            if self.demo.output_format == "log":
-                print(colorama.Style.RESET_ALL)
+            reset = colorama.Style.RESET_ALL + "\n"
         else:
-            self.execution_log += colorama.Style.RESET_ALL
-            if self.demo.output_format == "log":
-                print(colorama.Style.RESET_ALL, end="")
+            reset = colorama.Style.RESET_ALL
+        self.get_execution_log().write(color + text + reset)
+
+        if self.demo.output_format == "log":
+            print(color + text + reset, end="", flush=True)
 
     def log(self, level, text):
         if config.is_debug:
@@ -155,9 +187,7 @@ to select it) and a title (to be displayed).
         """
 
         text = ""
-        end_of_var = 0
-        current_command, undefined_var_list, defined_var_list = self.demo.get_current_command()
-        for idx, char in enumerate(current_command):
+        for char in self.demo.current_command:
             if char != "\n":
                 text += char
 
@@ -184,27 +214,10 @@ to select it) and a title (to be displayed).
         if not self.demo.is_learning or self.demo.current_command.strip() == "clear":
             self.type_command()
             _, undefined_var_list, defined_var_list = self.demo.get_current_command()
-
-            # Get values for unknown variables
-            for var_name in undefined_var_list:
-                if (self.demo.is_testing):
-                    var_value = "Dummy value for test"
-                else:
-                    var_value = self.input_interactive_variable(var_name)
-                if not var_name.startswith("SIMDEM_"):
-                    self.demo.env.set(var_name, var_value)
-                    self.run_command(var_name + '="' + var_value + '"')
-
-            # Log values if in debug mode
-            if config.is_debug:
-                self.information("\n")
-                for var_name in undefined_var_list:
-                    self.log("debug", "$" + var_name + " = " + self.demo.env.get(var_name))
-                for var_name in defined_var_list:
-                    self.log("debug", "$" + var_name + " = " + self.demo.env.get(var_name))
-                    
+            self.set_undefined_vars(undefined_var_list, defined_var_list)
             output = self.run_command()
             self.demo.last_command = self.demo.current_command
+            self.demo.last_exit_code = self.exit_code
             self.demo.current_command = ""
         else:
             done = False
@@ -233,9 +246,31 @@ to select it) and a title (to be displayed).
                     print(colorama.Fore.RED, end="")
                     print("You have a typo there")
 
-        self.log("debug", "Output: '" + output +"'")
+        self.log("debug", "Output: '" + str(output) +"'")
         return output
 
+    def set_undefined_vars(self, undefined_var_list, defined_var_list):
+        """Get values for variables that are used in the current command
+        but are not defined, and set them in the shell. In test mode a
+        dummy value is used, otherwise the user is asked for a value."""
+        # Get values for unknown variables
+        for var_name in undefined_var_list:
+            if (self.demo.is_testing):
+                var_value = "Dummy value for test"
+            else:
+                var_value = self.input_interactive_variable(var_name)
+            if not var_name.startswith("SIMDEM_"):
+                self.demo.env.set(var_name, var_value)
+                self.run_command(var_name + '="' + var_value + '"')
+
+        # Log values if in debug mode
+        if config.is_debug:
+            self.information("\n")
+            for var_name in undefined_var_list:
+                self.log("debug", "$" + var_name + " = " + self.demo.env.get(var_name))
+            for var_name in defined_var_list:
+                self.log("debug", "$" + var_name + " = " + self.demo.env.get(var_name))
+
     def input_string(self):
         """ Get a string from the user."""
         return input()
@@ -245,13 +280,55 @@ to select it) and a title (to be displayed).
         supplied demo
         """
         if self._shell == None:
-            child = pexpect.spawnu('/bin/bash', env=self.demo.env.get(), echo=False, timeout=None)
-            ps1 = PEXPECT_PROMPT[:5] + u'\[\]' + PEXPECT_PROMPT[5:]
-            ps2 = PEXPECT_CONTINUATION_PROMPT[:5] + u'\[\]' + PEXPECT_CONTINUATION_PROMPT[5:]
-            prompt_change = u"PS1='{0}' PS2='{1}' PROMPT_COMMAND=''".format(ps1, ps2)
-            self._shell = pexpect.replwrap.REPLWrapper(child, u'\$', prompt_change)
+            if config.cassette_mode == "replay":
+                import cassette
+                self._shell = cassette.CassetteShell(cassette.get_cassette(), self.get_cassette_key)
+                return self._shell
+            self._shell, wait_time = shell.get_pool().checkout(self.demo.env.get())
+            self.log("debug", "Shell started in %.3f seconds (waited %.3f seconds for it)" % (self._shell.startup_time, wait_time))
+            self.record_shell()
         return self._shell
 
+    def record_shell(self):
+        """Record the commands run in the shell, if recording, see
+        `cassette.py`."""
+        if config.cassette_mode == "record":
+            import cassette
+            self._shell = cassette.RecordingShell(self._shell, cassette.get_cassette(), self.get_cassette_key)
+
+    def get_cassette_key(self, command):
+        """Return the document, and the command with the variables it uses
+        expanded, under which a command is recorded in a cassette."""
+        if self.demo.document is not None:
+            document = self.demo.document.path
+        else:
+            document = os.path.join(self.demo.script_dir, self.demo.filename)
+        if not document.startswith("http"):
+            document = os.path.relpath(document)
+        return document, variables.expand(command, self.demo.env.get)
+
+    def replace_shell(self):
+        """Replace a shell that was closed because a command could not be
+        interrupted. The new shell is given the environment, and
+        working directory, of the old one as they were last
+        synchronized, see `Demo.sync_env`."""
+        env = self.demo.env.get()
+        directory = env.get("PWD")
+        if directory is None or not os.path.isdir(directory):
+            directory = None
+        self._shell, wait_time = shell.get_pool().checkout(env, directory)
+        self.record_shell()
+        self.warning("The shell was replaced, the directory stack and any unexported functions are lost.")
+
+    def command_timed_out(self, error):
+        """Display the output of a command that timed out, see
+        `shell.CommandTimeout`, and make sure there is a working shell
+        for the commands that follow. Any output of the command has
+        already been displayed as it arrived."""
+        self.warning("Command timed out after %.1f seconds: %s" % (error.duration, error.command.strip()))
+        if not self._shell.is_alive:
+            self.replace_shell()
+
     def run_command(self, command=None, silent = False):
         """
         Run the self.demo.curent_command unless command is passed in, in
@@ -260,6 +337,10 @@ to select it) and a title (to be displayed).
 
         A small number of commands are intercepted and handled as
         special cases, see `run_special_command`
+
+        Unless `silent` is True the output is displayed, in chunks, as
+        the command runs, see `output`. Large outputs are returned as a
+        `capture.SpilledOutput` rather than a string.
         """
         if not command:
             command = self.demo.current_command
@@ -270,15 +351,32 @@ to select it) and a title (to be displayed).
         self.log("debug", "Execute command: '" + command + "'")
         start_time = time.time()
 
-        response = self.run_special_command(command)
-        if response:
-            pass
-        else:
-            response = self.get_shell().run_command(command)
+        self.exit_code = None
+        output = capture.Capture()
+
+        def on_output(text):
+            output.write(text)
+            if not silent:
+                self.output(text)
+
+        try:
+            response = self.run_special_command(command)
+            if response:
+                on_output(response)
+            else:
+                self.get_shell().run_command(command, self.demo.get_timeout(), on_output)
+                self.exit_code = self.get_shell().exit_code
+        except shell.CommandTimeout as e:
+            e.output = output.close()
+            if not silent:
+                self.new_line()
+            self.command_timed_out(e)
+            raise
+        response = output.close()
         end_time = time.time()
 
         if not silent:
-            self.results(response)
+            self.new_line()
 
         if self.demo.is_testing:
             self.information("--- %s seconds execution time ---" % (end_time - start_time), True)
@@ -312,7 +410,7 @@ to select it) and a title (to be displayed).
 
         if orig_command != command:
             self.log("INFO", "Running special command " + orig_command + " as " + command)
-            response = self.get_shell().run_command(command)
+            response = self.get_shell().run_command(command, self.demo.get_timeout())
             return response
         else:
             return False
@@ -322,14 +420,12 @@ to select it) and a title (to be displayed).
         with the value they carry in the Environment. This is used by some special commands because the shell doesn't expand them (e.g. copying a $URL into a browser window using xdg-open)"""
 
         self.log("debug", "Expanding vars in " + command)
-        var_pattern = re.compile(".*?(?<=\$)\(?{?(\w*)(?=[\W|\$|\s|\\\"]?)\)?(?!\$).*")
-        matches = var_pattern.findall(command)
-        if matches:
-            for var in matches:
-                value = self.demo.env.get(var)
-                self.log("Debug", "Expanding variable " + var + " to value " + value)
-                command = command.replace("$" + var, value)
-        return command
+        return variables.expand(command, self.expand_var)
+
+    def expand_var(self, name):
+        value = self.demo.env.get(name)
+        self.log("debug", "Expanding variable " + name + " to value " + value)
+        return value
         
     def get_help(self):
         help = []
@@ -443,6 +539,8 @@ to select it) and a title (to be displayed).
             print(colorama.Fore.RED + colorama.Style.BRIGHT)
             print("FAILED")
             print(colorama.Style.RESET_ALL)
+            if results.get("timed_out"):
+                print("Timed out after %.1f seconds" % results["duration"])
             print("Similarity ratio:    " + str(results["similarity"]))
             print("Expected Similarity: " + str(results["required_similarity"]))
             print("\n\n=============================\n\n")
@@ -454,6 +552,11 @@ to select it) and a title (to be displayed).
             print(colorama.Fore.RED + colorama.Style.BRIGHT)
             print(results["results"])
             print(colorama.Style.RESET_ALL)
+            if "results_file" in results:
+                print("Full results: " + results["results_file"])
+            if "diff" in results:
+                print("Differences:")
+                print(results["diff"])
 
             print("\n\n=============================\n\n")
             print(colorama.Style.RESET_ALL)
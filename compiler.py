@@ -0,0 +1,395 @@
+# Compilation of documents into self contained bash test scripts.
+#
+# `simdem --test true script` outputs a bash script that runs the
+# commands of a document, or of each document in its test plan, and
+# checks their output against the results blocks, reporting the
+# outcome as TAP, or as JSON if SIMDEM_OUTPUT=json is set when it is
+# run. The prerequisites of the documents are included, each once,
+# before the first document that needs them, and are only run if their
+# validation fails. The script needs only bash and awk, and jq for
+# results blocks with `match=json`, so documents can be tested on hosts
+# without SimDem, Python or pexpect.
+#
+# Results are scored by awk. Scores are the same as SimDem's for
+# identical text and for the `lines` and `json` matchers. The default
+# `text` matcher compares lines first and then the characters of lines
+# that differ, which gives scores close to SimDem's. Regular
+# expressions are matched by grep, with Perl syntax where grep supports
+# it, one line at a time. Command timeouts are not enforced.
+
+import json
+import os
+import shlex
+
+import config
+import document
+from environment import Environment
+import prerequisite_graph
+
+def get_temp_dir():
+    """Return `config.SIMDEM_TEMP_DIR` as it is written in bash, a path
+    starting with `~/` is relative to $HOME."""
+    path = config.SIMDEM_TEMP_DIR
+    if path.startswith("~/"):
+        return "$HOME/" + path[2:]
+    return path
+
+# Variables SimDem sets, which are given values when the script runs
+# rather than when it is compiled
+RUNTIME_VARIABLES = {
+    "SIMDEM_CWD": '"$SIMDEM_ROOT"',
+    "SIMDEM_EXEC_DIR": '"$PWD"',
+    "SIMDEM_TEMP_DIR": '"${SIMDEM_TEMP_DIR-' + get_temp_dir() + '}"'
+}
+
+# Functions used by every compiled script. Each test writes the
+# expected results to $simdem_expected and the output of the command to
+# $simdem_out, scores them with simdem_score and reports the outcome
+# with simdem_report.
+RUNTIME = r'''
+simdem_dir=$(mktemp -d) || exit 2
+trap 'rm -rf "$simdem_dir"' EXIT
+simdem_out=$simdem_dir/actual
+simdem_expected=$simdem_dir/expected
+simdem_count=0
+simdem_failed=0
+simdem_json=()
+if echo | grep -qP '^$' 2>/dev/null; then
+    simdem_grep=-P
+else
+    simdem_grep=-E
+fi
+
+# Print the number of matching characters of the actual output (the
+# first file) and the expected results (the second), comparing lines
+# first, followed by the total number of characters
+simdem_awk_text='
+function chars(x, y,    lx, ly, i, j, c, prev, cur, yc, n) {
+    lx = length(x); ly = length(y)
+    if (lx == 0 || ly == 0) return 0
+    if (lx * ly > 250000) {
+        # Too long to compare every character, count the common prefix
+        # and suffix
+        for (n = 0; n < lx && n < ly && substr(x, n + 1, 1) == substr(y, n + 1, 1); n++);
+        for (i = 0; i < lx - n && i < ly - n && substr(x, lx - i, 1) == substr(y, ly - i, 1); i++);
+        return n + i
+    }
+    for (j = 1; j <= ly; j++) { yc[j] = substr(y, j, 1); prev[j] = 0 }
+    prev[0] = 0; cur[0] = 0
+    for (i = 1; i <= lx; i++) {
+        c = substr(x, i, 1)
+        for (j = 1; j <= ly; j++) {
+            if (c == yc[j]) cur[j] = prev[j - 1] + 1
+            else cur[j] = prev[j] > cur[j - 1] ? prev[j] : cur[j - 1]
+        }
+        for (j = 1; j <= ly; j++) prev[j] = cur[j]
+    }
+    return prev[ly]
+}
+function flush(    k) {
+    for (k = 1; k <= ga && k <= ge; k++) matches += chars(gap_a[k], gap_e[k]) + 1
+    ga = 0; ge = 0
+}
+FILENAME == ARGV[1] { sub(/\r$/, ""); gsub(/\033[^m]*m/, ""); a[++n] = $0; total += length($0) + 1; next }
+{ e[++m] = $0; total += length($0) + 1 }
+END {
+    if (n * m > 250000) {
+        for (i = 1; i <= n && i <= m; i++) matches += a[i] == e[i] ? length(a[i]) + 1 : chars(a[i], e[i]) + 1
+    } else {
+        for (i = n + 1; i >= 1; i--) s[i, m + 1] = 0
+        for (j = m + 1; j >= 1; j--) s[n + 1, j] = 0
+        for (i = n; i >= 1; i--)
+            for (j = m; j >= 1; j--)
+                if (a[i] == e[j]) s[i, j] = s[i + 1, j + 1] + 1
+                else s[i, j] = s[i + 1, j] >= s[i, j + 1] ? s[i + 1, j] : s[i, j + 1]
+        i = 1; j = 1
+        while (i <= n || j <= m) {
+            if (i <= n && j <= m && a[i] == e[j]) { flush(); matches += length(a[i]) + 1; i++; j++ }
+            else if (j > m || (i <= n && s[i + 1, j] >= s[i, j + 1])) gap_a[++ga] = a[i++]
+            else gap_e[++ge] = e[j++]
+        }
+        flush()
+    }
+    print matches, total
+}'
+
+# Print the number of lines common to both files, ignoring blank lines
+# and the order of the lines, followed by the total number of lines
+simdem_awk_lines='
+{ sub(/\r$/, ""); gsub(/\033[^m]*m/, ""); gsub(/^[ \t]+|[ \t]+$/, "") }
+$0 == "" { next }
+FILENAME == ARGV[1] { a[$0]++; total++; next }
+{ e[$0]++; total++ }
+END { for (line in a) if (line in e) matches += a[line] < e[line] ? a[line] : e[line]; print matches + 0, total + 0 }'
+
+# Print the flattened (path, value) pairs of a JSON document, see
+# similarity.flatten_json, for the keys in $keys if it is not empty
+simdem_jq='($keys | split(",")) as $selected
+    | paths(type != "object" and type != "array") as $path
+    | ($path | map(if type == "number" then "[\(.)]" else ".\(.)" end) | join("") | ltrimstr(".")) as $name
+    | select($keys == "" or (($name | gsub("\\[[0-9]+\\]"; "") | ltrimstr(".")) as $key | $selected | any(. == $key)))
+    | $name + "\t" + (getpath($path) | tojson)'
+
+# Score $simdem_out against $simdem_expected, setting simdem_similarity
+# and simdem_passed, which is 1, 0 or "skip". Arguments are the matcher,
+# the required similarity and the `keys` option, or the pattern for
+# the regex matcher.
+simdem_score() {
+    local counts
+    case $1 in
+        regex)
+            if tr -d '\r' <"$simdem_out" | grep -q $simdem_grep -- "$3"; then
+                simdem_similarity=1
+            else
+                simdem_similarity=0
+            fi;;
+        lines)
+            counts=$(awk "$simdem_awk_lines" "$simdem_out" "$simdem_expected");;
+        json)
+            if ! command -v jq >/dev/null; then
+                simdem_similarity=0
+                simdem_passed=skip
+                return
+            fi
+            if jq -r --arg keys "$3" "$simdem_jq" "$simdem_expected" >"$simdem_dir/expected.json" 2>/dev/null; then
+                jq -r --arg keys "$3" "$simdem_jq" "$simdem_out" >"$simdem_dir/actual.json" 2>/dev/null || : >"$simdem_dir/actual.json"
+                counts=$(awk "$simdem_awk_lines" "$simdem_dir/actual.json" "$simdem_dir/expected.json")
+            else
+                counts=$(awk "$simdem_awk_text" "$simdem_out" "$simdem_expected")
+            fi;;
+        *)
+            if cmp -s "$simdem_out" "$simdem_expected"; then
+                counts="1 2"
+            else
+                counts=$(awk "$simdem_awk_text" "$simdem_out" "$simdem_expected")
+            fi;;
+    esac
+    if [ -n "$counts" ]; then
+        simdem_similarity=$(echo "$counts" | awk '{ printf "%.4f", ($2 > 0 ? 2 * $1 / $2 : 1) }')
+    fi
+    simdem_passed=$(awk -v similarity="$simdem_similarity" -v required="$2" 'BEGIN { print (similarity + 0 >= required + 0 ? 1 : 0) }')
+}
+
+# Report the outcome of the test scored last. Arguments are the command
+# as a TAP description, as a JSON string, and the required similarity.
+simdem_report() {
+    local passed=true directive=""
+    simdem_count=$((simdem_count + 1))
+    if [ "$simdem_passed" = skip ]; then
+        directive=" # SKIP jq is not installed"
+    elif [ "$simdem_passed" != 1 ]; then
+        passed=false
+        simdem_failed=$((simdem_failed + 1))
+    fi
+    if [ "$SIMDEM_OUTPUT" = json ]; then
+        simdem_json+=("{\"command\": $2, \"passed\": $passed, \"similarity\": $simdem_similarity, \"required_similarity\": $3, \"exit_code\": $simdem_exit}")
+    elif [ "$passed" = true ]; then
+        echo "ok $simdem_count - $1$directive"
+    else
+        echo "not ok $simdem_count - $1"
+        echo "  ---"
+        echo "  similarity: $simdem_similarity"
+        echo "  required_similarity: $3"
+        echo "  exit_code: $simdem_exit"
+        echo "  actual: |"
+        tr -d '\r' <"$simdem_out" | head -n 50 | sed 's/^/    /'
+        echo "  ..."
+    fi
+    if [ "$passed" = false ] && [ "$SIMDEM_FAST_FAIL" = true ]; then
+        simdem_finish
+    fi
+}
+
+simdem_note() {
+    if [ "$SIMDEM_OUTPUT" != json ]; then
+        echo "# $1"
+    fi
+}
+
+simdem_cd() {
+    cd "$SIMDEM_ROOT/$1" 2>/dev/null || simdem_note "Directory not found: $SIMDEM_ROOT/$1"
+}
+
+simdem_finish() {
+    local IFS=,
+    if [ "$SIMDEM_OUTPUT" = json ]; then
+        echo "{\"passed\": $((simdem_count - simdem_failed)), \"failed\": $simdem_failed, \"tests\": [${simdem_json[*]}]}"
+    else
+        echo "1..$simdem_count"
+    fi
+    if [ "$simdem_failed" -gt 0 ]; then
+        exit 1
+    fi
+    exit 0
+}
+'''
+
+class ScriptCompiler(object):
+    """Builds a compiled test script, see the module documentation.
+    `root` is the directory of the document, or test plan, being
+    compiled. Documents are added with `add_document`."""
+
+    def __init__(self, root):
+        self.root = root
+        self.lines = []
+        self.prerequisites = set()
+        self.functions = 0
+
+    def emit(self, line=""):
+        self.lines.append(line)
+
+    def add_document(self, path):
+        """Add the document at `path`, preceded by any of its
+        prerequisites that have not been added already."""
+        doc = document.load(path)
+        directory = os.path.dirname(path)
+        for prerequisite in prerequisite_graph.get_paths(doc.prerequisites, self.root, directory):
+            self.add_prerequisite(prerequisite, [path])
+        self.emit()
+        self.emit("# " + path)
+        self.add_commands(doc, directory)
+
+    def add_prerequisite(self, path, stack):
+        """Add the prerequisite at `path` after its own prerequisites.
+        `stack` lists the documents that lead to it, to detect circular
+        prerequisites."""
+        if path in stack:
+            exit("Circular prerequisites: " + " -> ".join(stack[stack.index(path):] + [path]))
+        if path in self.prerequisites:
+            return
+        if not os.path.isfile(path):
+            exit("Missing prerequisite script: " + path)
+        self.prerequisites.add(path)
+
+        doc = document.load(path)
+        directory = os.path.dirname(path)
+        for prerequisite in prerequisite_graph.get_paths(doc.prerequisites, directory, directory):
+            self.add_prerequisite(prerequisite, stack + [path])
+
+        self.emit()
+        self.emit("# Prerequisite " + path)
+        if not prerequisite_graph.has_validation(doc):
+            self.add_commands(doc, directory)
+            return
+
+        self.functions += 1
+        function = "simdem_validate_" + str(self.functions)
+        self.emit(function + "() {")
+        self.add_cd(directory)
+        in_validation = False
+        for node in doc.nodes:
+            if node.type == "validation":
+                in_validation = True
+            elif node.type == "heading":
+                in_validation = False
+            elif in_validation and node.type == "executable":
+                self.add_command(node, is_validation=True)
+        self.emit("return 0")
+        self.emit("}")
+        self.emit("if " + function + "; then")
+        self.emit("simdem_note " + shlex.quote("Validation passed: " + path))
+        self.emit("else")
+        self.add_commands(doc, directory)
+        self.emit("fi")
+
+    def add_cd(self, directory):
+        self.emit("simdem_cd " + shlex.quote(os.path.relpath(directory, self.root)))
+
+    def add_commands(self, doc, directory):
+        """Add every command in `doc`, which is in `directory`."""
+        self.add_cd(directory)
+        for node in doc.nodes:
+            if node.type == "executable":
+                self.add_command(node)
+
+    def add_command(self, command, is_validation=False):
+        """Add a command, and a test of its output if it is followed by a
+        results block. In a validation function a failed test returns
+        from the function rather than being reported."""
+        text = command.text.strip()
+        if text.startswith("xdg-open "):
+            # As the CLI does, see `Ui.run_special_command`
+            text = "curl -I " + text[9:] + " --connect-timeout 90"
+        run = ["{ " + text, '} >"$simdem_out" 2>&1', "simdem_exit=$?"]
+
+        results = command.results
+        if results is None:
+            self.lines.extend(run)
+            return
+
+        matcher = results.options.get("match", "text").lower()
+        if matcher == "regex":
+            argument = results.text.strip()
+        else:
+            argument = results.options.get("keys", "")
+        required = repr(results.expected_similarity)
+        score = "simdem_score " + " ".join(shlex.quote(value) for value in [matcher, required, argument])
+
+        expected = results.text
+        if not expected.endswith("\n"):
+            expected += "\n"
+        delimiter = "SIMDEM_EXPECTED"
+        while delimiter in expected:
+            delimiter += "_"
+        self.emit("cat >\"$simdem_expected\" <<'" + delimiter + "'")
+        self.lines.append(expected + delimiter)
+
+        if "wait_until" in command.options:
+            self.emit("simdem_deadline=$((SECONDS + " + str(int(float(command.options["wait_until"]))) + "))")
+            self.emit("simdem_delay=" + str(max(int(config.wait_initial_delay), 1)))
+            self.emit("while :; do")
+            self.lines.extend(run)
+            self.emit(score)
+            self.emit('if [ "$simdem_passed" != 0 ] || [ "$SECONDS" -ge "$simdem_deadline" ]; then break; fi')
+            self.emit('sleep "$simdem_delay"')
+            self.emit("simdem_delay=$((simdem_delay * 2 > " + str(int(config.wait_max_delay)) + " ? " + str(int(config.wait_max_delay)) + " : simdem_delay * 2))")
+            self.emit("done")
+        else:
+            self.lines.extend(run)
+            self.emit(score)
+
+        if is_validation:
+            self.emit('[ "$simdem_passed" = 1 ] || return 1')
+        else:
+            description = text.replace("\\", "\\\\").replace("#", "\\#")
+            self.emit("simdem_report " + " ".join(shlex.quote(value) for value in [description, json.dumps(text), required]))
+
+    def script(self, source, output_format, is_fast_fail):
+        """Return the script. `source` is the document or test plan it
+        was compiled from, `output_format` and `is_fast_fail` the
+        default output format, "tap" or "json", and whether to stop at
+        the first failure."""
+        header = [
+            "#!/usr/bin/env bash",
+            "# SimDem test script compiled from " + source + " by SimDem " + config.SIMDEM_VERSION + ".",
+            "# Set SIMDEM_OUTPUT to 'tap' or 'json' to select the output format,",
+            "# SIMDEM_FAST_FAIL to 'false' to run every test after a failure and",
+            "# SIMDEM_ROOT to the directory holding the documents if it has moved.",
+            "",
+            "SIMDEM_OUTPUT=${SIMDEM_OUTPUT-" + output_format + "}",
+            "SIMDEM_FAST_FAIL=${SIMDEM_FAST_FAIL-" + ("true" if is_fast_fail else "false") + "}",
+            "SIMDEM_ROOT=${SIMDEM_ROOT-" + shlex.quote(self.root) + "}",
+            RUNTIME,
+            "# Environment"
+        ]
+        env = Environment(self.root, copy_env=False, is_test=True).get()
+        for name, value in sorted(env.items()):
+            header.append("export " + name + "=" + RUNTIME_VARIABLES.get(name, shlex.quote(value)))
+        header.append("simdem_note " + shlex.quote("SimDem tests compiled from " + source))
+        return "\n".join(header + self.lines + ["", "simdem_finish", ""])
+
+def compile_tests(demo):
+    """Return a bash script that tests the document of `demo`, or each
+    document in its test plan, see the module documentation."""
+    test_plan = demo.get_test_plan()
+    if test_plan:
+        source = os.path.join(demo.script_dir, "test_plan.txt")
+        paths = test_plan
+    else:
+        source = os.path.join(demo.script_dir, demo.filename)
+        paths = [source]
+    compiler = ScriptCompiler(demo.script_dir)
+    for path in paths:
+        compiler.add_document(path)
+    output_format = "json" if demo.output_format == "json" else "tap"
+    return compiler.script(source, output_format, demo.is_fast_fail)
@@ -8,9 +8,131 @@ TYPING_DELAY = 0.2
 # Prompt to use in the console
 console_prompt = "$ "
 
+# Number of bash shells to start in the background, ready for use,
+# while a document is being prepared
+shell_pool_size = 1
+
+# Maximum size, in bytes, of the on disk cache of parsed documents
+document_cache_size = 16 * 1024 * 1024
+
+# Expected and actual results larger than this, in characters, are
+# compared line by line before comparing characters. This bounds the
+# time taken to score large outputs, such as JSON documents. Characters
+# are then only matched within paired lines, so the score can be lower
+# than the character ratio used for smaller results, see similarity.py.
+similarity_line_threshold = 4096
+
+# Output of a command longer than output_spill_size characters is
+# written to a file under SIMDEM_TEMP_DIR/output rather than kept in
+# memory, 0 keeps all output in memory. Reports of failed tests include
+# output_excerpt_size characters from the start and the end of such
+# output, and the path of the file.
+output_spill_size = 1024 * 1024
+output_excerpt_size = 2048
+
+# Number of characters of the most recent output to keep in memory in
+# the execution log, 0 keeps all output
+execution_log_memory = 256 * 1024
+
+# Set is_execution_log_file to True to write the full execution log to
+# SIMDEM_TEMP_DIR/logs. Log files are rotated when they reach
+# execution_log_file_size characters, keeping execution_log_file_backups
+# old files.
+is_execution_log_file = False
+execution_log_file_size = 10 * 1024 * 1024
+execution_log_file_backups = 3
+
+# Seconds to wait before the second attempt of a command that waits
+# for a result (see `wait_until` in the syntax documentation), the
+# delay doubles after each attempt up to wait_max_delay seconds
+wait_initial_delay = 1
+wait_max_delay = 30
+
+# The output of a running command is displayed as it arrives, in
+# chunks of at most stream_chunk_size characters. With the 'pty'
+# executor new output is checked for every stream_interval seconds.
+stream_chunk_size = 8192
+stream_interval = 0.1
+
+# Seconds a command may run for before it is interrupted and recorded
+# as timed out, None allows commands to run forever. This can be
+# overriden for a code block with the `timeout` option on its fence
+# line, or in the command line with the `--timeout` option.
+command_timeout = None
+
+# Seconds all of the commands in a document, or in each test plan
+# entry, may run for before the document is abandoned, None allows
+# documents to run forever. This can be overriden in the command line
+# with the `--doctimeout` option.
+document_timeout = None
+
+# Seconds to wait for a shell to return to the prompt after a command
+# that timed out is interrupted. If it does not the shell is replaced.
+interrupt_timeout = 5
+
+# Set cassette_mode to "record" to record the results of all commands
+# in the cassette file at cassette_path, or "replay" to serve results
+# from it rather than running commands. This can be overriden in the
+# command line with the `--record` and `--replay` options.
+cassette_mode = None
+cassette_path = None
+
+# Seconds for which a prerequisite that passed validation is considered
+# satisfied by later runs, which skip its validation commands, 0
+# always validates prerequisites. The cache can't tell if the state the
+# validation checked, such as files or cloud resources, has since been
+# changed or deleted, so it is off by default and never used in test
+# mode. Set is_revalidate to True to ignore earlier validations, this
+# can be overriden in the command line with the `--revalidate true`
+# option.
+validation_cache_ttl = 0
+is_revalidate = False
+
+# Number of prerequisites whose validation steps are run concurrently,
+# each in a shell of its own, before any prerequisite is run. 1
+# validates prerequisites one at a time in the shell of the document.
+prerequisite_jobs = 4
+
+# Set is_incremental to True to skip, when testing, the test plan
+# entries that passed last time and have not changed since, see
+# `incremental.py`. This can be overriden in the command line with the
+# `--incremental true` option.
+is_incremental = False
+
+# Number of scripts whose titles are read concurrently when the index
+# of scripts used to generate a table of contents is built, see
+# `script_index.py`. 1 reads titles one at a time.
+script_index_jobs = 8
+
+# Documents served over HTTP are cached on disk, in at most
+# remote_cache_size bytes, and served from the cache for
+# remote_cache_ttl seconds after they were fetched before being
+# revalidated with the server, see `remote.py`. Requests time out
+# after remote_timeout seconds and are retried remote_retries times.
+# The prerequisites of a remote document are fetched remote_jobs at a
+# time.
+remote_cache_size = 16 * 1024 * 1024
+remote_cache_ttl = 5 * 60
+remote_timeout = 30
+remote_retries = 2
+remote_jobs = 4
+
+# Set is_offline to True to serve documents served over HTTP only from
+# the cache, without any requests. This can be overriden in the
+# command line with the `--offline true` option.
+is_offline = False
+
 # Port for web server when running with '--webui true' optios
 port = 8080
 
+# Seconds to wait for input from the web UI before giving up, None
+# waits forever
+webui_input_timeout = None
+
+# Seconds to wait for a browser to reconnect to the web UI before
+# abandoning any wait for input
+webui_disconnect_timeout = 30
+
 # ------------------------------------------------------------------ #
 # Danger zone
 #
@@ -22,6 +144,19 @@ port = 8080
 # can be overriden in the command like with the `--debug true` option.
 is_debug = False
 
+# Set is_minimal_shell to True to start shells without reading any
+# bash profile or rc files. This can be overriden in the command line
+# with the `--norc true` option.
+is_minimal_shell = False
+
+# The backend used to execute commands. 'pty' runs commands in an
+# interactive bash session through a pseudo terminal, exactly as a user
+# would see them. 'pipe' runs them in a bash session connected through
+# pipes, which is faster and reports exit codes, but commands do not
+# have a terminal. This can be overriden in the command line with the
+# `--executor` option.
+executor = "pty"
+
 # Available modes of execution
 modes = [ "tutorial", "demo", "learn", "test", "script", "prep" ]
 
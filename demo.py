@@ -1,25 +1,38 @@
 # This class represents a Demo to be executed in SimDem.
 
 import datetime
-import difflib
-from itertools import tee, islice, zip_longest
+from collections import deque
+from itertools import islice
 import json
 import os
+import random
 import re
 import sys
-import urllib.request
+import time
+from capture import SpilledOutput
+import document
 from environment import Environment
+import shell
+import validation
+import variables
 
 from cli import Ui
 import config
 
 def get_next(some_iterable, window=1):
-    items, nexts = tee(some_iterable, 2)
-    nexts = islice(nexts, window, None)
-    return zip_longest(items, nexts)
+    """Yield a tuple of each item and the item `window` places after it
+    (None towards the end). Only `window + 1` items are held in memory
+    at a time, so this can be used on streams of any length."""
+    iterator = iter(some_iterable)
+    ahead = deque(islice(iterator, window))
+    for item in iterator:
+        ahead.append(item)
+        yield ahead.popleft(), item
+    while ahead:
+        yield ahead.popleft(), None
 
 class Demo(object):
-    def __init__(self, is_running_in_docker, script_dir="demo_scripts", filename="README.md", is_simulation=True, is_automated=False, is_testing=False, is_fast_fail=True,is_learning = False, parent_script_dir = None, is_prep_only = False, is_prerequisite = False, output_format="log"):
+    def __init__(self, is_running_in_docker, script_dir="demo_scripts", filename="README.md", is_simulation=True, is_automated=False, is_testing=False, is_fast_fail=True,is_learning = False, parent_script_dir = None, is_prep_only = False, is_prerequisite = False, output_format="log", jobs=1):
         """
         is_running_in_docker should be set to true is we are running inside a Docker container
         script_dir is the location to look for scripts
@@ -32,6 +45,7 @@ class Demo(object):
         parent_script_dir should be the directory of the script that calls this one, or None if this is the root script
         is_prep_only should be set to true if we want to stop execution after all prerequisites are satsified
         is_prerequisite indicates whether this is a prerequisite or not. It is used to decide behaviour with respect to simulation etc.
+        jobs is the number of test plan entries to execute concurrently when running in test mode
         """
         self.mode = None
         self.is_docker = is_running_in_docker
@@ -46,6 +60,10 @@ class Demo(object):
         self.current_command = ""
         self.current_description = ""
         self.last_command = ""
+        self.last_exit_code = None
+        self.last_attempts = None
+        self.command_timeout = config.command_timeout
+        self.document_deadline = None
         self.is_prep_only = is_prep_only
         self.parent_script_dir = parent_script_dir
         if self.parent_script_dir:
@@ -56,12 +74,21 @@ class Demo(object):
         self.output_format = output_format
         self.all_results = []
         self.completed_validation_steps = []
+        self.jobs = jobs
+        self.test_plan = None
+        self.document = None
         
     def set_script_dir(self, script_dir, base_dir = None):
+        import remote
         if base_dir is not None and not base_dir.endswith(os.sep):
             base_dir += os.sep
         elif base_dir is None:
             base_dir = ""
+        if remote.is_remote(base_dir):
+            script_dir = remote.join(base_dir, script_dir)
+        if remote.is_remote(script_dir):
+            self.script_dir = script_dir.rstrip("/")
+            return
             
         self.script_dir = os.path.abspath(os.path.join(base_dir,  script_dir))
         
@@ -70,68 +97,96 @@ class Demo(object):
         Return a tuple of the current command and a list of environment
         variables that haven't been set and a list that have been set..
         """
-
-        # If the command sets a variable put it in our env copy
-        pattern = re.compile("^(\w*)=(.*)$")
-        match = pattern.match(self.current_command)
-        if match:
-            key = match.groups()[0]
-            val = match.groups()[1]
-            self.env.set(key, val)
-            
-        # Get all the vars, check to see if they are uninitialized
-        var_pattern = re.compile(".*?(?<=\$)\(?{?(\w*)(?=[\W|\$|\s|\\\"]?)\)?(?!\$).*")
-        matches = var_pattern.findall(self.current_command)
-        undefined_var_list = []
-        defined_var_list = []
-        if matches:
-            for var in matches:
-                have_value = False
-                if self.env:
-                    for item in self.env.get():
-                        if var == item:
-                            have_value = True
-                            defined_var_list.append(var)
-                            break
-                if len(var) > 0 and not have_value and not '$(' + var in self.current_command:
-                    value = self.ui.get_shell().run_command("echo $" + var).strip()
-                    if len(value) == 0:
-                        undefined_var_list.append(var)
-                    else:
-                        defined_var_list.append(var)
+        undefined_var_list, defined_var_list = self.get_command_vars([self.current_command])
         return self.current_command, undefined_var_list, defined_var_list
 
+    def get_command_vars(self, commands):
+        """Return a list of the variables used in the supplied commands that
+        have not been set and a list of those that have. Commands are
+        assumed to be run in order, so variables set by one command are
+        defined for those that follow it.
+
+        Variables are looked up in our environment. If any are not
+        found, and commands have been run since the environment was
+        last synchronized with the shell, it is synchronized first.
+        """
+        env = self.env.get()
+        assigned = set()
+        names = {}
+        for command in commands:
+            assigned.update(variables.get_assigned_names(command))
+            for name in variables.get_names(command):
+                if name not in assigned:
+                    names[name] = True
+
+        if any(name not in env for name in names):
+            self.sync_env()
+        defined_var_list = [name for name in names if name in env]
+        undefined_var_list = [name for name in names if name not in env]
+        return undefined_var_list, defined_var_list
+
+    def get_timeout(self):
+        """Return the number of seconds the next command may run for, or
+        None if there is no limit. This is the smaller of the command
+        timeout, see `set_command_timeout`, and the time left before
+        the document times out."""
+        timeout = self.command_timeout
+        if self.document_deadline is not None:
+            remaining = max(self.document_deadline - time.time(), 0)
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+        return timeout
+
+    def set_command_timeout(self, line):
+        """Set the timeout for the commands in `line` from the `timeout`
+        option of its code block, or `config.command_timeout` if it has
+        none."""
+        if "timeout" in line.options:
+            self.command_timeout = float(line.options["timeout"])
+        else:
+            self.command_timeout = config.command_timeout
+
+    def start_document_timer(self):
+        """Start timing a document, see `config.document_timeout`."""
+        if config.document_timeout is None:
+            self.document_deadline = None
+        else:
+            self.document_deadline = time.time() + config.document_timeout
+
+    def is_document_timed_out(self):
+        return self.document_deadline is not None and time.time() >= self.document_deadline
+
+    def sync_env(self):
+        """Bring our environment up to date with the variables set in the
+        shell, unless it already is. This takes at most one round trip
+        to the shell."""
+        shell = self.ui.get_shell()
+        if not self.env.is_synced(shell):
+            self.env.sync(shell)
+
     def get_scripts(self, directory):
         """
-        Starting with the supplied directory find all `README.md` files
-        and return them as a list of scripts available to this execution.
-        We will not return multiple `README.md` files from each part of 
-        the tree. It is assumed that the highest level `README.md` files
-        contains an index of scripts in that directory.
+        Starting with the supplied directory find all `README.md` and
+        `script.md` files and return their paths, relative to the
+        directory, as a list of scripts available to this execution.
+        The scripts are found through a persistent index of the
+        directory, see `script_index.py`.
 
         """
-        lines = []
-        for dirpath, dirs, files in os.walk(directory):
-            for file in files:
-                if file == "README.md" or file == "script.md":
-                    lines.append(os.path.join(dirpath[len(directory):], file) + "\n")
-                
-        return lines
+        import script_index
+        return [path + "\n" for path, _ in script_index.get_scripts(directory)]
 
     def generate_toc(self):
+        import script_index
         toc = {}
         lines = []
         lines.append("# Welcome to Simdem\n")
         lines.append("Below is an autogenerated list of scripts available in `" + self.script_dir + "` and its subdirectories. You can execute any of them from here.\n\n")
         lines.append("# Next Steps\n")
 
-        scripts = self.get_scripts(self.script_dir)
+        scripts = script_index.get_scripts(self.script_dir)
             
-        for script in scripts:
-            script = script.strip()
-            with open(os.path.join(self.script_dir, script)) as f:
-                title = f.readline().strip()
-                title = title[2:]
+        for script, title in scripts:
             demo = { "title": title, "path": script }
 
             name, _ = os.path.split(script)
@@ -179,7 +234,11 @@ class Demo(object):
         self.ui.log("debug", "Running script in " + self.mode + " mode")
 
         if mode == "script":
-            print(self.get_bash_script())
+            if self.is_testing:
+                import compiler
+                print(compiler.compile_tests(self))
+            else:
+                print(self.get_bash_script())
             return
         elif mode == "demo":
             # we automate the prereq steps so start in auto mode without simulation
@@ -206,8 +265,15 @@ class Demo(object):
         
         self.ui.log("debug", "Running script called '" + self.filename + "' in '" + self.script_dir +"'")
         
-        classified_lines = self.classify_lines()
-        failed_tests, passed_tests = self.execute(classified_lines)
+        test_plan = self.get_test_plan()
+        if test_plan and self.jobs > 1 and type(self.ui) is Ui and not self.is_prep_only:
+            # Each test plan entry gets its own worker process, shell
+            # and environment
+            import parallel
+            failed_tests, passed_tests = parallel.execute_test_plan(self, test_plan, self.jobs)
+        else:
+            classified_lines = self.classify_lines()
+            failed_tests, passed_tests = self.execute(classified_lines)
 
         if self.is_prep_only:
             if failed_tests == 0:
@@ -232,10 +298,10 @@ class Demo(object):
 
         if not self.is_simulation and not self.is_testing and not self.is_prep_only:
             next_steps = []
-            for line in classified_lines:
-                if line["type"] == "next_step" and len(line["text"].strip()) > 0:
+            for line in self.document.next_steps:
+                if len(line.text.strip()) > 0:
                     pattern = re.compile('.*\[.*\]\((.*)\/(.*)\).*')
-                    match = pattern.match(line["text"])
+                    match = pattern.match(line.text)
                     if match:
                         next_steps.append(line)
 
@@ -257,7 +323,7 @@ class Demo(object):
 
                 self.ui.log("debug", "Selected next step: " + str(next_steps[in_value -1]))
                 pattern = re.compile('.*\[.*\]\((.*)\/(.*)\).*')
-                match = pattern.match(next_steps[in_value -1]["text"])
+                match = pattern.match(next_steps[in_value -1].text)
                 self.set_script_dir(match.groups()[0], self.script_dir)
                 self.filename = match.groups()[1]
                 self.run(self.mode)
@@ -290,6 +356,8 @@ logs throughout execution."""
             if self.output_format == "summary":
                 if is_success:
                     meta = "Succesful test"
+                    if result.get("cached"):
+                        meta += " (cached)"
                 else:
                     meta = "Failed test:\t" + json.dumps(failure_message)
                 meta += "\nTime (UTC):\t" + timestamp
@@ -309,6 +377,7 @@ logs throughout execution."""
                     "Region": region,
                     "Orchestrator": orchestrator,
                     "Success": is_success,
+                    "Cached": result.get("cached", False),
                     "FailureStr": failure_message
                 }
                 output.append(meta)
@@ -342,227 +411,178 @@ logs throughout execution."""
             else:
                 sys.exit(output)
 
-    def classify_lines(self):
-        lines = None
-
-        # Only run through test plan for the first script
-        if self.is_testing and self.parent_script_dir is None:
-            test_file = os.path.join(self.script_dir,  "test_plan.txt")
-            if os.path.isfile(test_file):
-                self.ui.log("info", "Executing test plan in " + test_file)
-                plan_lines = list(open(test_file))
-                lines = []
-                for line in plan_lines:
-                    line = line.strip()
-                    if not line == "" and not line.startswith("#"):
-                        # not a comment or whitespace so should be a path to a script with tests
-                        self.ui.log("debug", "Including " + line + " in tests.")
-                        before = len(lines)
-                        file = os.path.join(self.script_dir, line)
-                        lines.append("START TEST FILE: " + file)
-                        lines = lines + list(open(file))
-                        lines.append("END TEST FILE: " + file)
-                        after = len(lines)
-                        self.ui.log("debug", "Added " + str(after - before) + " lines.")
-                        
-        if lines is None:
-            if (self.script_dir.endswith(".md")):
-                self.script_dir, self.filename = os.path.split(self.script_dir)
-                
-            file = os.path.join(self.script_dir, self.filename)
-            self.ui.log("info", "Reading lines from " + file)
-    
-            if file.startswith("http"):
-                # FIXME: Error handling
-                response = urllib.request.urlopen(file)
-                data = response.read().decode("utf-8")
-                lines = data.splitlines(True)
-            else:
-                if not lines and os.path.isfile(file):
-                    lines = list(open(file))
-                elif not lines:
-                    if self.parent_script_dir != "":
-                        # If we have a parent then this is a preqiusite and therefore it should exist
-                        # if it doesn't then it may be that we are using relative paths
-                        # from the script location and that is different from self.script_dir
-                        exit("Missing prerequisite script: " + self.filename + " in " + self.script_dir)
-                    else:
-                        lines = self.generate_toc()
-
-        test_file_path = None
-        in_code_block = False
-        in_non_executable_code_block = False
-        in_results_section = False
-        in_next_steps = False
-        in_prerequisites = False
-        in_validation_section = False
-        executed_code_in_this_section = False
-
-        classified_lines = []
-
-        # TODO: this for loop is awful. We need to make this a state machine. It has grown out of control.
-        for line in lines:
-            # print("Classifying line: " + line)
-            if line.startswith("START TEST FILE: "):
-                test_file_path = line[17:]
-                self.ui.log("debug", "Entering test file: " + test_file_path)
-                classified_lines.append({"type": "start_test_file",
-                                         "file": test_file_path})
-            elif line.startswith("END TEST FILE: "):
-                test_file_path = line[15:]
-                self.ui.log("debug", "Exiting test file: " + test_file_path)
-                classified_lines.append({"type": "end_test_file",
-                                         "file": test_file_path})
-                test_file_path = None
-            elif line.lower().startswith("results:"):
-                # Entering results section
-                # print("Entering results section " + line)
-                in_results_section = True
-            elif not in_code_block and line.strip().lower() == "```bash":
-                # Entering a code block,
-                # print("Entering executable code block " + line);
-                in_code_block = True 
-            elif not in_code_block and not in_non_executable_code_block and line.startswith("```"):
-                if (not in_results_section and line.strip() == "```"):
-                        self.ui.warning("Found a backtick line with no language hint near line " + str(len(classified_lines) + 1) + " of '" + file + "'\n. Treating as a non-executable code block, this can result in failed tests if this is intended to be executable. Add a 'bash' language hint to mark it as executable.")
-                # Entering a non executable code block - one we don't know how to execute
-                #print("Entering a non-executable block " + line)
-                in_non_executable_code_block = True
-                pos = line.lower().find("expected_similarity")
-                if pos >= 0:
-                    pos = line.find("=", pos) + 1
-                    similarity = line[pos:].strip()
-                    expected_similarity = float(similarity)
-                else:
-                    expected_similarity = 0.5
-                self.ui.log("debug", "Expected similarity set to " + str(expected_similarity) + " because of line '" + line + "'")
-            elif (in_code_block or in_non_executable_code_block or in_results_section) and line.strip().startswith("```"):
-                # Finishing code block
-                # print("Exiting code block " + line)
-                in_code_block = False
-                in_non_executable_code_block = False
-                in_results_section = False
-                in_validation_section = False
-            elif in_results_section and (in_code_block or in_non_executable_code_block):
-                # print("Adding results line " + line)
-                classified_lines.append({"type": "result",
-                                         "expected_similarity": expected_similarity,
-                                         "text": line})
-            elif in_code_block and not in_results_section:
-                # Executable line
-                # print("Add executable line " + line)
-                if line.strip().startswith("#"):
-                    # comment
-                    pass
-                else:
-                    classified_lines.append({"type": "executable",
-                                             "text": line})
-            elif not in_code_block and not in_results_section and line.strip().startswith("#"):
-                # Heading in descriptive text, indicating a new section
-                if line.lower().strip().endswith("# next steps"):
-                    in_next_steps = True
-                    in_prerequisites = False
-                    in_validation_section = False
-                elif line.lower().strip().endswith("# prerequisites"):
-                    self.ui.log("debug", "Found a prerequisites section")
-                    in_prerequisites = True
-                    in_validation_section = False
-                    in_next_steps = False
-                elif line.lower().strip().startswith("# validation"):
-                    # Entering validation section
-                    self.ui.log("debug", "Entering Validation Section")
-                    in_validation_section = True
-                    in_prerequisites = False
-                    in_next_steps = False
-                else:
-                    in_prerequisites = False
-                    in_validation_section = False
-                    in_next_steps = False
-                classified_lines.append({"type": "heading",
-                                         "text": line})
-            else:
-                if in_next_steps:
-                    classified_lines.append({"type": "next_step",
-                                             "text": line})
-                elif in_prerequisites and len(line.strip()) > 0:
-                    if test_file_path:
-                        source_file_path = test_file_path
-                    else:
-                        source_file_path = os.path.join(self.script_dir, self.filename)
-                    classified_lines.append({"type": "prerequisite",
-                                             "text": line,
-                                             "source_file_path": source_file_path})
-                elif in_validation_section:
-                    classified_lines.append({"type": "validation",
-                                             "text": line})
-                else:
-                    classified_lines.append({"type": "description",
-                                             "text": line})
+    def get_test_plan(self):
+        """Return the list of script files to execute as part of the test
+        plan, in plan order, or None if there is no test plan for this
+        demo. A test plan is only used when testing the first (root)
+        script. If `self.test_plan` has been set it is used in place of
+        the `test_plan.txt` file.
 
-            is_first_line = False
+        """
+        if self.test_plan is not None:
+            return self.test_plan
+
+        if not self.is_testing or self.parent_script_dir is not None:
+            return None
+
+        test_file = os.path.join(self.script_dir,  "test_plan.txt")
+        if not os.path.isfile(test_file):
+            return None
+
+        self.ui.log("info", "Executing test plan in " + test_file)
+        test_plan = []
+        for line in open(test_file):
+            line = line.strip()
+            if not line == "" and not line.startswith("#"):
+                # not a comment or whitespace so should be a path to a script with tests
+                self.ui.log("debug", "Including " + line + " in tests.")
+                test_plan.append(os.path.join(self.script_dir, line))
+        self.test_plan = test_plan
+        return test_plan
 
-        classified_lines.append({"type": "EOF",
-                                 "text": ""})
+    def classify_lines(self):
+        """Yield the nodes of the document this demo represents, or of
+        each document in the test plan, followed by an EOF node. See
+        `document.py` for the node types.
+
+        This is a generator, documents are only loaded when the
+        executor reaches them, so execution of a large test plan starts
+        as soon as the first document is loaded and only one document
+        is held in memory at a time. `self.document` is the document
+        whose nodes are currently being yielded.
+        """
+        # Only run through test plan for the first script
+        test_plan = self.get_test_plan()
+        if test_plan:
+            for file in test_plan:
+                doc = self.load_document(file)
+                for warning in doc.warnings:
+                    self.ui.warning(warning)
+                self.document = doc
+                yield document.StartTestFile(file)
+                yield from self.log_nodes(doc.nodes)
+                yield document.EndTestFile(file)
+                self.ui.log("debug", "Added " + str(len(doc.nodes)) + " lines.")
+        else:
+            yield from self.log_nodes(self.get_document().nodes)
+
+        yield document.EndOfFile()
+
+    def log_nodes(self, nodes):
+        """Yield the supplied nodes, logging each of them in debug mode."""
+        for node in nodes:
+            if config.is_debug:
+                self.ui.log("debug", "Classified line: " + str(node))
+            yield node
+
+    def get_document(self):
+        """Load the document this demo represents and make it the current
+        document. If the script is not found then a document listing
+        all the available scripts is generated."""
+        import remote
+        if (self.script_dir.endswith(".md")):
+            self.script_dir, self.filename = os.path.split(self.script_dir)
+
+        file = os.path.join(self.script_dir, self.filename)
+        self.ui.log("info", "Reading lines from " + file)
+
+        if remote.is_remote(file):
+            try:
+                data = remote.fetch(file)
+            except remote.FetchError as e:
+                exit(str(e))
+            doc = document.parse(file, data.splitlines(True))
+        elif os.path.isfile(file):
+            doc = self.load_document(file)
+        elif self.parent_script_dir:
+            # If we have a parent then this is a preqiusite and therefore it should exist
+            # if it doesn't then it may be that we are using relative paths
+            # from the script location and that is different from self.script_dir
+            exit("Missing prerequisite script: " + self.filename + " in " + self.script_dir)
+        else:
+            doc = document.parse(file, self.generate_toc())
+        for warning in doc.warnings:
+            self.ui.warning(warning)
+        self.document = doc
+        return doc
 
-        if config.is_debug:
-            self.ui.log("debug", "Classified lines: ")
-            for line in classified_lines:
-                self.ui.log("debug", str(line))
-        
-        return classified_lines
+    def load_document(self, path):
+        """Load the parsed document at `path`, see `document.load`."""
+        self.ui.log("debug", "Loading document " + path)
+        return document.load(path)
 
     def execute(self, lines):
         """Execute the script found in the lines. Return the number of failed
            tests and the number of passed tests."""
-        
+        import incremental
         source_file_directory = None
         is_first_line = True
-        in_results = False
-        expected_results = ""
         actual_results = ""
         failed_tests = 0
         passed_tests = 0
         done_prerequisites = False
+        is_timed_out = False
+        is_skipping = False
+        input_env = None
+        self.start_document_timer()
 
         if not self.is_testing:
             self.ui.clear()
+
         for line, next_line in get_next(lines):
-            # print("Executing line of Type: " + line["type"])
+            # print("Executing line of Type: " + line.type)
+
+            if is_skipping and line.type != "end_test_file":
+                # The document timed out, or is unchanged since it
+                # passed, skip the rest of it
+                continue
 
-            if line["type"] == "start_test_file":
-                source_file_directory = os.path.dirname(line["file"])
+            if line.type == "start_test_file":
+                source_file_directory = os.path.dirname(line.file)
                 self.ui.get_shell().run_command("pushd " + source_file_directory)
                 done_prerequisites = False
-            elif line["type"] == "end_test_file":
+                self.start_document_timer()
+                entry_failed_tests = failed_tests
+                entry_results = len(self.all_results)
+                entry_key = None
+                if config.is_incremental:
+                    if input_env is None:
+                        input_env = Environment(self.script_dir, is_test = True)
+                    entry_key = incremental.get_key(self.load_document(line.file), self.script_dir, input_env.get)
+                    cached_results = incremental.get_results(line.file, entry_key)
+                    if cached_results is None:
+                        incremental.forget(line.file)
+                    else:
+                        self.ui.information("Skipping '" + line.file + "', it is unchanged since it passed.", True)
+                        for results in cached_results:
+                            self.all_results.append(dict(results, cached = True))
+                        passed_tests += len(cached_results)
+                        entry_key = None
+                        is_skipping = True
+            elif line.type == "end_test_file":
+                if entry_key is not None and failed_tests == entry_failed_tests:
+                    incremental.record_pass(line.file, entry_key, self.all_results[entry_results:])
                 source_file_directory = None
+                is_skipping = False
                 self.ui.get_shell().run_command("popd")
-            elif line["type"] == "result":
-                if not in_results:
-                    in_results = True
-                    expected_results = ""
-                expected_results += line["text"]
-                expected_similarity = line["expected_similarity"]
-            elif line["type"] != "result" and in_results:
-                # Finishing results section
-                if self.is_testing:
-                    results = self.is_pass(expected_results, self.strip_ansi(actual_results), expected_similarity)
+            elif line.type == "result":
+                # If the command was recorded as timed out there are no
+                # results to compare
+                if self.is_testing and not is_timed_out:
+                    results = self.is_pass(line.text, self.strip_ansi(actual_results), line.expected_similarity, line.options)
                     self.ui.test_results(results)
                     self.all_results.append(results)
                     if results["passed"]:
                         passed_tests += 1
                     else:
-                        # print("Failed test")
-                        # print(line)
                         failed_tests += 1
                         if self.is_fast_fail:
                             break
-                expected_results = ""
                 actual_results = ""
-                in_results = False
-            elif line["type"] == "prerequisite":
+            elif line.type == "prerequisite":
                 if not done_prerequisites:
-                    self.ui.heading(line["text"])
-                    self.check_prerequisites(lines, source_file_directory)
+                    self.ui.heading(line.text)
+                    self.check_prerequisites(self.document.prerequisites, source_file_directory)
                     done_prerequisites = True
                     if self.is_prep_only:
                         return failed_tests, passed_tests
@@ -571,125 +591,255 @@ logs throughout execution."""
                         # prereqs are now complete, so switch to simulated demo mode
                         self.is_simulation = True
                         self.is_automated = False
-            elif line["type"] == "executable":
+            elif line.type == "executable":
                 # print("Execting:")
-                # print(line["text"])
-                if line["text"].strip() == "":
+                # print(line.text)
+                if line.text.strip() == "":
                     break
                 if not self.is_learning:
                     self.ui.prompt()
                     self.ui.check_for_interactive_command()
-                self.current_command = line["text"]
-                actual_results = self.ui.simulate_command()
+                self.current_command = line.text
+                self.last_attempts = None
+                is_timed_out = False
+                self.set_command_timeout(line)
+                try:
+                    if "wait_until" in line.options and line.results is not None:
+                        actual_results = self.wait_until(line, line.results)
+                    else:
+                        actual_results = self.ui.simulate_command()
+                except shell.CommandTimeout as e:
+                    actual_results = ""
+                    is_timed_out = True
+                    is_skipping = self.is_document_timed_out()
+                    if self.is_testing:
+                        self.record_timeout(e, line.results)
+                        failed_tests += 1
+                        if self.is_fast_fail:
+                            break
+                    continue
                 self.current_description = ""
-                if not self.is_automated and not next_line["type"] == "executable":
+                if self.is_end_of_block(next_line):
+                    self.sync_env()
+                if not self.is_automated and not next_line.type == "executable":
                     self.ui.check_for_interactive_command()
-            elif line["type"] == "heading":
+            elif line.type == "heading":
                 if not is_first_line and not self.is_simulation:
                     self.ui.check_for_interactive_command()
                 if not self.is_simulation and not self.is_testing:
                     self.ui.clear()
-                    self.ui.heading(line["text"])
+                    self.ui.heading(line.text)
             else:
-                if not self.is_simulation and (line["type"] == "description" or line["type"] == "validation"):
+                if not self.is_simulation and (line.type == "description" or line.type == "validation"):
                     # print("Description:")
                     # print(line)
                     # Descriptive text
                     if not self.is_testing:
-                        self.ui.description(line["text"])
-                    self.current_description += line["text"]
-                if line["type"] == "next_step" and not self.is_simulation:
+                        self.ui.description(line.text)
+                    self.current_description += line.text
+                if line.type == "next_step" and not self.is_simulation:
                     pattern = re.compile('(.*)\[(.*)\]\(.*\).*')
-                    match = pattern.match(line["text"])
+                    match = pattern.match(line.text)
                     if match:
                         self.ui.next_step(match.groups()[0], match.groups()[1])
                     else:
-                        self.ui.description(line["text"])
+                        self.ui.description(line.text)
 
             is_first_line = False
 
         return failed_tests, passed_tests
     
-    def check_prerequisites(self, lines, source_file_directory = None):
+    def record_timeout(self, error, expected=None):
+        """Record a failed test for a command that timed out, see
+        `shell.CommandTimeout`. `expected` is the results block that
+        follows the command, if there is one."""
+        results = {
+            "passed": False,
+            "command": error.command,
+            "exit_code": None,
+            "results": self.strip_ansi(error.output),
+            "expected_results": expected.text if expected is not None else "",
+            "matcher": None,
+            "similarity": 0.0,
+            "required_similarity": expected.expected_similarity if expected is not None else None,
+            "timed_out": True,
+            "duration": error.duration
+        }
+        self.set_results_file(results)
+        if self.is_document_timed_out():
+            self.ui.warning("Document timed out, skipping its remaining commands.")
+        self.ui.test_results(results)
+        self.all_results.append(results)
+
+    def wait_until(self, line, expected):
+        """Run the command in `line` repeatedly until its output matches the
+        `expected` results block, or until the number of seconds given
+        by the `wait_until` option of the code block has passed. The
+        delay between attempts starts at `config.wait_initial_delay`
+        and doubles after each attempt, up to `config.wait_max_delay`,
+        with random jitter so that many waiting scripts don't poll in
+        step. Waiting also stops when the document times out, see
+        `config.document_timeout`.
+
+        The duration and similarity of each attempt is recorded in
+        `self.last_attempts`. Returns the output of the last attempt.
+        """
+        deadline = time.time() + float(line.options["wait_until"])
+        if self.document_deadline is not None:
+            deadline = min(deadline, self.document_deadline)
+        delay = config.wait_initial_delay
+        attempts = []
+        while True:
+            start_time = time.time()
+            if not attempts:
+                actual_results = self.ui.simulate_command()
+            else:
+                actual_results = self.ui.run_command(line.text)
+                self.last_exit_code = self.ui.exit_code
+            duration = time.time() - start_time
+
+            _, ratio = self.get_similarity(expected.text, self.strip_ansi(actual_results), expected.expected_similarity, expected.options)
+            attempts.append({"duration": duration, "similarity": ratio})
+            remaining = deadline - time.time()
+            if ratio >= expected.expected_similarity or remaining <= 0:
+                break
+
+            sleep = min(delay * random.uniform(0.5, 1), remaining)
+            self.ui.information("Waiting %.1f seconds before attempt %d (similarity %.2f, required %.2f)" % (sleep, len(attempts) + 1, ratio, expected.expected_similarity), True)
+            time.sleep(sleep)
+            delay = min(delay * 2, config.wait_max_delay)
+
+        self.ui.log("debug", "Wait took " + str(len(attempts)) + " attempts")
+        self.last_attempts = attempts
+        return actual_results
+
+    def is_end_of_block(self, next_line):
+        """True if `next_line` does not continue the current block of
+        commands."""
+        return next_line is None or next_line.type != "executable"
+
+    def check_prerequisites(self, prerequisites, source_file_directory = None):
         """Check that all prerequisites have been satisfied by iterating
-        through them and running the validation steps. If the
+        through the supplied prerequisite lines and running the validation steps. If the
         validatin tests pass then move on, if they do not then execute
         the prerequisite script. If running in test mode assume that
         this is the case (pre-requisites should be handled in the
         test_plan).
 
+        The prerequisites of prerequisites are found first, and the
+        validation steps of all of them are run concurrently, see
+        `prerequisite_graph.py`.
+
         When running in test mode the script_dir may be different from 
         the location of the prerequisite script file. In these cases the 
         'source_file_directory' should container the directory in which
         the prequisite script is located.
         """
+        import prerequisite_graph
+        import remote
         if source_file_directory is None:
             source_file_directory = self.script_dir
-        steps = []
-        for line in lines:
-            step = {}
-            if line["type"] == "prerequisite" and len(line["text"].strip()) > 0:
-                if source_file_directory and line["source_file_path"].startswith(source_file_directory):
-                    self.ui.log("debug", "Looking for prereq file in line: " + line["text"])
-                    self.ui.description(line["text"])
-                    pattern = re.compile('.*\[(.*)\]\((.*)\).*')
-                    match = pattern.match(line["text"])
-                    if match:
-                        step["title"] = match.groups()[0].strip()
-                        href = match.groups()[1]
-                        if not href.endswith(".md"):
-                            if not href.endswith("/"):
-                                href = href + "/"
-                            href = href + "README.md"
-                        step["href"] = href
-                        steps.append(step)
-                        self.ui.log("debug", "Found prereq: " + str(step))
-
-        for step in steps:
-            path, filename = os.path.split(step["href"])
-            self.ui.log("debug", "Source file directory is " + source_file_directory)
-            if (step["href"].startswith(".")):
-                if source_file_directory is not None:
-                    new_dir = os.path.join(self.script_dir, source_file_directory, path)
-                else:
-                    new_dir = os.path.join(self.script_dir, path)
-            else:
-                new_dir = path
+        graph = prerequisite_graph.resolve(self, prerequisites, source_file_directory)
+        prerequisite_graph.validate(graph)
 
-            new_dir = os.path.abspath(new_dir)
-            full_path = os.path.join(new_dir, filename)
-            if full_path in self.completed_validation_steps:
-                self.ui.log("debug", "Already validated / executed script in  " + full_path)
-                continue
-            
+        for prerequisite in graph:
             self.ui.new_para()
 
-            self.ui.log("debug", "Execute prerequisite step in " + filename + " in " + new_dir)
-            demo = Demo(self.is_docker, new_dir, filename, self.is_simulation, self.is_automated, self.is_testing, self.is_fast_fail, self.is_learning, self.script_dir, is_prerequisite = True, output_format=self.output_format)
+            self.ui.log("debug", "Execute prerequisite step in " + prerequisite.path)
+            is_valid = prerequisite.is_valid
+            if any(dependency.is_run for dependency in prerequisite.dependencies):
+                # Running a dependency may change the outcome of
+                # validation, either way. A validation may only have
+                # failed because the dependency had not yet run.
+                is_valid = None
+            demo = prerequisite.demo
             demo.mode = self.mode
             demo.set_ui(self.ui)
-            demo.run_if_validation_fails(self.mode)
-            self.ui.get_shell().run_command("popd ") # set_ui runs pushd
+            prerequisite.is_run = demo.run_if_validation_fails(self.mode, is_valid)
+            if not remote.is_remote(demo.script_dir):
+                self.ui.get_shell().run_command("popd ") # set_ui runs pushd
             self.ui.set_demo(self) # demo.set_ui(...) assigns new demo to ui, this reverts after prereq execution
 
-            self.completed_validation_steps.append(full_path)
+            self.completed_validation_steps.append(prerequisite.path)
             self.ui.check_for_interactive_command()
-            
-    def run_if_validation_fails(self, mode = None):
-        self.ui.information("Validating pre-requisite of '" + self.parent_script_dir + "' in '" + os.path.abspath(os.path.join(self.script_dir, self.filename)) + "'")
+
+    def get_prerequisite_paths(self, prerequisites, source_file_directory):
+        """Return the full paths of the documents linked to from the
+        supplied prerequisite lines."""
+        import prerequisite_graph
+        self.ui.log("debug", "Source file directory is " + source_file_directory)
+        paths = []
+        for line in prerequisite_graph.get_lines(prerequisites, source_file_directory):
+            self.ui.log("debug", "Looking for prereq file in line: " + line.text)
+            self.ui.description(line.text)
+            path = prerequisite_graph.get_path(line, self.script_dir, source_file_directory)
+            if path is not None:
+                self.ui.log("debug", "Found prereq: " + line.title + " (" + path + ")")
+                paths.append(path)
+        return paths
+
+    def new_prerequisite(self, path):
+        """Return a Demo for the prerequisite document at `path`. It shares
+        our UI and record of completed prerequisites."""
+        new_dir, filename = os.path.split(path)
+        demo = Demo(self.is_docker, new_dir, filename, self.is_simulation, self.is_automated, self.is_testing, self.is_fast_fail, self.is_learning, self.script_dir, is_prerequisite = True, output_format=self.output_format)
+        demo.ui = self.ui
+        demo.completed_validation_steps = self.completed_validation_steps
+        return demo
+
+    def get_path(self):
+        """Return the full path, or URL, of the document this demo
+        represents."""
+        import remote
+        path = os.path.join(self.script_dir, self.filename)
+        if remote.is_remote(path):
+            return path
+        return os.path.abspath(path)
+
+    def run_if_validation_fails(self, mode = None, is_valid = None):
+        """Validate this prerequisite and run it if validation fails.
+        `is_valid` is the outcome of validating it already, if it has
+        been, see `prerequisite_graph.validate`. Return True if the
+        prerequisite was run."""
+        self.ui.information("Validating pre-requisite of '" + self.parent_script_dir + "' in '" + self.get_path() + "'")
         self.ui.new_para()
-        lines = self.classify_lines()
-        self.check_prerequisites(lines, self.script_dir)
-        if self.validate(lines):
+        doc = self.get_document()
+        key = self.get_validation_key(doc)
+        age = validation.get_age(key) if key is not None and is_valid is None else None
+        if age is not None:
+            self.ui.information("Validation passed " + str(int(age)) + " seconds ago, skipping validation.", True)
+            return False
+        if is_valid is None:
+            is_valid = self.validate(doc.nodes)
+        if is_valid:
+            if key is not None:
+                validation.record_pass(key)
             self.ui.information("Validation passed.", True)
+            return False
         else:
-            self.ui.information("Validation failed of pre-requisite execution did not pass. Running prerequisite steps in '" + os.path.abspath(os.path.join(self.script_dir, self.filename)) + "'", True)
+            self.ui.information("Validation failed of pre-requisite execution did not pass. Running prerequisite steps in '" + self.get_path() + "'", True)
             self.ui.new_para()
             self.ui.check_for_interactive_command()
             self.run(mode)
             if not self.is_testing:
                 self.ui.clear()
-            
+            return True
+
+    def get_validation_key(self, doc):
+        """Return the key under which the outcome of validating `doc` is
+        cached, see `validation.py`, or None if it is not cached. Tests
+        always validate, since the cache can't tell whether the state a
+        validation checked still exists."""
+        if self.is_testing or not validation.is_enabled():
+            return None
+        commands = [command.text for command in validation.get_commands(doc)]
+        if not commands:
+            return None
+        # Bring the environment up to date with the shell if the commands
+        # use variables it does not have
+        self.get_command_vars(commands)
+        return validation.get_key(doc, self.env.get)
+
     def validate(self, lines):
         """Run through the supplied lines, executing and testing any that are
 found in the validation section.
@@ -699,79 +849,115 @@ found in the validation section.
         result = True
         in_validation = False
         has_validation_steps = False
-        in_results = False
-        expected_results = ""
+        actual_results = ""
         for line in lines:
-            if line["type"] == "validation":
+            if line.type == "validation":
                 in_validation = True
                 has_validation_steps = True
-            elif line["type"] == "heading":
+            elif line.type == "heading":
                 in_validation = False
-            elif in_validation and line["type"] == "executable":
-                self.current_command = line["text"]
+            elif in_validation and line.type == "executable":
+                self.current_command = line.text
                 self.ui.log("debug", "Execute validation command: " + self.current_command)
-                actual_results = self.ui.simulate_command(not config.is_debug)
-                expected_results = ""
-            elif in_validation and line["type"] == "result":
-                if not in_results:
-                    in_results = True
-                    expected_results = ""
-                expected_results += line["text"]
-                expected_similarity = line["expected_similarity"]
-            elif (line["type"] != "result" and in_results):
-                # Finishing results section
-                test_results = self.is_pass(expected_results, self.strip_ansi(actual_results), expected_similarity)
+                self.set_command_timeout(line)
+                try:
+                    actual_results = self.ui.simulate_command(not config.is_debug)
+                except shell.CommandTimeout:
+                    actual_results = ""
+                    result = False
+            elif in_validation and line.type == "result":
+                test_results = self.is_pass(line.text, self.strip_ansi(actual_results), line.expected_similarity, line.options)
                 if not test_results["passed"]:
-                    self.ui.log("debug", "validation expected results: '" + expected_results + "'")
-                    self.ui.log("debug", "validation actual results: '" + actual_results + "'")
+                    self.ui.log("debug", "validation expected results: '" + line.text + "'")
+                    self.ui.log("debug", "validation actual results: '" + str(actual_results) + "'")
                     result = False
-                expected_results = ""
                 actual_results = ""
-                in_results = False
 
         return result and has_validation_steps
 
     def strip_ansi(self, text):
-        """ Strip ANSI codes from a string."""
+        """ Strip ANSI codes from a string. Spilled output has had them
+        removed already, see `capture.py`."""
+        if isinstance(text, SpilledOutput):
+            return text
         ansi_escape = re.compile(r'\x1b[^m]*m')
         return ansi_escape.sub('', text)
     
-    def is_pass(self, expected_results, actual_results, expected_similarity = 0.66):
+    def is_pass(self, expected_results, actual_results, expected_similarity = 0.66, options = None):
         """Checks to see if a command execution passes.
         If actual results compared to expected results is within
         the expected similarity level then it's considered a pass.
+        `options` are the options of the results block, the `match`
+        option selects how results are compared.
 
         Returns a dictionary containing the results:
         {
           "passed": boolean,
           "command": "the command executed",
+          "exit_code": int, or None if the executor does not provide exit codes,
           "results": "Results returned",
           "expected_results": "Expected results",
+          "matcher": "the matcher used, see `similarity.MATCHERS`",
           "similarity": float,
-          "required_similarity": float
+          "required_similarity": float,
+          "attempts": [{"duration": float, "similarity": float}], only for commands that wait for a result,
+          "diff": "unified diff of expected and actual results, failures only",
+          "results_file": "path of the file holding the full results, failures with large outputs only"
         }
 
+        Commands that time out are recorded by `record_timeout` with
+        "timed_out" set to True and "duration" set to the number of
+        seconds the command ran for.
+
+        See `similarity.score` for how the similarity of text is
+        calculated, for a failing test it may be an upper bound.
+
         """
-        differ = difflib.Differ()
-        comparison = differ.compare(actual_results, expected_results)
-        diff = differ.compare(actual_results, expected_results)
-        seq = difflib.SequenceMatcher(lambda x: x in " \t\n\r", actual_results, expected_results)
+        import similarity
+        matcher, ratio = self.get_similarity(expected_results, actual_results, expected_similarity, options)
+        is_pass = ratio >= expected_similarity
 
-        is_pass = seq.ratio() >= expected_similarity
-        
-        self.ui.log("debug", "Similarity is: " + str(seq.ratio()))
+        self.ui.log("debug", "Similarity is: " + str(ratio))
 
         message = {
             "passed": is_pass,
             "command": self.last_command,
+            "exit_code": self.last_exit_code,
             "results": actual_results,
             "expected_results": expected_results,
-            "similarity": seq.ratio(),
+            "matcher": matcher,
+            "similarity": ratio,
             "required_similarity": expected_similarity
         }
+        if self.last_attempts is not None:
+            message["attempts"] = self.last_attempts
+        if not is_pass:
+            message["diff"] = similarity.diff(actual_results, expected_results)
+        self.set_results_file(message)
 
         return message
+
+    def set_results_file(self, message):
+        """If the results in the test result `message` were spilled to
+        disk, see `capture.py`, replace them with an excerpt. For a
+        failed test the file is kept and its path added to the message
+        as "results_file"."""
+        results = message["results"]
+        if isinstance(results, SpilledOutput):
+            message["results"] = results.excerpt()
+            if not message["passed"]:
+                results.keep()
+                message["results_file"] = results.path
                 
+    def get_similarity(self, expected_results, actual_results, expected_similarity, options = None):
+        """Return a tuple of the name of the matcher selected by the `match`
+        option and the similarity it gives the results."""
+        import similarity
+        if options is None:
+            options = {}
+        matcher = options.get("match", "text").lower()
+        return matcher, similarity.MATCHERS[matcher](actual_results, expected_results, expected_similarity, options)
+
     def __str__( self ):
         s = "Demo directory: " + self.script_dir + "\n"
         s += "Demo filename: " + self.filename + "\n"
@@ -788,10 +974,14 @@ found in the validation section.
         
         return s
 
-    def set_ui(self, ui):
+    def set_ui(self, ui, is_shell_needed = True):
+        """Set the UI of this demo and move the shell to the script
+        directory. If `is_shell_needed` is False no shell is started."""
+        import remote
         self.ui = ui
         ui.set_demo(self)
-        self.ui.get_shell().run_command("pushd " + self.script_dir)
+        if is_shell_needed and not remote.is_remote(self.script_dir):
+            self.ui.get_shell().run_command("pushd " + self.script_dir)
         self.ui.log("debug", str(self))
 
     def get_bash_script(self):
@@ -0,0 +1,365 @@
+# The document model for SimDem scripts.
+#
+# A markdown document is parsed, once, into a compact sequence of typed
+# nodes. Parsed documents are cached on disk so that unchanged
+# documents are never parsed twice.
+
+import os
+import re
+
+from cache import DiskCache, hash_bytes
+import config
+import similarity
+
+# Increment whenever the parser or the node classes change so that
+# documents cached by an older version are parsed again.
+PARSER_VERSION = 4
+
+DEFAULT_EXPECTED_SIMILARITY = 0.5
+
+class Node(object):
+    """A single item in a document. Each node class has a `type` that
+    the executor uses to decide how to handle it."""
+    __slots__ = ()
+    type = None
+
+    def __repr__(self):
+        names = [name for cls in reversed(type(self).__mro__) for name in getattr(cls, "__slots__", ())]
+        values = ", ".join(name + "=" + repr(getattr(self, name)) for name in names)
+        return self.type + "(" + values + ")"
+
+class TextNode(Node):
+    """A node holding a single line of text from the document."""
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        self.text = text
+
+class Heading(TextNode):
+    __slots__ = ()
+    type = "heading"
+
+class Description(TextNode):
+    __slots__ = ()
+    type = "description"
+
+class Validation(TextNode):
+    """Descriptive text in a validation section."""
+    __slots__ = ()
+    type = "validation"
+
+class NextStep(TextNode):
+    __slots__ = ()
+    type = "next_step"
+
+class Command(TextNode):
+    """A single line of an executable code block. `options` holds the
+    options given on the fence line that opened the block. `results`
+    is the results block that follows the command, if this is the last
+    command before one."""
+    __slots__ = ("options", "results")
+    type = "executable"
+
+    def __init__(self, text, options):
+        self.text = text
+        self.options = options
+        self.results = None
+
+class ResultBlock(TextNode):
+    """The expected results of the command that precedes it."""
+    __slots__ = ("expected_similarity", "options")
+    type = "result"
+
+    def __init__(self, text, expected_similarity, options):
+        self.text = text
+        self.expected_similarity = expected_similarity
+        self.options = options
+
+class Prerequisite(TextNode):
+    """A line in a prerequisites section. If the line links to another
+    document then `title` and `href` are the text and target of the
+    link, otherwise they are None."""
+    __slots__ = ("source_file_path", "title", "href")
+    type = "prerequisite"
+
+    def __init__(self, text, source_file_path):
+        self.text = text
+        self.source_file_path = source_file_path
+        self.title = None
+        self.href = None
+        match = re.match(r'.*\[(.*)\]\((.*)\).*', text)
+        if match:
+            self.title = match.groups()[0].strip()
+            self.href = match.groups()[1]
+
+class StartTestFile(Node):
+    """Marks the start of a test plan entry."""
+    __slots__ = ("file",)
+    type = "start_test_file"
+
+    def __init__(self, file):
+        self.file = file
+
+class EndTestFile(StartTestFile):
+    """Marks the end of a test plan entry."""
+    __slots__ = ()
+    type = "end_test_file"
+
+class EndOfFile(Node):
+    __slots__ = ()
+    type = "EOF"
+    text = ""
+
+class Section(object):
+    """A heading and the index range, in `Document.nodes`, of the nodes
+    that follow it. `kind` is one of "body", "prerequisites",
+    "validation" or "next_steps"."""
+    __slots__ = ("heading", "kind", "start", "end")
+
+    def __init__(self, heading, kind, start):
+        self.heading = heading
+        self.kind = kind
+        self.start = start
+        self.end = start
+
+class Document(object):
+    """A parsed SimDem document."""
+    __slots__ = ("path", "title", "nodes", "sections", "prerequisites", "next_steps", "warnings")
+
+    def __init__(self, path):
+        self.path = path
+        self.title = None
+        self.nodes = []
+        self.sections = []
+        self.prerequisites = []
+        self.next_steps = []
+        self.warnings = []
+
+def parse_fence(line):
+    """Parse a line that opens a code block, e.g. "```bash" or
+    "```expected_similarity=0.2". Returns a tuple of the language hint,
+    lower case and possibly empty, and a dictionary of options. Option
+    names are lower case."""
+    text = line.strip()[3:]
+    options = {}
+    for match in re.finditer(r'([A-Za-z_][\w-]*)\s*=\s*(\S+)', text):
+        options[match.group(1).lower()] = match.group(2)
+    language = re.sub(r'([A-Za-z_][\w-]*)\s*=\s*(\S+)', '', text).strip().lower()
+    return language, options
+
+class DocumentParser(object):
+    """A state machine that classifies the lines of a SimDem document.
+
+    The parser tracks two independent pieces of state. The block state
+    records whether we are in descriptive text ("text"), an executable
+    code block ("code") or any other code block ("other"). The section
+    state records the kind of section the current heading started. In
+    addition a "Results:" line marks the next code block as a results
+    block.
+    """
+
+    def __init__(self, path):
+        self.document = Document(path)
+        self.block = "text"
+        self.section = "body"
+        self.in_results = False
+        self.expected_similarity = DEFAULT_EXPECTED_SIMILARITY
+        self.options = {}
+        self.results = None
+        self.last_command = None
+        self.line_number = 0
+        self.handlers = {
+            "text": self.text_line,
+            "code": self.code_line,
+            "other": self.other_line
+        }
+
+    def parse(self, lines):
+        """Parse the supplied lines and return the Document."""
+        for line in lines:
+            self.line_number += 1
+            if line.lower().startswith("results:"):
+                self.in_results = True
+            else:
+                self.handlers[self.block](line)
+        self.end_results()
+        self.end_section()
+        document = self.document
+        document.nodes = tuple(document.nodes)
+        return document
+
+    def add(self, node):
+        self.document.nodes.append(node)
+
+    def text_line(self, line):
+        stripped = line.strip()
+        if stripped.lower().startswith("```"):
+            language, options = parse_fence(line)
+        if stripped.startswith("```") and language == "bash":
+            self.open_block("code", options)
+        elif line.startswith("```"):
+            if not self.in_results and stripped == "```":
+                self.document.warnings.append("Found a backtick line with no language hint near line " + str(self.line_number) + " of '" + self.document.path + "'\n. Treating as a non-executable code block, this can result in failed tests if this is intended to be executable. Add a 'bash' language hint to mark it as executable.")
+            self.open_block("other", options)
+        elif self.in_results and stripped.startswith("```"):
+            self.close_block()
+        elif not self.in_results and stripped.startswith("#"):
+            self.heading(line)
+        else:
+            self.text(line)
+
+    def code_line(self, line):
+        if line.strip().startswith("```"):
+            self.close_block()
+        elif self.in_results:
+            self.result(line)
+        elif not line.strip().startswith("#"):
+            self.last_command = Command(line, self.options)
+            self.add(self.last_command)
+
+    def other_line(self, line):
+        if line.strip().startswith("```") and parse_fence(line)[0] == "bash":
+            self.open_block("code", parse_fence(line)[1])
+        elif line.strip().startswith("```"):
+            self.close_block()
+        elif self.in_results:
+            self.result(line)
+        elif not self.in_results and line.strip().startswith("#"):
+            # Lines in non-executable blocks are treated as text
+            self.heading(line)
+        else:
+            self.text(line)
+
+    def open_block(self, block, options):
+        self.block = block
+        self.options = options
+        if block == "other":
+            if "match" in options and options["match"].lower() not in similarity.MATCHERS:
+                self.document.warnings.append("Unknown matcher '" + options["match"] + "' near line " + str(self.line_number) + " of '" + self.document.path + "'. Available matchers are: " + ", ".join(sorted(similarity.MATCHERS)) + ". Results will be compared as text.")
+                del options["match"]
+            if "expected_similarity" in options:
+                self.expected_similarity = float(options["expected_similarity"])
+            elif "match" in options:
+                # Structural matches are exact unless stated otherwise
+                self.expected_similarity = 1.0
+            else:
+                self.expected_similarity = DEFAULT_EXPECTED_SIMILARITY
+
+    def close_block(self):
+        self.end_results()
+        self.block = "text"
+        self.in_results = False
+        if self.section == "validation":
+            self.section = "body"
+
+    def result(self, line):
+        if self.results is None:
+            self.results = []
+        self.results.append(line)
+
+    def end_results(self):
+        if self.results is not None:
+            block = ResultBlock("".join(self.results), self.expected_similarity, self.options)
+            if self.options.get("match", "").lower() == "regex":
+                try:
+                    similarity.compile_regex(block.text.strip())
+                except re.error as e:
+                    self.document.warnings.append("Invalid regular expression near line " + str(self.line_number) + " of '" + self.document.path + "': " + str(e) + ". The results will not match.")
+            if self.last_command is not None:
+                self.last_command.results = block
+                self.last_command = None
+            self.add(block)
+            self.results = None
+
+    def heading(self, line):
+        if self.document.title is None:
+            self.document.title = line.strip().lstrip("#").strip()
+        heading = line.lower().strip()
+        if heading.endswith("# next steps"):
+            section = "next_steps"
+        elif heading.endswith("# prerequisites"):
+            section = "prerequisites"
+        elif heading.startswith("# validation"):
+            section = "validation"
+        else:
+            section = "body"
+        self.end_section()
+        self.section = section
+        self.document.sections.append(Section(line, section, len(self.document.nodes)))
+        self.add(Heading(line))
+
+    def end_section(self):
+        if self.document.sections:
+            self.document.sections[-1].end = len(self.document.nodes)
+
+    def text(self, line):
+        if self.section == "next_steps":
+            node = NextStep(line)
+            self.document.next_steps.append(node)
+        elif self.section == "prerequisites" and len(line.strip()) > 0:
+            node = Prerequisite(line, self.document.path)
+            self.document.prerequisites.append(node)
+        elif self.section == "validation":
+            node = Validation(line)
+        else:
+            node = Description(line)
+        self.add(node)
+
+def get_hash_text(node):
+    """Return the text identifying `node` in `get_hash`, including the
+    fence options and expected similarity that decide how it is run and
+    its results compared."""
+    text = node.type + ":" + getattr(node, "text", "")
+    options = getattr(node, "options", None)
+    if options:
+        text += "\1" + "\1".join(key + "=" + str(value) for key, value in sorted(options.items()))
+    if isinstance(node, ResultBlock):
+        text += "\1similarity=" + repr(node.expected_similarity)
+    return text
+
+def get_hash(doc):
+    """Return a hex digest identifying the content of `doc`."""
+    return hash_bytes("\0".join(get_hash_text(node) for node in doc.nodes).encode("utf-8"))
+
+def parse(path, lines):
+    """Parse the lines of the document found at `path`."""
+    return DocumentParser(path).parse(lines)
+
+_cache = None
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = DiskCache("documents", config.document_cache_size)
+    return _cache
+
+def load(path):
+    """Load and parse the document at the local file `path`, using the
+    on disk cache where possible. Cache entries are keyed by path and
+    validated first by modification time and size, which avoids reading
+    the file at all, and then by a hash of the content.
+    """
+    cache = get_cache()
+    stat = os.stat(path)
+    entry = cache.get(path)
+    if entry is not None and entry["version"] == PARSER_VERSION:
+        if entry["mtime"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+            return entry["document"]
+
+    with open(path, "rb") as f:
+        data = f.read()
+    content_hash = hash_bytes(data)
+
+    if entry is not None and entry["version"] == PARSER_VERSION and entry["hash"] == content_hash:
+        document = entry["document"]
+    else:
+        document = parse(path, data.decode("utf-8").splitlines(True))
+
+    cache.set(path, {
+        "version": PARSER_VERSION,
+        "mtime": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "hash": content_hash,
+        "document": document
+    })
+    return document
@@ -1,20 +1,117 @@
 # For managing the environment in which a SimDem demo executes.
-
+#
+# An environment is a stack of layers: the environment SimDem runs in,
+# then each env.json style file in order of precedence, then the
+# variables set by SimDem itself or read back from the shell. Only the
+# top layer belongs to an Environment, the others are shared by every
+# Environment that uses them and are never modified. Files are parsed
+# once and memoized by path and modification time.
+
+from collections import ChainMap
 import os
+import stat
 import sys
 import json
 
 import config
 
+# Parsed env.json style files, by path, see `load_layer`
+_layers = {}
+
+# Marks a variable that has been removed from the top layer of an
+# environment but may still be defined in a lower layer
+_REMOVED = object()
+
+def process_env(new_env):
+    """
+    Takes an environment definition and processes it for use.
+    For example, expand '~' to home directory.
+    """
+    for key in new_env:
+        val = new_env[key]
+        if val.startswith('~'):
+            new_env[key] = os.path.expanduser(val)
+    return new_env
+
+def load_layer(filename):
+    """Return the processed variables defined in the JSON file
+    `filename`, or None if there is no such file. The returned
+    dictionary is shared and must not be modified."""
+    try:
+        info = os.stat(filename)
+    except OSError:
+        return None
+    if not stat.S_ISREG(info.st_mode):
+        return None
+    signature = (info.st_mtime_ns, info.st_size)
+    cached = _layers.get(filename)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    with open(filename) as env_file:
+        layer = process_env(json.load(env_file))
+    _layers[filename] = (signature, layer)
+    return layer
+
+class Layers(ChainMap):
+    """A ChainMap in which variables can be removed even when they are
+    defined in a lower layer. Only the first layer is modified."""
+
+    def __getitem__(self, key):
+        for mapping in self.maps:
+            if key in mapping:
+                value = mapping[key]
+                if value is _REMOVED:
+                    break
+                return value
+        return self.__missing__(key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __contains__(self, key):
+        for mapping in self.maps:
+            if key in mapping:
+                return mapping[key] is not _REMOVED
+        return False
+
+    def __iter__(self):
+        keys = {}
+        for mapping in reversed(self.maps):
+            keys.update(dict.fromkeys(mapping))
+        return (key for key in keys if key in self)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if any(key in mapping for mapping in self.maps[1:]):
+            self.maps[0][key] = _REMOVED
+        else:
+            del self.maps[0][key]
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        if default:
+            return default[0]
+        raise KeyError(key)
+
 class Environment(object):
     def __init__(self, directory, copy_env=True, is_test=False):
-        """Initialize the environment"""
-        if copy_env:
-            self.env = os.environ.copy()
-        else:
-            self.env = {}
+        """Initialize the environment. If `copy_env` is True the
+        environment SimDem runs in is the lowest layer, it is not
+        copied."""
         self.is_test = is_test
-        self.read_simdem_environment(directory)
+        self.snapshot = {}
+        self.synced_at = None
+        layers = self.read_simdem_environment(directory)
+        if copy_env:
+            layers.append(os.environ)
+        self.env = Layers({}, *layers)
         self.set("SIMDEM_VERSION", config.SIMDEM_VERSION)
         self.set("SIMDEM_CWD", directory)
         self.set("SIMDEM_EXEC_DIR", os.getcwd())
@@ -22,8 +119,8 @@ class Environment(object):
         self.set("SIMDEM_TEMP_DIR", temp_dir)
 
     def read_simdem_environment(self, directory):
-        """Populates each shell environment with a set of environment vars
-        loaded via env.json and/or env.local.json files. Variables are
+        """Returns the layers of variables loaded via env.json and/or
+        env.local.json files, highest precedence first. Variables are
         loaded in order first from the parent of the current script
         directory, then the current scriptdir itself and finally from
         the directory in which the `simdem` command was executed (the
@@ -31,7 +128,7 @@ class Environment(object):
 
         Values are loaded in the following order, the last file to
         define a vlaue is the one that "wins".
-        
+
         - PARENT_OF_SCRIPT_DIR/env.json
         - SCRIPT_DIR/env.json
         - PARENT_OF_SCRIPT_DIR/env.local.json
@@ -52,86 +149,58 @@ class Environment(object):
         - CWD/env.json
 
         """
-        env = {}
-
         if not directory.endswith('/'):
             directory = directory + "/"
 
-        filename = directory + "../env.json"
-        if os.path.isfile(directory + "../env.json"):
-            with open(filename) as env_file:
-                app_env = self.process_env(json.load(env_file))
-                env.update(app_env)
-
-        filename = directory + "env.json"
-        if os.path.isfile(filename):
-            with open(filename) as env_file:
-                script_env = self.process_env(json.load(env_file))
-                env.update(script_env)
-
-        filename = directory + "../env.local.json"
-        if os.path.isfile(filename):
-            with open(filename) as env_file:
-                local_env = self.process_env(json.load(env_file))
-                env.update(local_env)
-
-        filename = directory + "env.local.json"
-        if os.path.isfile(filename):
-            with open(filename) as env_file:
-                local_env = self.process_env(json.load(env_file))
-                env.update(local_env)
-
-        filename = os.getcwd() + "env.json"
-        if os.path.isfile(filename):
-            with open(filename) as env_file:
-                local_env = self.process_env(json.load(env_file))
-                env.update(local_env)
-
-        filename = os.getcwd() + "env.local.json"
-        if os.path.isfile(filename):
-            with open(filename) as env_file:
-                local_env = self.process_env(json.load(env_file))
-                env.update(local_env)
-
+        filenames = [
+            directory + "../env.json",
+            directory + "env.json",
+            directory + "../env.local.json",
+            directory + "env.local.json",
+            os.getcwd() + "env.json",
+            os.getcwd() + "env.local.json"
+        ]
         if self.is_test:
-            filename = directory + "../env.test.json"
-            if os.path.isfile(filename):
-                with open(filename) as env_file:
-                    script_env = self.process_env(json.load(env_file))
-                    env.update(script_env)
-
-            filename = directory + "env.test.json"
-            if os.path.isfile(filename):
-                with open(filename) as env_file:
-                    script_env = self.process_env(json.load(env_file))
-                    env.update(script_env)
-
-            filename = os.getcwd() + "/env.test.json"
-            if os.path.isfile(filename):
-                with open(filename) as env_file:
-                    local_env = self.process_env(json.load(env_file))
-                    env.update(local_env)
-                
-        self.env.update(env)
-        
-    def process_env(self, new_env):
-        """
-        Takes an environment definition and processes it for use.
-        For example, expand '~' to home directory.
-        """
-        for key in new_env:
-            val = new_env[key]
-            if val.startswith('~'):
-                new_env[key] = os.path.expanduser(val)
-        return new_env
-        
+            filenames += [
+                directory + "../env.test.json",
+                directory + "env.test.json",
+                os.getcwd() + "/env.test.json"
+            ]
+
+        layers = []
+        for filename in reversed(filenames):
+            layer = load_layer(filename)
+            if layer is not None:
+                layers.append(layer)
+        return layers
+
     def set(self, var, value):
         """Sets a new variable to the environment"""
         self.env[var] = value
 
+    def is_synced(self, shell):
+        """True if no commands have been run in the shell since this
+        environment was last synchronized with it."""
+        return self.synced_at == (id(shell), shell.command_count)
+
+    def sync(self, shell):
+        """Update this environment with the variables set in the shell.
+        Only variables that have changed since the last snapshot of the
+        shell are updated. Variables that have been unset in the shell
+        are removed."""
+        snapshot = shell.get_variables()
+        for key, value in snapshot.items():
+            if self.snapshot.get(key) != value:
+                self.env[key] = value
+        for key in self.snapshot:
+            if key not in snapshot:
+                self.env.pop(key, None)
+        self.snapshot = snapshot
+        self.synced_at = (id(shell), shell.command_count)
+
     def get(self, key=None):
         """Returns a either a value for a supplied key or, if key is None, a
-           dictionary containing the current environment"""
+           mapping containing the current environment"""
         if key:
             if key not in self.env:
                 return "UNDEFINED"
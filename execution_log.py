@@ -0,0 +1,129 @@
+# The log of everything displayed during a SimDem run.
+#
+# The log is written in chunks, one per call to `write`, rather than by
+# concatenating strings. In memory the log is a ring buffer holding the
+# most recent output only, so memory use is bounded however long the
+# run. The full log can also be written to rotating files under
+# SIMDEM_TEMP_DIR/logs.
+
+import atexit
+from collections import deque
+import os
+
+import config
+
+# The number of chunks written before they are joined into a single
+# chunk. Joining keeps the overhead of storing many small strings, such
+# as the single characters typed when simulating a command, low.
+COMPACT_CHUNKS = 4096
+
+class ExecutionLog(object):
+    """An append only log of text. The most recent `max_size` characters
+    are kept in memory, all of the text if `max_size` is 0. Between
+    trims up to twice as much may be held.
+
+    If `path` is supplied all text is also written to that file. When the
+    file grows beyond `file_size` characters it is rotated, keeping
+    `backups` old files named `path.1`, `path.2` and so on.
+    """
+
+    def __init__(self, max_size=0, path=None, file_size=0, backups=0):
+        self.max_size = max_size
+        self.path = path
+        self.file_size = file_size
+        self.backups = backups
+        self._chunks = deque()
+        self._size = 0
+        self._text = ""
+        self._file = None
+        if path:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._open("a")
+            atexit.register(self.close)
+
+    def write(self, text):
+        """Append text to the log."""
+        if not text:
+            return
+        self._chunks.append(text)
+        self._size += len(text)
+        self._text = None
+        if len(self._chunks) >= COMPACT_CHUNKS:
+            self._compact()
+        if self.max_size and self._size > 2 * self.max_size:
+            # Trimming copies the oldest chunk, so allow the log to grow
+            # before trimming rather than trimming every write
+            self._trim()
+        if self._file:
+            self._write_file(text)
+
+    def getvalue(self):
+        """Return the text held in memory. The text is joined at most once
+        between writes."""
+        if self._text is None:
+            if self.max_size:
+                self._trim()
+            self._compact()
+        return self._text
+
+    def __len__(self):
+        return self._size
+
+    def __str__(self):
+        return self.getvalue()
+
+    def _compact(self):
+        self._text = "".join(self._chunks)
+        self._chunks = deque([self._text]) if self._text else deque()
+
+    def _trim(self):
+        while self._size > self.max_size:
+            excess = self._size - self.max_size
+            chunk = self._chunks[0]
+            if len(chunk) <= excess:
+                self._chunks.popleft()
+                self._size -= len(chunk)
+            else:
+                self._chunks[0] = chunk[excess:]
+                self._size -= excess
+
+    def _open(self, mode):
+        self._file = open(self.path, mode)
+        self._file_written = self._file.tell()
+
+    def _write_file(self, text):
+        self._file.write(text)
+        self._file_written += len(text)
+        if self.file_size and self._file_written >= self.file_size:
+            self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        for index in range(self.backups - 1, 0, -1):
+            source = self.path + "." + str(index)
+            if os.path.exists(source):
+                os.replace(source, self.path + "." + str(index + 1))
+        if self.backups > 0:
+            os.replace(self.path, self.path + ".1")
+        self._open("w")
+
+    def flush(self):
+        if self._file:
+            self._file.flush()
+
+    def close(self):
+        """Close the log file, if there is one."""
+        if self._file:
+            self._file.close()
+            self._file = None
+
+def get_log_path():
+    """Return the path of the execution log file for this process."""
+    return os.path.join(os.path.expanduser(config.SIMDEM_TEMP_DIR), "logs", "execution-" + str(os.getpid()) + ".log")
+
+def create():
+    """Create an execution log configured as set in `config.py`."""
+    path = None
+    if config.is_execution_log_file:
+        path = get_log_path()
+    return ExecutionLog(config.execution_log_memory, path, config.execution_log_file_size, config.execution_log_file_backups)
@@ -0,0 +1,76 @@
+# Incremental testing, see the `--incremental` option.
+#
+# When a test plan entry passes its results are recorded on disk along
+# with a hash of its inputs: the content of the document and of each of
+# its prerequisites, including the options of their code and results
+# blocks such as `expected_similarity` and `match`, and the values of
+# the variables their commands use, as set by env.json and
+# env.test.json files or the environment SimDem is run in. An
+# incremental test run skips the entries whose inputs have not changed
+# since they last passed, and reports the recorded results as cached
+# passes. Entries that failed, or were not run, last time are always
+# run.
+
+import os
+
+from cache import DiskCache, hash_bytes
+import document
+import prerequisite_graph
+import variables
+
+# Maximum size, in bytes, of the store of results
+MAX_CACHE_SIZE = 16 * 1024 * 1024
+
+_cache = None
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = DiskCache("results", MAX_CACHE_SIZE)
+    return _cache
+
+def get_key(doc, script_dir, lookup):
+    """Return a hash of the inputs of the test plan entry `doc`, see the
+    module documentation. `script_dir` is the directory of the test
+    plan and `lookup(name)` returns the value of a variable."""
+    parts = []
+    names = {}
+    seen = set()
+
+    def add(doc, script_dir):
+        parts.append(doc.path + "\0" + document.get_hash(doc))
+        for node in doc.nodes:
+            if node.type == "executable":
+                for name in variables.get_names(node.text):
+                    names[name] = True
+        for path in prerequisite_graph.get_paths(doc.prerequisites, script_dir, os.path.dirname(doc.path)):
+            if path in seen:
+                continue
+            seen.add(path)
+            if os.path.isfile(path):
+                add(document.load(path), os.path.dirname(path))
+            else:
+                parts.append(path + "\0missing")
+
+    add(doc, script_dir)
+    parts.extend(name + "=" + lookup(name) for name in sorted(names))
+    return hash_bytes("\n".join(parts).encode("utf-8"))
+
+def get_results(path, key):
+    """Return the results recorded when the test plan entry at `path`
+    last passed, or None if it did not pass or its inputs, identified
+    by `key`, have changed since."""
+    entry = get_cache().get(path)
+    if entry is None or entry["key"] != key:
+        return None
+    return entry["results"]
+
+def record_pass(path, key, results):
+    """Record the `results` of the test plan entry at `path`, which
+    passed with the inputs identified by `key`."""
+    get_cache().set(path, {"key": key, "results": results})
+
+def forget(path):
+    """Forget the results of the test plan entry at `path`, for example
+    because it is being run again."""
+    get_cache().delete(path)
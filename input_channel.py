@@ -0,0 +1,65 @@
+import queue
+import threading
+import time
+
+from cli import InputCancelled
+
+class InputChannel(object):
+    """Hands input from the Socket.IO handlers to the demo thread. The
+    demo thread blocks, without using any CPU, until input arrives,
+    the wait times out or the wait is cancelled.
+
+    Once cancelled every wait fails, including those that start after
+    the cancellation, until the channel is resumed by a browser
+    connecting again."""
+
+    CANCELLED = object()
+
+    def __init__(self, name):
+        self.name = name
+        self._queue = queue.Queue()
+        self._cancelled = threading.Event()
+        self.latency = None
+
+    def request(self):
+        """Discard any input that arrived before it was asked for. A
+        cancellation is kept."""
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                return
+
+    def put(self, value):
+        """Called by a Socket.IO handler when input arrives."""
+        self._queue.put((value, time.time()))
+
+    def cancel(self):
+        """Abandon the current wait, if any, and any later waits until
+        `resume` is called."""
+        self._cancelled.set()
+        self._queue.put((self.CANCELLED, time.time()))
+
+    def resume(self):
+        """Accept input again after a cancellation."""
+        self._cancelled.clear()
+
+    def get(self, timeout=None):
+        """Wait for input and return it. `latency` is set to the time
+        between the input arriving and the demo thread receiving it.
+        Raises InputCancelled if no input arrives in `timeout` seconds
+        (None waits forever) or the channel is cancelled."""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            if self._cancelled.is_set():
+                raise InputCancelled("Browser disconnected while waiting for " + self.name)
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            try:
+                value, received = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                raise InputCancelled("No " + self.name + " received in " + str(timeout) + " seconds")
+            if value is not self.CANCELLED:
+                # Otherwise the cancellation is checked again, it may
+                # have been resumed since
+                self.latency = time.time() - received
+                return value
@@ -6,49 +6,11 @@
 import optparse
 import os
 import sys
-import time
 
-from cli import Ui
-from web import WebUi
+from cli import Ui, InputCancelled
 import config
 from demo import Demo
-from environment import Environment
-
-def get_bash_script(script_dir, is_simulation = True, is_automated=False, is_testing=False):
-    """
-    Reads a README.md file in the indicated directoy and builds an
-    executable bash script from the commands contained within.
-    """
-    if not script_dir.endswith('/'):
-        script_dir = script_dir + "/"
-
-    script = ""
-    env = Environment(script_dir, False).get()
-    for key, value in env.items():
-        script += key + "='" + value + "'\n"
-
-    filename = env.get_script_file_name(script_dir)
-    in_code_block = False
-    in_results_section = False
-    lines = list(open(script_dir + filename))
-    for line in lines:
-        if line.startswith("Results:"):
-            # Entering results section
-            in_results_section = True
-        elif line.startswith("```") and not in_code_block:
-            # Entering a code block, if in_results_section = True then it's a results block
-            in_code_block = True
-        elif line.startswith("```") and in_code_block:
-            # Finishing code block
-            in_results_section = False
-            in_code_block = False
-        elif in_code_block and not in_results_section:
-            # Executable line
-            script += line
-        elif line.startswith("#") and not in_code_block and not in_results_section and not is_automated:
-            # Heading in descriptive text
-            script += "\n"
-    return script
+import shell
 
 def main():
     """SimDem CLI interpreter"""
@@ -70,6 +32,26 @@ def main():
                  help="If set to anything other than False the output of the command will be compared to the expected results in the sript. Any failures will be reported")
     p.add_option('--fastfail', default="True",
                  help="If set to anything other than True test execution has will stop on the first failure. This has no affect if running in any mode other than 'test'.")
+    p.add_option('--jobs', '-j', default="1",
+                 help="The number of test plan entries to execute concurrently when running in 'test' mode. Each entry is run in its own shell. The default is 1, which runs the test plan sequentially.")
+    p.add_option('--norc', default="False",
+                 help="Set to True to start shells without reading bash profile and rc files. This makes startup faster and isolates tests from the user's own shell configuration.")
+    p.add_option('--executor', '-e', default="pty",
+                 help="How commands are executed. 'pty' (the default) runs them in an interactive shell through a pseudo terminal. 'pipe' runs them in a shell connected through pipes, this is faster and records exit codes but commands do not have a terminal. 'pipe' is recommended for 'test' mode.")
+    p.add_option('--timeout', default=None,
+                 help="The number of seconds a command may run for before it is interrupted. In 'test' mode a command that times out is recorded as a failed test. The `timeout` option of a code block overrides this for the commands in that block. By default commands may run forever.")
+    p.add_option('--doctimeout', default=None,
+                 help="The number of seconds the commands in a document, or in each entry of a test plan, may run for before the rest of the document is skipped. By default documents may run forever.")
+    p.add_option('--record', default=None,
+                 help="Record the output, exit code and duration of every command in the named cassette file. Test plans are run sequentially while recording.")
+    p.add_option('--replay', default=None,
+                 help="Serve the results of commands from the named cassette file, see `--record`, rather than running them. No shell is started.")
+    p.add_option('--incremental', default="False",
+                 help="Set to True to skip the test plan entries that passed in the last run and whose documents, prerequisites and variables have not changed since. Skipped entries are reported as cached passes.")
+    p.add_option('--revalidate', default="False",
+                 help="Set to True to run the validation of every prerequisite, even those that passed validation in a recent run. Only applies when `validation_cache_ttl` in config.py is set, earlier validations can't detect that the state they checked has since changed.")
+    p.add_option('--offline', default="False",
+                 help="Set to True to serve documents fetched over HTTP, and their prerequisites, only from the cache of earlier fetches, without any network requests.")
     p.add_option('--debug', '-d', default="False",
                  help="Turn on debug logging by setting to True.")
     p.add_option('--webui', '-w', default="False",
@@ -105,9 +87,55 @@ def main():
         print("Unknown style (--style, -s): " + options.style)
         exit(1)
 
+    try:
+        jobs = int(options.jobs)
+    except ValueError:
+        print("Invalid number of jobs (--jobs, -j): " + options.jobs)
+        exit(1)
+
+    try:
+        if options.timeout is not None:
+            config.command_timeout = float(options.timeout)
+        if options.doctimeout is not None:
+            config.document_timeout = float(options.doctimeout)
+    except ValueError:
+        print("Invalid number of seconds (--timeout, --doctimeout): " + str(options.timeout) + ", " + str(options.doctimeout))
+        exit(1)
+
     if options.debug.lower() == "true":
         config.is_debug = True
 
+    if options.norc.lower() == "true":
+        config.is_minimal_shell = True
+
+    if options.revalidate.lower() == "true":
+        config.is_revalidate = True
+
+    if options.incremental.lower() == "true":
+        config.is_incremental = True
+
+    if options.offline.lower() == "true":
+        config.is_offline = True
+
+    if options.executor not in shell.EXECUTORS:
+        print("Unknown executor (--executor, -e): " + options.executor)
+        exit(1)
+    config.executor = options.executor
+
+    if options.record and options.replay:
+        print("Only one of --record and --replay can be used")
+        exit(1)
+    elif options.record:
+        config.cassette_mode = "record"
+        config.cassette_path = options.record
+        jobs = 1
+    elif options.replay:
+        if not os.path.isfile(options.replay):
+            print("Cassette not found (--replay): " + options.replay)
+            exit(1)
+        config.cassette_mode = "replay"
+        config.cassette_path = options.replay
+
     if len(arguments) == 2:
         script_dir = options.path + arguments[1]
     else:
@@ -123,23 +151,35 @@ def main():
             is_test = True
             is_auto = True
 
+    # Script mode only prints text, it does not need a shell
+    is_shell_needed = cmd != "script" or options.webui != "False"
+
+    # Start shells in the background while the demo is prepared
+    if config.cassette_mode != "replay" and is_shell_needed:
+        shell.get_pool().start()
+
     filename = "README.md"
     is_docker = os.path.isfile('/.dockerenv')
-    demo = Demo(is_docker, script_dir, filename, simulate, is_automatic, is_test, is_fast_fail, output_format=options.output);
+    demo = Demo(is_docker, script_dir, filename, simulate, is_automatic, is_test, is_fast_fail, output_format=options.output, jobs=jobs);
 
     if options.webui == "False":
         ui = Ui()
     else:
+        # The web UI needs Flask, which is slow to import, so it is only
+        # imported when it is used
+        from web import WebUi
         ui = WebUi(config.port)
         print("Server started. Listening on port " + str(ui.port))
         print("Point your browser at " + str(ui.port))
         print()
-        while not ui.ready:
-            time.sleep(0.25)
+        while not ui.wait_for_client(5):
             print("Waiting for client connection")
         cmd = None
 
-    demo.set_ui(ui)
-    demo.run(cmd)
+    demo.set_ui(ui, is_shell_needed)
+    try:
+        demo.run(cmd)
+    except InputCancelled as e:
+        sys.exit(str(e))
     
 main()
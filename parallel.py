@@ -0,0 +1,144 @@
+# Concurrent execution of SimDem test plans.
+#
+# Each entry in a test plan is run in its own worker process, with its
+# own bash session and Environment. Results are merged back into the
+# root demo in plan order.
+
+import io
+import multiprocessing
+from multiprocessing.connection import wait
+import os
+import signal
+import sys
+
+from cli import Ui
+from demo import Demo
+from environment import Environment
+import shell
+
+def terminate(signum, frame):
+    """SIGTERM handler of a worker process, cancelled after a failure
+    elsewhere when failing fast. The worker's shells run in sessions of
+    their own, they and the commands running in them are killed before
+    the worker exits."""
+    shell.kill_all()
+    os._exit(128 + signum)
+
+def run_entry(root, entry, conn):
+    """Worker process body. Executes a single test plan entry and sends a
+    report of the outcome back through `conn`. All output generated
+    by the worker is captured so that it can be replayed in plan
+    order by the parent.
+
+    """
+    signal.signal(signal.SIGTERM, terminate)
+    shell.discard_inherited_pool()
+    sys.stdout = io.StringIO()
+    report = {
+        "failed": 0,
+        "passed": 0,
+        "all_results": [],
+        "error": None
+    }
+    try:
+        demo = Demo(root.is_docker, root.script_dir, root.filename, root.is_simulation, root.is_automated, True, root.is_fast_fail, root.is_learning, output_format=root.output_format)
+        demo.mode = root.mode
+        demo.test_plan = [entry]
+        demo.set_ui(Ui())
+        demo.env = Environment(demo.script_dir, is_test = True)
+        lines = demo.classify_lines()
+        report["failed"], report["passed"] = demo.execute(lines)
+        report["all_results"] = demo.all_results
+    except SystemExit as e:
+        report["error"] = str(e.code)
+        report["failed"] += 1
+    except Exception as e:
+        report["error"] = repr(e)
+        report["failed"] += 1
+    report["log"] = sys.stdout.getvalue()
+    conn.send(report)
+    conn.close()
+
+def execute_test_plan(demo, test_plan, jobs):
+    """Execute each entry in `test_plan` in a separate worker process,
+    running at most `jobs` workers at a time. Worker output and
+    results are merged into `demo` in plan order. If `demo.is_fast_fail`
+    is set then the first failure cancels any workers that are still
+    running and no further entries are started.
+
+    Return the number of failed tests and the number of passed tests.
+    """
+    context = multiprocessing.get_context("fork")
+    # Workers are forked, no thread of the shell pool may be running
+    # while they are, see `ShellPool.stop`
+    shell.get_pool().stop()
+    pending = list(enumerate(test_plan))
+    running = {}
+    reports = {}
+    next_report = 0
+    is_cancelled = False
+
+    demo.ui.log("info", "Executing " + str(len(test_plan)) + " test plan entries with " + str(jobs) + " workers")
+
+    while pending or running:
+        while pending and len(running) < jobs and not is_cancelled:
+            index, entry = pending.pop(0)
+            parent_conn, child_conn = context.Pipe(False)
+            process = context.Process(target=run_entry, args=(demo, entry, child_conn))
+            process.start()
+            child_conn.close()
+            running[parent_conn] = (index, entry, process)
+            demo.ui.log("debug", "Started worker " + str(process.pid) + " for " + entry)
+
+        if not running:
+            break
+
+        for conn in wait(list(running)):
+            index, entry, process = running.pop(conn)
+            try:
+                report = conn.recv()
+            except EOFError:
+                report = {"failed": 1, "passed": 0, "all_results": [], "log": "", "error": "Worker for '" + entry + "' exited without a report"}
+            conn.close()
+            process.join()
+            reports[index] = report
+
+            if report["failed"] > 0 and demo.is_fast_fail and not is_cancelled:
+                is_cancelled = True
+                for _, cancelled_entry, cancelled_process in running.values():
+                    demo.ui.log("debug", "Cancelling worker for " + cancelled_entry)
+                    cancelled_process.terminate()
+
+        if is_cancelled:
+            for conn, (index, entry, process) in list(running.items()):
+                process.join()
+                conn.close()
+                del running[conn]
+
+        # Replay the output of contiguous completed entries in plan order
+        while next_report in reports:
+            report_entry(demo, test_plan[next_report], reports[next_report])
+            next_report += 1
+
+    failed_tests = 0
+    passed_tests = 0
+    for index, entry in enumerate(test_plan):
+        if index not in reports:
+            demo.ui.warning("Cancelled: " + entry)
+            continue
+        report = reports[index]
+        if index >= next_report:
+            report_entry(demo, entry, report)
+        failed_tests += report["failed"]
+        passed_tests += report["passed"]
+        demo.all_results.extend(report["all_results"])
+
+    return failed_tests, passed_tests
+
+def report_entry(demo, entry, report):
+    """Output the captured log, and any error, of a completed test plan
+    entry."""
+    if demo.output_format == "log":
+        print(report["log"], end="", flush=True)
+    if report["error"]:
+        demo.ui.warning("Error executing '" + entry + "': " + report["error"])
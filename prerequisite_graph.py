@@ -0,0 +1,197 @@
+# Resolution and validation of the prerequisites of a document.
+#
+# Before any prerequisite is run the full graph of prerequisites is
+# loaded, by following the "# Prerequisites" section of each document
+# in turn. A prerequisite shared by several documents appears in the
+# graph once, and circular prerequisites are reported as an error.
+# The remote prerequisites of each document are fetched concurrently.
+#
+# The validation steps of the prerequisites are then run concurrently,
+# each prerequisite in a shell of its own, since they are expected to
+# only inspect the state of the system. The prerequisites that fail
+# validation are run one at a time in the shell of the document, with
+# every prerequisite run after those it depends on. A prerequisite is
+# validated again if one of the prerequisites it depends on has been
+# run, since that may change the outcome, whether validation passed or
+# failed.
+
+import os
+
+import config
+import remote
+import shell
+import validation
+
+class Prerequisite(object):
+    """A node in the prerequisite graph. `demo` is the Demo that runs
+    the prerequisite document, `document` and `dependencies` the
+    Prerequisites it depends on.
+
+    `is_valid` is the outcome of the concurrent validation, None if the
+    prerequisite has not been validated, and `is_run` is True once the
+    prerequisite has been run."""
+
+    def __init__(self, path, demo, document):
+        self.path = path
+        self.demo = demo
+        self.document = document
+        self.dependencies = []
+        self.is_valid = None
+        self.is_run = False
+
+def get_lines(prerequisites, source_file_directory):
+    """Return the prerequisite lines, other than blank lines, that are
+    in a document in `source_file_directory`."""
+    return [line for line in prerequisites
+            if len(line.text.strip()) > 0 and source_file_directory and line.source_file_path.startswith(source_file_directory)]
+
+def get_path(line, script_dir, source_file_directory):
+    """Return the full path of the document linked to from the
+    prerequisite `line`, or None if it has no link. Links to a
+    directory are to the README.md file in it. Links in, or to, a
+    remote document are resolved as URLs."""
+    if line.href is None:
+        return None
+    href = line.href
+    if not href.endswith(".md"):
+        if not href.endswith("/"):
+            href = href + "/"
+        href = href + "README.md"
+    if remote.is_remote(href) or remote.is_remote(line.source_file_path):
+        return remote.join(line.source_file_path, href)
+    path, filename = os.path.split(href)
+    if href.startswith("."):
+        path = os.path.join(script_dir, source_file_directory, path)
+    return os.path.join(os.path.abspath(path), filename)
+
+def get_paths(prerequisites, script_dir, source_file_directory):
+    """Return the full paths of the documents linked to from the
+    `prerequisites` lines, as `Demo.get_prerequisite_paths` does but
+    without displaying the lines."""
+    paths = []
+    for line in get_lines(prerequisites, source_file_directory):
+        path = get_path(line, script_dir, source_file_directory)
+        if path is not None:
+            paths.append(path)
+    return paths
+
+def resolve(demo, prerequisites, source_file_directory):
+    """Return the prerequisites of `demo` found by following the
+    `prerequisites` lines and the prerequisites of each prerequisite in
+    turn, as a list in which every prerequisite follows those it
+    depends on. Prerequisites already in
+    `demo.completed_validation_steps` are left out.
+
+    Like a missing prerequisite, a prerequisite that depends on itself
+    ends SimDem with an error."""
+    nodes = {}
+    order = []
+
+    def visit(parent, path, stack):
+        if path in demo.completed_validation_steps:
+            return None
+        if path in stack:
+            exit("Circular prerequisites: " + " -> ".join(stack[stack.index(path):] + [path]))
+        if path in nodes:
+            return nodes[path]
+
+        child = parent.new_prerequisite(path)
+        node = Prerequisite(path, child, child.get_document())
+        stack.append(path)
+        dependency_paths = child.get_prerequisite_paths(node.document.prerequisites, child.script_dir)
+        remote.prefetch(dependency_paths)
+        for dependency_path in dependency_paths:
+            dependency = visit(child, dependency_path, stack)
+            if dependency is not None and dependency not in node.dependencies:
+                node.dependencies.append(dependency)
+        stack.pop()
+
+        nodes[path] = node
+        order.append(node)
+        return node
+
+    paths = demo.get_prerequisite_paths(prerequisites, source_file_directory)
+    remote.prefetch(paths)
+    for path in paths:
+        visit(demo, path, [])
+    return order
+
+def has_validation(doc):
+    return any(node.type == "validation" for node in doc.nodes)
+
+def run_commands(commands, env, directory):
+    """Run `commands` in a shell of their own, with environment `env`
+    and working directory `directory`. Return the output of each
+    command, None for a command that timed out, after which no more
+    commands are run."""
+    pool = shell.get_pool()
+    validation_shell, _ = pool.checkout(env, directory)
+    outputs = []
+    try:
+        for command in commands:
+            timeout = float(command.options["timeout"]) if "timeout" in command.options else config.command_timeout
+            try:
+                outputs.append(validation_shell.run_command(command.text, timeout))
+            except shell.CommandTimeout:
+                outputs.append(None)
+                break
+    except Exception:
+        validation_shell.close()
+        raise
+    if validation_shell.is_alive:
+        pool.release(validation_shell)
+    return outputs
+
+def is_passed(demo, commands, outputs):
+    """True if the `outputs` of the validation `commands` of `demo` match
+    their results, see `Demo.validate`."""
+    for command, output in zip(commands, outputs):
+        if output is None:
+            return False
+        if command.results is not None:
+            results = demo.is_pass(command.results.text, demo.strip_ansi(output), command.results.expected_similarity, command.results.options)
+            if not results["passed"]:
+                return False
+    return len(outputs) == len(commands)
+
+def validate(nodes, jobs=None):
+    """Run the validation steps of `nodes` concurrently, at most `jobs`
+    prerequisites at a time, and set `is_valid` on each node.
+
+    Nodes are left unvalidated when a prerequisite passed validation in
+    a recent run, see `validation.py`, or validation fails for reasons
+    other than the results of its commands, such as a failure to start
+    a shell. They are also left unvalidated when commands are recorded
+    or replayed, see `cassette.py`, since the cassette records the
+    commands of each document in order."""
+    if jobs is None:
+        jobs = config.prerequisite_jobs
+    if jobs < 2 or config.cassette_mode is not None:
+        return
+
+    pending = []
+    for node in nodes:
+        if not has_validation(node.document):
+            node.is_valid = False
+            continue
+        key = node.demo.get_validation_key(node.document)
+        if key is not None and validation.get_age(key) is not None:
+            continue
+        node.demo.sync_env()
+        pending.append(node)
+
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        futures = []
+        for node in pending:
+            commands = validation.get_commands(node.document)
+            future = executor.submit(run_commands, commands, node.demo.env.get(), node.demo.script_dir)
+            futures.append((node, commands, future))
+
+        for node, commands, future in futures:
+            try:
+                outputs = future.result()
+            except Exception as e:
+                node.demo.ui.log("debug", "Unable to validate " + node.path + ": " + repr(e))
+                continue
+            node.is_valid = is_passed(node.demo, commands, outputs)
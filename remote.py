@@ -0,0 +1,129 @@
+# Fetching of documents served over HTTP, such as a script run with
+# `--path https://...` and its prerequisites.
+#
+# Fetched documents are kept in an on disk cache. For
+# `config.remote_cache_ttl` seconds after a document was fetched it is
+# served from the cache without a request, after that it is revalidated
+# with a conditional request, using the ETag and Last-Modified headers
+# of the last response, so an unchanged document is not downloaded
+# again. If the server can't be reached a cached copy is served however
+# old it is. With `config.is_offline` set documents are only ever served
+# from the cache. A document is fetched at most once by each SimDem
+# process.
+
+import time
+
+from cache import DiskCache
+import config
+
+_cache = None
+
+# The content of the documents fetched by this process, by URL
+_documents = {}
+
+class FetchError(Exception):
+    """Raised when a document can't be fetched, or found in the cache
+    when offline."""
+    pass
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = DiskCache("remote", config.remote_cache_size)
+    return _cache
+
+def is_remote(path):
+    """True if `path` is the URL of a remote document."""
+    return path.startswith("http://") or path.startswith("https://")
+
+def join(url, href):
+    """Return the URL of `href`, a link in the document at `url`."""
+    import urllib.parse
+    return urllib.parse.urljoin(url, href)
+
+def request(url, entry):
+    """Request the document at `url`, conditionally if there is a cached
+    `entry` for it. Return the new entry, which is `entry` with a new
+    fetch time if the document has not changed. Requests that fail
+    because the server can't be reached, or has an error, are retried
+    up to `config.remote_retries` times."""
+    # urllib.request is slow to import and only needed for remote
+    # documents
+    import urllib.error
+    import urllib.request
+    headers = {}
+    if entry is not None:
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+    attempt = 0
+    while True:
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=config.remote_timeout) as response:
+                return {
+                    "fetched_at": time.time(),
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "data": response.read()
+                }
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and entry is not None:
+                return dict(entry, fetched_at=time.time())
+            if e.code < 500 or attempt >= config.remote_retries:
+                raise
+        except OSError:
+            if attempt >= config.remote_retries:
+                raise
+        time.sleep(0.5 * 2 ** attempt)
+        attempt += 1
+
+def fetch(url):
+    """Return the content, as text, of the document at `url`. See the
+    module documentation for when the cache is used."""
+    if url in _documents:
+        return _documents[url]
+    text = fetch_entry(url)["data"].decode("utf-8")
+    _documents[url] = text
+    return text
+
+def fetch_entry(url):
+    """Return the cache entry of the document at `url`, fetching or
+    revalidating it first if need be."""
+    cache = get_cache()
+    entry = cache.get(url)
+    if config.is_offline:
+        if entry is None:
+            raise FetchError(url + " is not in the cache and SimDem is offline")
+        return entry
+    if entry is not None and 0 <= time.time() - entry["fetched_at"] < config.remote_cache_ttl:
+        return entry
+    try:
+        new_entry = request(url, entry)
+    except OSError as e:
+        # Including urllib.error.URLError
+        if entry is None:
+            raise FetchError("Unable to fetch " + url + ": " + str(e))
+        return entry
+    cache.set(url, new_entry)
+    return new_entry
+
+def prefetch(urls, jobs=None):
+    """Fetch the documents at `urls` concurrently, at most `jobs` at a
+    time, so that they are in the cache when they are needed. Errors
+    are ignored, they are reported when the document is fetched."""
+    if jobs is None:
+        jobs = config.remote_jobs
+    urls = [url for url in dict.fromkeys(urls) if is_remote(url)]
+    if len(urls) < 2 or jobs < 2:
+        return
+
+    def fetch_quietly(url):
+        try:
+            fetch(url)
+        except FetchError:
+            pass
+
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(min(jobs, len(urls))) as executor:
+        list(executor.map(fetch_quietly, urls))
@@ -0,0 +1,161 @@
+# A persistent index of the scripts in a directory tree, used to
+# generate a table of contents when there is no README.md to run.
+#
+# The index records, for each directory, its modification time, its
+# subdirectories and the scripts (README.md and script.md files) in it,
+# and for each script its title, the first line of the file. When the
+# index is refreshed only the directories whose modification time has
+# changed are listed again, and only the scripts that have changed are
+# read again. Titles are read concurrently, which matters when the
+# index is first built for a large tree.
+#
+# Files and directories matching a pattern in the IGNORE_FILE at the
+# top of the tree are left out of the index. Patterns are matched, in
+# the style of `fnmatch`, against both the name and the path, relative
+# to the top of the tree, of each file and directory.
+
+import fnmatch
+import os
+
+from cache import DiskCache
+import config
+
+# Names of the files that are scripts
+SCRIPT_NAMES = ["README.md", "script.md"]
+
+# Name of the file listing the patterns of paths to leave out
+IGNORE_FILE = ".simdemignore"
+
+# Maximum size, in bytes, of the store of indexes. Each script takes
+# roughly a hundred bytes.
+MAX_CACHE_SIZE = 16 * 1024 * 1024
+
+_cache = None
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = DiskCache("scripts", MAX_CACHE_SIZE)
+    return _cache
+
+def read_ignore_patterns(directory):
+    """Return the patterns in the ignore file at the top of
+    `directory`, ignoring blank lines and comments."""
+    patterns = []
+    try:
+        with open(os.path.join(directory, IGNORE_FILE)) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    patterns.append(line.rstrip("/"))
+    except OSError:
+        pass
+    return patterns
+
+def is_ignored(name, path, patterns):
+    for pattern in patterns:
+        if fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(path, pattern):
+            return True
+    return False
+
+def join(rel, name):
+    """Return the path of `name` in the directory at `rel`, a faster
+    `os.path.join` for the relative paths in an index."""
+    return rel + os.sep + name if rel else name
+
+def read_title(path):
+    """Return the title of the script at `path`, its first line less
+    the leading '# '."""
+    try:
+        with open(path) as f:
+            return f.readline().strip()[2:]
+    except (OSError, UnicodeDecodeError):
+        return ""
+
+def read_titles(paths):
+    return [read_title(path) for path in paths]
+
+def list_directory(directory, rel, patterns):
+    """Return the names of the subdirectories and of the scripts in the
+    directory at `rel` in `directory`, each sorted by name."""
+    subdirs = []
+    scripts = []
+    # os.scandir is only a context manager from Python 3.6, the iterator
+    # is closed once it is exhausted
+    for entry in os.scandir(join(directory, rel)):
+        if patterns and is_ignored(entry.name, join(rel, entry.name), patterns):
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry.name)
+        elif entry.name in SCRIPT_NAMES and entry.is_file():
+            scripts.append(entry.name)
+    return sorted(subdirs), sorted(scripts)
+
+def get_scripts(directory, jobs=None):
+    """Return a list of (path, title) pairs for the scripts in
+    `directory` and its subdirectories, with paths relative to
+    `directory`. Directories are listed before their subdirectories,
+    and the index of `directory` is brought up to date and saved."""
+    if jobs is None:
+        jobs = config.script_index_jobs
+    directory = os.path.abspath(directory)
+    patterns = read_ignore_patterns(directory)
+    index = get_cache().get(directory)
+    if index is None or index["patterns"] != patterns:
+        index = {"patterns": patterns, "directories": {}, "scripts": {}}
+    directories = {}
+    scripts = {}
+    order = []
+    stale = []
+    is_changed = False
+
+    pending = [""]
+    while pending:
+        rel = pending.pop()
+        try:
+            mtime = os.stat(join(directory, rel)).st_mtime_ns
+            entry = index["directories"].get(rel)
+            if entry is None or entry[0] != mtime:
+                entry = (mtime,) + list_directory(directory, rel, patterns)
+                is_changed = True
+        except OSError:
+            is_changed = True
+            continue
+        directories[rel] = entry
+        _, subdirs, names = entry
+        for name in names:
+            path = join(rel, name)
+            try:
+                info = os.stat(directory + os.sep + path)
+            except OSError:
+                is_changed = True
+                continue
+            signature = (info.st_mtime_ns, info.st_size)
+            script = index["scripts"].get(path)
+            if script is None or script[0] != signature:
+                script = (signature, None)
+                stale.append(path)
+            scripts[path] = script
+            order.append(path)
+        pending.extend(join(rel, subdir) for subdir in reversed(subdirs))
+
+    if stale:
+        is_changed = True
+        paths = [directory + os.sep + path for path in stale]
+        if jobs > 1 and len(stale) > 1:
+            # Each thread reads a share of the titles
+            import concurrent.futures
+            chunks = [paths[i::jobs] for i in range(jobs)]
+            with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+                results = list(executor.map(read_titles, chunks))
+            titles = [None] * len(paths)
+            for i, chunk in enumerate(results):
+                titles[i::jobs] = chunk
+        else:
+            titles = read_titles(paths)
+        for path, title in zip(stale, titles):
+            scripts[path] = (scripts[path][0], title)
+
+    if is_changed or len(scripts) != len(index["scripts"]):
+        get_cache().set(directory, {"patterns": patterns, "directories": directories, "scripts": scripts})
+    return [(path, scripts[path][1]) for path in order]
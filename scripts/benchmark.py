@@ -0,0 +1,583 @@
+#!/usr/bin/env python3
+
+# Micro benchmarks for SimDem internals. Run from the root of the
+# repository, for example:
+#
+#   python3 scripts/benchmark.py executor
+#
+# Each benchmark prints a small table of timings.
+
+import difflib
+import glob
+import http.server
+import json
+import optparse
+import os
+import random
+import re
+import shutil
+import socketserver
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import cassette
+import config
+import shell
+from cli import Ui
+from demo import Demo
+import document
+from environment import Environment
+import execution_log
+import input_channel
+import remote
+import script_index
+import similarity
+import variables
+
+def benchmark_executor(options):
+    """Compare the per-command overhead of the shell backends on a
+    document made up of many short commands."""
+    commands = []
+    for i in range(options.count // 3):
+        commands += ["X=" + str(i), "echo $X", "true"]
+    print("Running " + str(len(commands)) + " short commands per executor")
+    print("%-10s %12s %12s %16s" % ("executor", "startup (s)", "total (s)", "per command (ms)"))
+    for name, shell_class in sorted(shell.EXECUTORS.items()):
+        start_time = time.time()
+        sh = shell_class(dict(os.environ), True)
+        startup = time.time() - start_time
+
+        start_time = time.time()
+        for command in commands:
+            sh.run_command(command)
+        total = time.time() - start_time
+        sh.close()
+        print("%-10s %12.3f %12.3f %16.3f" % (name, startup, total, total / len(commands) * 1000))
+
+def benchmark_stream(options):
+    """Compare the time until the first output of a slow command is
+    available, and the size of the largest piece of output delivered at
+    once, with and without streaming."""
+    command = "for i in 1 2 3 4 5; do seq 1 20000; sleep 0.2; done"
+    print("%-10s %10s %20s %16s %20s" % ("executor", "streamed", "first output (s)", "total (s)", "largest piece (KB)"))
+    for name, shell_class in sorted(shell.EXECUTORS.items()):
+        sh = shell_class(dict(os.environ), True)
+        for is_streamed in [False, True]:
+            pieces = []
+            start_time = time.time()
+            def on_output(text):
+                pieces.append((time.time() - start_time, len(text)))
+            output = sh.run_command(command, -1, on_output if is_streamed else None)
+            total = time.time() - start_time
+            if not is_streamed:
+                pieces.append((total, len(output)))
+            print("%-10s %10s %20.3f %16.3f %20.1f" % (name, is_streamed, pieces[0][0], total, max(size for _, size in pieces) / 1024))
+        sh.close()
+
+def benchmark_replay(options):
+    """Compare running commands in a shell with replaying them from a
+    cassette, including saving and loading the cassette."""
+    commands = []
+    for i in range(options.count // 3):
+        commands += ["X=" + str(i), "echo $X", "seq 1 " + str(i % 50)]
+    get_key = lambda command: ("benchmark.md", command)
+    path = os.path.join(tempfile.mkdtemp(), "benchmark.cassette")
+    print("Running " + str(len(commands)) + " short commands")
+    print("%-20s %12s %16s" % ("executor", "total (s)", "per command (ms)"))
+    for name, shell_class in sorted(shell.EXECUTORS.items()):
+        recording = cassette.Cassette(path)
+        start_time = time.time()
+        sh = cassette.RecordingShell(shell_class(dict(os.environ), True), recording, get_key)
+        for command in commands:
+            sh.run_command(command)
+        total = time.time() - start_time
+        sh.close()
+        print("%-20s %12.3f %16.3f" % (name + " (recording)", total, total / len(commands) * 1000))
+
+    start_time = time.time()
+    recording.save()
+    replaying = cassette.Cassette(path)
+    replaying.load()
+    sh = cassette.CassetteShell(replaying, get_key)
+    for command in commands:
+        sh.run_command(command)
+    total = time.time() - start_time
+    print("%-20s %12.3f %16.3f" % ("replay", total, total / len(commands) * 1000))
+    print("Cassette size: %.1f KB" % (os.path.getsize(path) / 1024))
+    shutil.rmtree(os.path.dirname(path))
+
+def benchmark_pipeline(options):
+    """Measure the time until the first command of a test plan is
+    available and the peak memory used while streaming every node of
+    the plan, for test plans of increasing size."""
+    directory = tempfile.mkdtemp(prefix="simdem-benchmark-")
+    source = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "demo_scripts", "AKSDeployment", "README.md")
+    with open(source) as f:
+        text = f.read()
+    print("%-10s %16s %12s %16s" % ("documents", "first cmd (ms)", "total (s)", "peak memory (KB)"))
+    try:
+        for size in [1, 10, options.count]:
+            plan = []
+            for i in range(size):
+                path = os.path.join(directory, "doc" + str(i) + ".md")
+                with open(path, "w") as f:
+                    f.write(text)
+                plan.append(path)
+
+            demo = Demo(False, directory, is_testing=True)
+            demo.ui = Ui()
+            demo.ui.demo = demo
+            demo.test_plan = plan
+
+            tracemalloc.start()
+            start_time = time.time()
+            first = None
+            for node in demo.classify_lines():
+                if first is None and node.type == "executable":
+                    first = time.time() - start_time
+            total = time.time() - start_time
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print("%-10d %16.3f %12.3f %16.1f" % (size, first * 1000, total, peak / 1024))
+    finally:
+        shutil.rmtree(directory)
+
+def captured_outputs(count):
+    """Return a list of (actual, expected) result pairs. Expected results
+    are the results blocks of the bundled demo scripts, actual results
+    are the same text with any hex identifiers changed, as they
+    would be from one run to the next. Some large JSON documents, like
+    those output by `az`, are included too."""
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "demo_scripts")
+    rand = random.Random(0)
+    def vary(text):
+        return re.sub(r"[0-9a-f]{8,}", lambda m: "".join(rand.choice("0123456789abcdef") for _ in m.group()), text)
+
+    pairs = []
+    for path in sorted(glob.glob(os.path.join(root, "**", "*.md"), recursive=True)):
+        with open(path) as f:
+            doc = document.parse(path, f.readlines())
+        for node in doc.nodes:
+            if node.type == "result":
+                pairs.append((vary(node.text), node.text))
+
+    for size in [10, 50, 200]:
+        resources = []
+        for i in range(size):
+            resources.append({
+                "id": "/subscriptions/%032x/resourceGroups/rg%d/providers/Microsoft.Compute/virtualMachines/vm%d" % (rand.getrandbits(128), i, i),
+                "location": "eastus",
+                "name": "vm" + str(i),
+                "properties": {"provisioningState": "Succeeded", "vmId": "%032x" % rand.getrandbits(128)},
+                "tags": {}
+            })
+        expected = json.dumps(resources, indent=2)
+        pairs.append((vary(expected), expected))
+    return pairs[:count]
+
+def score_before(actual, expected, required):
+    # The scoring done by Demo.is_pass before the tiered scorer
+    differ = difflib.Differ()
+    differ.compare(actual, expected)
+    differ.compare(actual, expected)
+    seq = difflib.SequenceMatcher(lambda x: x in " \t\n\r", actual, expected)
+    seq.ratio() >= required
+    str(seq.ratio())
+    return seq.ratio()
+
+def benchmark_similarity(options):
+    """Compare the time taken to score results blocks before and after
+    the introduction of the tiered scorer. `changed` is the number of
+    blocks for which the two scorers disagree on whether the test
+    passed."""
+    pairs = captured_outputs(options.count)
+    print("Scoring " + str(len(pairs)) + " results blocks, largest " + str(max(len(e) for _, e in pairs)) + " characters")
+    print("%-10s %10s %12s %16s %10s" % ("scorer", "required", "total (s)", "per block (ms)", "changed"))
+    for required in [0.3, 0.8, 0.99]:
+        verdicts = {}
+        for name, scorer in [("before", score_before), ("after", similarity.score)]:
+            start_time = time.time()
+            verdicts[name] = [scorer(actual, expected, required) >= required for actual, expected in pairs]
+            total = time.time() - start_time
+            changed = sum(1 for a, b in zip(verdicts["before"], verdicts[name]) if a != b)
+            print("%-10s %10.2f %12.3f %16.3f %10d" % (name, required, total, total / len(pairs) * 1000, changed))
+
+def benchmark_log(options):
+    """Compare string concatenation with the chunked execution log when
+    simulating typing, which writes one chunk per character."""
+    chunks = ["\x1b[37m", "x", "\x1b[0m"] * (options.count * 100)
+    print("Writing " + str(len(chunks)) + " chunks")
+    print("%-20s %12s %20s" % ("log", "total (s)", "size in memory (KB)"))
+
+    # Ui used to append to an attribute, which, unlike a local variable,
+    # CPython cannot extend in place
+    ui = Ui()
+    ui.text = ""
+    start_time = time.time()
+    for chunk in chunks:
+        ui.text += chunk
+    print("%-20s %12.3f %20.1f" % ("concatenation", time.time() - start_time, len(ui.text) / 1024))
+
+    for max_size in [0, 256 * 1024]:
+        log = execution_log.ExecutionLog(max_size)
+        start_time = time.time()
+        for chunk in chunks:
+            log.write(chunk)
+        log.getvalue()
+        label = "chunked" if max_size == 0 else "ring buffer " + str(max_size // 1024) + "KB"
+        print("%-20s %12.3f %20.1f" % (label, time.time() - start_time, len(log) / 1024))
+
+def benchmark_input(options):
+    """Compare the busy waiting the web UI used to do for input with the
+    InputChannel that replaced it. Reports the CPU used by the waiting
+    thread while idle for a second and the mean latency between input
+    arriving and the waiting thread receiving it."""
+    print("%-10s %16s %16s" % ("wait", "idle CPU (%)", "latency (ms)"))
+
+    class Spin(object):
+        value = None
+
+        def put(self, value):
+            self.received = time.time()
+            self.value = value
+
+        def get(self):
+            while self.value is None:
+                pass
+            value, self.value = self.value, None
+            self.latency = time.time() - self.received
+            return value
+
+    for name, channel in [("spin", Spin()), ("channel", input_channel.InputChannel("key"))]:
+        cpu = []
+        latencies = []
+
+        def waiter():
+            for i in range(options.batch):
+                start_time = time.process_time()
+                channel.get()
+                cpu.append(time.process_time() - start_time)
+                latencies.append(channel.latency)
+
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        for i in range(options.batch):
+            time.sleep(1)
+            channel.put("n")
+        thread.join()
+        print("%-10s %16.1f %16.3f" % (name, sum(cpu) / len(cpu) * 100, sum(latencies) / len(latencies) * 1000))
+
+def environment_before(directory, is_test):
+    # The environment Environment built before it was layered, a copy
+    # of os.environ updated from every env.json style file
+    env = os.environ.copy()
+    names = ["../env.json", "env.json", "../env.local.json", "env.local.json"]
+    if is_test:
+        names += ["../env.test.json", "env.test.json"]
+    for name in names:
+        filename = os.path.join(directory, name)
+        if os.path.isfile(filename):
+            with open(filename) as env_file:
+                env.update(json.load(env_file))
+    return env
+
+def benchmark_environment(options):
+    """Compare the time taken to build, and the memory held by, the
+    environments of a deep chain of prerequisites before and after
+    environments were layered. Each prerequisite has an env.json and
+    an env.test.json file, and its environment is built twice, once
+    when its Demo is created and once when it is run."""
+    depth = max(options.count // 10, 1)
+    root = tempfile.mkdtemp()
+    directories = []
+    directory = root
+    for i in range(depth):
+        directory = os.path.join(directory, "step" + str(i))
+        os.mkdir(directory)
+        for name in ["env.json", "env.test.json"]:
+            with open(os.path.join(directory, name), "w") as env_file:
+                json.dump({"STEP_" + str(i) + "_" + str(j): "value " + str(j) for j in range(20)}, env_file)
+        directories.append(directory)
+
+    print("Building the environments of a chain of " + str(depth) + " prerequisites, " + str(len(os.environ)) + " environment variables")
+    print("%-10s %12s %18s %20s" % ("loader", "total (s)", "per document (ms)", "memory held (KB)"))
+    loaders = [
+        ("before", lambda directory: environment_before(directory, True)),
+        ("after", lambda directory: Environment(directory, is_test=True))
+    ]
+    try:
+        for name, loader in loaders:
+            tracemalloc.start()
+            start_time = time.time()
+            for i in range(options.batch):
+                environments = []
+                for directory in directories:
+                    environments.append(loader(directory))
+                    environments.append(loader(directory))
+            total = time.time() - start_time
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del environments
+            print("%-10s %12.3f %18.3f %20.1f" % (name, total, total / (options.batch * depth) * 1000, memory / 1024))
+    finally:
+        shutil.rmtree(root)
+
+def bundled_commands():
+    """Return the commands in the bundled demo scripts."""
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "demo_scripts")
+    commands = []
+    for path in sorted(glob.glob(os.path.join(root, "**", "*.md"), recursive=True)):
+        with open(path) as f:
+            doc = document.parse(path, f.readlines())
+        commands += [node.text for node in doc.nodes if node.type == "executable"]
+    return commands
+
+def benchmark_vars(options):
+    """Compare the time taken to find the variables in the bundled
+    commands, and whether they are in the environment, before and after
+    the introduction of the variables tokenizer. Neither includes the
+    shell round trips for variables not in the environment, which were
+    one per variable and are now one per step."""
+    commands = bundled_commands()
+    env = dict(os.environ)
+    print("Resolving the variables in " + str(len(commands)) + " commands with " + str(len(env)) + " environment variables")
+    print("%-10s %12s %18s" % ("resolver", "total (s)", "per command (us)"))
+
+    def before(command):
+        var_pattern = re.compile(".*?(?<=\$)\(?{?(\w*)(?=[\W|\$|\s|\\\"]?)\)?(?!\$).*")
+        defined = []
+        for var in var_pattern.findall(command):
+            for item in env:
+                if var == item:
+                    defined.append(var)
+                    break
+        return defined
+
+    def after(command):
+        return [name for name in variables.get_names(command) if name in env]
+
+    for name, resolver in [("before", before), ("after", after)]:
+        start_time = time.time()
+        for i in range(options.count):
+            for command in commands:
+                resolver(command)
+        total = time.time() - start_time
+        print("%-10s %12.3f %18.3f" % (name, total, total / (options.count * len(commands)) * 1000000))
+
+def toc_before(directory):
+    # The scripts and titles generate_toc found before the script index
+    scripts = []
+    for dirpath, dirs, files in os.walk(directory):
+        for file in files:
+            if file == "README.md" or file == "script.md":
+                with open(os.path.join(dirpath, file)) as f:
+                    scripts.append((os.path.join(dirpath, file), f.readline().strip()[2:]))
+    return scripts
+
+def benchmark_toc(options):
+    """Compare the time taken to find the scripts, and their titles, for
+    a table of contents before and after the script index. The index is
+    measured when it is first built (cold), when nothing has changed
+    (warm) and after one script in every ten has been edited."""
+    root = tempfile.mkdtemp()
+    temp_dir = config.SIMDEM_TEMP_DIR
+    config.SIMDEM_TEMP_DIR = os.path.join(root, "simdem")
+    scripts_dir = os.path.join(root, "scripts")
+    count = options.count * 10
+    paths = []
+    for i in range(count):
+        directory = os.path.join(scripts_dir, "group" + str(i % 30), "script" + str(i))
+        os.makedirs(directory)
+        paths.append(os.path.join(directory, "README.md"))
+        with open(paths[-1], "w") as f:
+            f.write("# Script " + str(i) + "\n\nSome text.\n")
+
+    def edit():
+        for path in paths[::10]:
+            with open(path, "a") as f:
+                f.write("More text.\n")
+
+    print("Finding " + str(count) + " scripts in " + str(count + 31) + " directories")
+    print("%-10s %12s" % ("finder", "total (ms)"))
+    runs = [
+        ("before", None, lambda: toc_before(scripts_dir)),
+        ("cold", None, lambda: script_index.get_scripts(scripts_dir)),
+        ("warm", None, lambda: script_index.get_scripts(scripts_dir)),
+        ("edited", edit, lambda: script_index.get_scripts(scripts_dir))
+    ]
+    try:
+        for name, prepare, finder in runs:
+            if prepare is not None:
+                prepare()
+            start_time = time.time()
+            scripts = finder()
+            total = time.time() - start_time
+            assert len(scripts) == count
+            print("%-10s %12.1f" % (name, total * 1000))
+    finally:
+        config.SIMDEM_TEMP_DIR = temp_dir
+        shutil.rmtree(root)
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # http.server only provides this from Python 3.7
+    daemon_threads = True
+
+class SlowHandler(http.server.SimpleHTTPRequestHandler):
+    # Serves the files in `root`, after a delay standing in for the
+    # network, and counts the requests served
+    root = None
+    delay = 0.05
+    requests = 0
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        SlowHandler.requests += 1
+        super().do_GET()
+
+    def translate_path(self, path):
+        # SimpleHTTPRequestHandler only takes a directory to serve from
+        # Python 3.7
+        return os.path.join(self.root, urllib.parse.urlparse(path).path.lstrip("/"))
+
+    def log_message(self, *args):
+        pass
+
+def benchmark_remote(options):
+    """Compare the time taken to fetch a remote document and its
+    prerequisites before and after the cache of remote documents, from
+    a local HTTP server that responds after 50ms. The cache is measured
+    when it is empty (cold), when its entries are fresh (warm) and when
+    they must be revalidated with the server (revalidate)."""
+    root = tempfile.mkdtemp()
+    temp_dir = config.SIMDEM_TEMP_DIR
+    config.SIMDEM_TEMP_DIR = os.path.join(root, "simdem")
+    count = max(options.batch, 1)
+    links = ""
+    for i in range(count):
+        os.mkdir(os.path.join(root, "step" + str(i)))
+        with open(os.path.join(root, "step" + str(i), "README.md"), "w") as f:
+            f.write("# Step " + str(i) + "\n\n```bash\necho " + str(i) + "\n```\n")
+        links += "  * [Step " + str(i) + "](../step" + str(i) + "/README.md)\n"
+    os.mkdir(os.path.join(root, "main"))
+    with open(os.path.join(root, "main", "README.md"), "w") as f:
+        f.write("# Main\n\n# Prerequisites\n\n" + links + "\n# Run\n\n```bash\necho main\n```\n")
+
+    SlowHandler.root = root
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:" + str(server.server_address[1]) + "/main/README.md"
+
+    def before():
+        doc = document.parse(url, urllib.request.urlopen(url).read().decode("utf-8").splitlines(True))
+        for line in doc.prerequisites:
+            urllib.request.urlopen(remote.join(url, line.href)).read()
+
+    def after():
+        doc = document.parse(url, remote.fetch(url).splitlines(True))
+        paths = [remote.join(url, line.href) for line in doc.prerequisites]
+        remote.prefetch(paths)
+        for path in paths:
+            remote.fetch(path)
+
+    def expire():
+        config.remote_cache_ttl = 0
+        remote._documents.clear()
+
+    print("Fetching a remote document with " + str(count) + " prerequisites")
+    print("%-12s %12s %10s" % ("fetcher", "total (ms)", "requests"))
+    ttl = config.remote_cache_ttl
+    runs = [
+        ("before", None, before),
+        ("cold", None, after),
+        ("warm", remote._documents.clear, after),
+        ("revalidate", expire, after)
+    ]
+    try:
+        for name, prepare, fetcher in runs:
+            if prepare is not None:
+                prepare()
+            SlowHandler.requests = 0
+            start_time = time.time()
+            fetcher()
+            total = time.time() - start_time
+            print("%-12s %12.1f %10d" % (name, total * 1000, SlowHandler.requests))
+    finally:
+        config.remote_cache_ttl = ttl
+        config.SIMDEM_TEMP_DIR = temp_dir
+        server.shutdown()
+        shutil.rmtree(root)
+
+def benchmark_startup(options):
+    """Measure the time taken to import SimDem's modules, reported by
+    `python -X importtime`, and to run a one command document, in
+    script, test and tutorial modes. Each mode is run `batch` times in a
+    new process, the medians are reported."""
+    directory = tempfile.mkdtemp(prefix="simdem-benchmark-")
+    with open(os.path.join(directory, "README.md"), "w") as f:
+        f.write("# Startup\n\n```bash\necho hello\n```\n\nResults:\n\n```\nhello\n```\n")
+    main_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "main.py")
+    print("Starting SimDem on a one command document, " + str(options.batch) + " runs per mode")
+    print("%-10s %14s %12s  %s" % ("mode", "imports (ms)", "run (ms)", "heaviest imports (ms)"))
+    try:
+        for mode in ["script", "test", "tutorial"]:
+            import_times = []
+            run_times = []
+            for i in range(max(options.batch, 1)):
+                start_time = time.time()
+                process = subprocess.run([sys.executable, "-X", "importtime", main_py, "-p", directory, "--norc", "true", "--auto", "true", mode],
+                                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+                run_times.append(time.time() - start_time)
+                imports = {}
+                for line in process.stderr.splitlines():
+                    # Top level imports are indented by a single space
+                    match = re.match(r"import time:\s+\d+ \|\s+(\d+) \| (\S.*)$", line)
+                    if match:
+                        imports[match.group(2)] = int(match.group(1)) / 1000
+                import_times.append(sum(imports.values()))
+            heaviest = sorted(imports.items(), key=lambda item: -item[1])[:3]
+            print("%-10s %14.1f %12.1f  %s" % (mode, statistics.median(import_times), statistics.median(run_times) * 1000,
+                                               ", ".join("%s %.0f" % item for item in heaviest)))
+    finally:
+        shutil.rmtree(directory)
+
+BENCHMARKS = {
+    "environment": benchmark_environment,
+    "executor": benchmark_executor,
+    "input": benchmark_input,
+    "log": benchmark_log,
+    "pipeline": benchmark_pipeline,
+    "remote": benchmark_remote,
+    "replay": benchmark_replay,
+    "similarity": benchmark_similarity,
+    "startup": benchmark_startup,
+    "stream": benchmark_stream,
+    "toc": benchmark_toc,
+    "vars": benchmark_vars
+}
+
+def main():
+    p = optparse.OptionParser("%prog [" + "|".join(sorted(BENCHMARKS)) + "] <options>")
+    p.add_option('--count', '-n', type="int", default=300,
+                 help="The number of iterations to run, where applicable.")
+    p.add_option('--batch', '-b', type="int", default=10,
+                 help="The number of repetitions in the input, environment, remote and startup benchmarks.")
+    options, arguments = p.parse_args()
+
+    names = arguments or sorted(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            p.error("Unknown benchmark: " + name)
+        print("== " + name + " ==")
+        BENCHMARKS[name](options)
+        print()
+
+main()
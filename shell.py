@@ -0,0 +1,595 @@
+# Management of the bash shells in which SimDem executes commands.
+
+import codecs
+import os
+import queue
+import select
+import shlex
+import signal
+import subprocess
+import threading
+import time
+import uuid
+import weakref
+
+import config
+
+# pexpect is imported when the first 'pty' shell is started, see
+# `import_pexpect`
+pexpect = None
+
+# The shells started by this process, see `kill_all`
+_shells = weakref.WeakSet()
+
+PEXPECT_PROMPT = u'[PEXPECT_PROMPT>'
+PEXPECT_CONTINUATION_PROMPT = u'[PEXPECT_PROMPT+'
+
+# Bash snippet run in every new shell. It disables readline's bracketed
+# paste mode, which would otherwise wrap command output in escape
+# sequences, and records the names of the variables that exist once the
+# shell has started so that `__simdem_reset` can later discard anything
+# a previous user of the shell defined.
+INIT_COMMAND = u"bind 'set enable-bracketed-paste off' 2>/dev/null; __SIMDEM_BASELINE=\" __SIMDEM_BASELINE $(compgen -v | tr '\\n' ' ') \"; __simdem_reset() { local __v; for __v in $(compgen -v); do case \"$__SIMDEM_BASELINE\" in *\" $__v \"*) ;; *) unset \"$__v\" 2>/dev/null;; esac; done; dirs -c; }"
+
+# Bash snippet that prints the name and value of each variable a user
+# of the shell may have set, or changed, as `name=value` pairs each
+# terminated by a NUL. Variables bash set when the shell started are
+# ignored unless they are exported. The exit code of the previous
+# command is preserved.
+DUMP_VARIABLES_COMMAND = u"__simdem_s=$?; __simdem_e=\" $(compgen -e | tr '\\n' ' ') \"; for __simdem_v in $(compgen -v); do case \"$__SIMDEM_BASELINE\" in *\" $__simdem_v \"*) case \"$__simdem_e\" in *\" $__simdem_v \"*) ;; *) continue;; esac;; esac; printf '%s=%s\\0' \"$__simdem_v\" \"${!__simdem_v}\"; done; unset __simdem_v __simdem_e; (exit $__simdem_s)"
+
+def stream(on_output, text):
+    """Pass `text` to the `on_output` callback in chunks of at most
+    `config.stream_chunk_size` characters."""
+    size = config.stream_chunk_size
+    for start in range(0, len(text), size):
+        on_output(text[start:start + size])
+
+def import_pexpect():
+    """Import pexpect, which is only needed by the 'pty' executor and
+    is slow to import."""
+    global pexpect
+    if pexpect is None:
+        import pexpect.replwrap
+    return pexpect
+
+def get_prompt_prefix_length(text):
+    """Return the length of the longest end of `text` that may be the
+    start of a prompt, see PEXPECT_PROMPT."""
+    # The prompts only differ in their last character
+    for length in range(min(len(text), len(PEXPECT_PROMPT) - 1), 0, -1):
+        if text.endswith(PEXPECT_PROMPT[:length]):
+            return length
+    return 0
+
+def spawn_bash(args, env):
+    """Start bash, with the supplied arguments and environment, in a
+    pseudo terminal. Return the pexpect child."""
+    child = pexpect.spawnu('/bin/bash', args, env=env, echo=False, timeout=None)
+    # pexpect sleeps for 50ms before every write, so that a program that
+    # has just turned echo off to read a password sees all of its input.
+    # We only write to the shell once it has printed its prompt, and the
+    # delay would otherwise be most of the time taken by a short command.
+    child.delaybeforesend = 0
+    return child
+
+class ShellExited(Exception):
+    """Raised when the shell process exits while running a command."""
+    pass
+
+class CommandTimeout(Exception):
+    """Raised when a command does not complete within its timeout. The
+    command has been interrupted by the time this is raised, if the
+    shell could not be recovered `is_alive` is False on the shell.
+
+    `output` is the output of the command before it was interrupted
+    and `duration` the number of seconds it ran for."""
+
+    def __init__(self, command, output="", duration=None):
+        super().__init__("Command timed out after %.1f seconds: %s" % (duration or 0, command))
+        self.command = command
+        self.output = output
+        self.duration = duration
+
+class BaseShell(object):
+    """Behaviour common to all shell backends. Subclasses provide
+    `run_command` and `close`, and set `env`, the environment the
+    shell was started with."""
+
+    # Exit code and execution time, in seconds, of the last command
+    # run. The exit code is None if the backend cannot provide it.
+    exit_code = None
+    duration = None
+    is_used = False
+
+    # False once the shell has been closed because a command could not
+    # be interrupted, see `interrupt`
+    is_alive = True
+
+    # The number of commands run in the shell so far, used to tell
+    # whether the shell may have changed since it was last inspected
+    command_count = 0
+
+    def reset(self, directory, env):
+        """Prepare the shell for a new user. The working directory is set
+        to `directory` and the environment is updated to match `env`,
+        any variables defined by a previous user of the shell are
+        discarded. This is done in a single round trip to the shell.
+        """
+        commands = []
+        if self.is_used:
+            commands.append("__simdem_reset")
+            changed = env
+        else:
+            changed = {key: value for key, value in env.items() if self.env.get(key) != value}
+        removed = [key for key in self.env if key not in env]
+
+        if changed:
+            commands.append("export " + " ".join(key + "=" + shlex.quote(str(value)) for key, value in changed.items()))
+        if removed:
+            commands.append("unset " + " ".join(removed))
+        commands.append("cd " + shlex.quote(directory))
+        self.run_command("; ".join(commands))
+        self.is_used = False
+
+    def get_variables(self):
+        """Return a dictionary of the variables set in the shell, see
+        DUMP_VARIABLES_COMMAND. This takes a single round trip to the
+        shell."""
+        output = self.run_command(DUMP_VARIABLES_COMMAND).replace("\r\n", "\n")
+        variables = {}
+        for item in output.split("\0"):
+            name, sep, value = item.partition("=")
+            name = name.strip()
+            if sep and not name.startswith("__simdem") and not name.startswith("__SIMDEM"):
+                variables[name] = value
+        return variables
+
+class Shell(BaseShell):
+    """A long lived, interactive bash session driven through pexpect."""
+
+    def __init__(self, env, is_minimal=False):
+        """Spawn a new bash process with the supplied environment.
+
+        If is_minimal is True then bash will not read any profile or
+        rc files, this is considerably faster to start and is
+        isolated from the users own shell configuration.
+        """
+        start_time = time.time()
+        import_pexpect()
+        self.env = env
+        self.is_minimal = is_minimal
+        self.is_used = False
+
+        ps1 = PEXPECT_PROMPT[:5] + u'\[\]' + PEXPECT_PROMPT[5:]
+        ps2 = PEXPECT_CONTINUATION_PROMPT[:5] + u'\[\]' + PEXPECT_CONTINUATION_PROMPT[5:]
+        if is_minimal:
+            # No rc files will override the prompt so we can set it
+            # in the environment and avoid waiting for the default one
+            spawn_env = dict(env)
+            spawn_env["PS1"] = ps1
+            spawn_env["PS2"] = ps2
+            spawn_env["PROMPT_COMMAND"] = ""
+            child = spawn_bash(['--norc', '--noprofile'], spawn_env)
+            self._repl = pexpect.replwrap.REPLWrapper(child, PEXPECT_PROMPT, None, PEXPECT_PROMPT, PEXPECT_CONTINUATION_PROMPT, INIT_COMMAND)
+        else:
+            child = spawn_bash([], env)
+            prompt_change = u"PS1='{0}' PS2='{1}' PROMPT_COMMAND=''".format(ps1, ps2)
+            self._repl = pexpect.replwrap.REPLWrapper(child, u'\$', prompt_change, extra_init_cmd=INIT_COMMAND)
+        self.child = child
+        _shells.add(self)
+        self.startup_time = time.time() - start_time
+
+    def run_command(self, command, timeout=-1, on_output=None):
+        """Run a command in the shell and return its output. If `timeout`
+        is a number of seconds, rather than None or -1, and the command
+        does not complete in that time it is interrupted and
+        CommandTimeout is raised.
+
+        If `on_output` is supplied the output is instead passed to it,
+        in chunks, while the command runs, see `stream`. The shell does
+        not keep output that has been passed on and None is returned.
+        """
+        self.is_used = True
+        self.command_count += 1
+        start_time = time.time()
+        try:
+            if on_output is None:
+                response = self._repl.run_command(command, timeout)
+            else:
+                response = self._run_streamed(command, timeout, on_output)
+        except pexpect.TIMEOUT:
+            self.duration = time.time() - start_time
+            output = self.child.before
+            if on_output is not None:
+                stream(on_output, output)
+                output = ""
+            self.interrupt()
+            raise CommandTimeout(command, output, self.duration)
+        self.duration = time.time() - start_time
+        return response
+
+    def _run_streamed(self, command, timeout, on_output):
+        """Run a command, as `REPLWrapper.run_command` does, passing its
+        output to `on_output` as it arrives rather than returning it."""
+        lines = command.splitlines()
+        if command.endswith("\n"):
+            lines.append("")
+        if not lines:
+            raise ValueError("No command was given")
+
+        self.child.sendline(lines[0])
+        for line in lines[1:]:
+            self._expect_prompt(timeout, on_output)
+            self.child.sendline(line)
+        if self._expect_prompt(timeout, on_output) == 1:
+            # We got the continuation prompt - command was incomplete
+            self.child.kill(signal.SIGINT)
+            self._repl._expect_prompt(timeout=1)
+            raise ValueError("Continuation prompt found - input was incomplete:\n" + command)
+
+    def _expect_prompt(self, timeout, on_output=None):
+        """Wait for the prompt. If `on_output` is supplied the output read
+        so far is passed to it, and discarded, every
+        `config.stream_interval` seconds while waiting. Returns 0 for
+        the prompt and 1 for the continuation prompt."""
+        if on_output is None:
+            return self._repl._expect_prompt(timeout=timeout)
+
+        deadline = None
+        if timeout is not None and timeout >= 0:
+            deadline = time.time() + timeout
+        while True:
+            interval = config.stream_interval
+            if deadline is not None:
+                interval = max(min(interval, deadline - time.time()), 0)
+            try:
+                index = self._repl._expect_prompt(timeout=interval)
+            except pexpect.TIMEOUT:
+                if deadline is not None and time.time() >= deadline:
+                    raise
+                # `before` holds everything read since the last prompt,
+                # hold back what may be the start of the next one
+                before = self.child.before
+                end = len(before) - get_prompt_prefix_length(before)
+                if end > 0:
+                    stream(on_output, before[:end])
+                    self._discard(end)
+                continue
+            stream(on_output, self.child.before)
+            return index
+
+    def _discard(self, length):
+        """Discard the first `length` characters read since the last
+        prompt, so that output that has been streamed is not held in
+        memory. This replaces pexpect's internal buffers."""
+        tail = self.child.before[length:]
+        for name in ("_before", "_buffer"):
+            buffer = self.child.buffer_type()
+            buffer.write(tail)
+            setattr(self.child, name, buffer)
+        self.child.before = tail
+
+    def interrupt(self):
+        """Interrupt the running command, as a user would by pressing
+        Ctrl-C, and wait for the shell to return to the prompt. If the
+        command ignores the interrupt its process group is killed. If
+        the shell still does not return to the prompt it is closed and
+        `is_alive` set to False."""
+        self.child.sendintr()
+        if self._resync():
+            return
+        try:
+            group = os.tcgetpgrp(self.child.child_fd)
+            if group != os.getpgid(self.child.pid):
+                os.killpg(group, signal.SIGKILL)
+        except OSError:
+            pass
+        if not self._resync():
+            self.close()
+            self.is_alive = False
+
+    def _resync(self):
+        """Wait for the prompt, then discard anything up to the output of
+        a marker command, so that no output of the interrupted command
+        is mistaken for the output of the next one. Returns False if
+        the shell did not respond within `config.interrupt_timeout`
+        seconds."""
+        marker = uuid.uuid4().hex
+        try:
+            self._repl._expect_prompt(timeout=config.interrupt_timeout)
+            self.child.sendline("echo __SIMDEM_SYNC_" + "$((1))" + marker)
+            self.child.expect_exact("__SIMDEM_SYNC_1" + marker, timeout=config.interrupt_timeout)
+            self._repl._expect_prompt(timeout=config.interrupt_timeout)
+        except (pexpect.TIMEOUT, pexpect.EOF):
+            return False
+        return True
+
+    def close(self):
+        """Terminate the shell process."""
+        self.child.close(force=True)
+
+    def kill(self):
+        """Kill the shell and the command running in it, if any, without
+        waiting for them. Commands run in a process group of their own,
+        the shell in the process group of the pseudo terminal's
+        session."""
+        try:
+            group = os.tcgetpgrp(self.child.child_fd)
+            if group != os.getpgid(self.child.pid):
+                os.killpg(group, signal.SIGKILL)
+        except OSError:
+            pass
+        try:
+            os.killpg(self.child.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+class PipeShell(BaseShell):
+    """A long lived bash session driven through pipes rather than a
+    pseudo terminal. There is no prompt to match, instead each command
+    is followed by a sentinel line, unique to this shell and command,
+    that carries the exit code of the command. Output is read until the
+    sentinel is found, so the per-command overhead is a single write
+    and a scan of the new output only.
+
+    Commands are run with `eval` in the shell itself, so variables,
+    functions and the working directory persist between commands just
+    as they do in an interactive shell. Commands read from /dev/null
+    rather than the pipe used to send commands to the shell.
+    """
+
+    def __init__(self, env, is_minimal=False):
+        start_time = time.time()
+        self.env = env
+        self.is_minimal = is_minimal
+        self._sentinel = ("__SIMDEM_" + uuid.uuid4().hex).encode()
+        self._sequence = 0
+        self._buffer = b""
+
+        spawn_env = dict(env)
+        if is_minimal:
+            spawn_env.pop("BASH_ENV", None)
+        self.process = subprocess.Popen(['/bin/bash', '--norc', '--noprofile'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=spawn_env, start_new_session=True)
+        _shells.add(self)
+        if not is_minimal:
+            self.run_command("shopt -s expand_aliases; [ -f ~/.bashrc ] && . ~/.bashrc")
+        self.run_command(INIT_COMMAND)
+        self.is_used = False
+        self.startup_time = time.time() - start_time
+
+    def run_command(self, command, timeout=-1, on_output=None):
+        """Run a command in the shell and return its output. The exit
+        code is available in `self.exit_code` afterwards. See
+        `Shell.run_command` for `timeout` and `on_output`."""
+        self.is_used = True
+        self.command_count += 1
+        self._sequence += 1
+        marker = b"\n" + self._sentinel + b":" + str(self._sequence).encode() + b":"
+        framed = "eval " + shlex.quote(command) + " </dev/null\nprintf '\\n%s:%d:%d\\n' " + self._sentinel.decode() + " " + str(self._sequence) + " $?\n"
+
+        start_time = time.time()
+        try:
+            self.process.stdin.write(framed.encode())
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            raise ShellExited("Shell exited before running: " + command)
+
+        deadline = None
+        if timeout is not None and timeout >= 0:
+            deadline = start_time + timeout
+        try:
+            output, self.exit_code = self._read_until(marker, command, deadline, on_output)
+        except CommandTimeout as e:
+            e.duration = self.duration = time.time() - start_time
+            self.interrupt()
+            raise
+        self.duration = time.time() - start_time
+        return output
+
+    def _read_until(self, marker, command, deadline=None, on_output=None):
+        """Read output until the sentinel `marker` is found. Return the
+        output that preceded it and the exit code it carries. Raises
+        CommandTimeout if the marker is not found by `deadline`. If
+        `on_output` is supplied output is passed to it as it is read,
+        and None returned in its place."""
+        fd = self.process.stdout.fileno()
+        search_from = 0
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        while True:
+            pos = self._buffer.find(marker, search_from)
+            if pos >= 0:
+                end = self._buffer.find(b"\n", pos + len(marker))
+                if end >= 0:
+                    break
+            else:
+                # The marker may straddle two reads
+                search_from = max(0, len(self._buffer) - len(marker))
+            if on_output is not None:
+                # Pass on, and discard, all but what may be the start of
+                # the marker
+                limit = pos if pos >= 0 else len(self._buffer) - len(marker)
+                if limit > 0:
+                    stream(on_output, decoder.decode(self._buffer[:limit]))
+                    self._buffer = self._buffer[limit:]
+                    search_from = max(0, search_from - limit)
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                    output = self._buffer.decode("utf-8", "replace")
+                    if on_output is not None:
+                        stream(on_output, output)
+                        output = ""
+                    raise CommandTimeout(command, output)
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise ShellExited("Shell exited while running: " + command)
+            self._buffer += chunk
+
+        if on_output is not None:
+            stream(on_output, decoder.decode(self._buffer[:pos], True))
+            output = None
+        else:
+            output = self._buffer[:pos].decode("utf-8", "replace")
+        exit_code = int(self._buffer[pos + len(marker):end])
+        self._buffer = self._buffer[end + 1:]
+        return output, exit_code
+
+    def interrupt(self):
+        """Stop the running command. Commands run in the shell process
+        itself, so the command cannot be stopped on its own. The shell,
+        and everything it started, is killed and `is_alive` set to
+        False."""
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.close()
+        self.is_alive = False
+
+    def close(self):
+        """Terminate the shell process."""
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.kill()
+        self.process.wait()
+
+    def kill(self):
+        """Kill the shell, and everything it started, without waiting
+        for them."""
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+class ShellPool(object):
+    """A pool of pre-spawned, pre-configured shells. Shells are started
+    in background threads so that the cost of starting bash (and
+    reading the users rc files) overlaps with other work, such as
+    parsing the document to be executed.
+    """
+
+    def __init__(self, size=None, is_minimal=None, executor=None):
+        if size is None:
+            size = config.shell_pool_size
+        if is_minimal is None:
+            is_minimal = config.is_minimal_shell
+        if executor is None:
+            executor = config.executor
+        self.size = size
+        self.is_minimal = is_minimal
+        self.shell_class = EXECUTORS[executor]
+        self.is_prewarming = False
+        self.env = os.environ.copy()
+        self._idle = queue.Queue()
+        self._spawning = 0
+        self._lock = threading.Condition()
+
+    def start(self):
+        """Start spawning shells in the background until `size` shells are
+        available. Once started the pool is replenished each time a
+        shell is checked out."""
+        self.is_prewarming = True
+        self._replenish()
+
+    def stop(self):
+        """Stop replenishing the pool and wait for the shells being spawned
+        in the background. No thread of the pool is running once this
+        returns, so the process can safely be forked."""
+        with self._lock:
+            self.is_prewarming = False
+            while self._spawning > 0:
+                self._lock.wait()
+
+    def _replenish(self):
+        with self._lock:
+            needed = self.size - self._idle.qsize() - self._spawning
+            if needed > 0:
+                self._spawning += needed
+        for _ in range(needed):
+            threading.Thread(target=self._spawn, daemon=True).start()
+
+    def _spawn(self):
+        try:
+            self._idle.put(self.shell_class(self.env, self.is_minimal))
+        except Exception as e:
+            self._idle.put(e)
+        finally:
+            with self._lock:
+                self._spawning -= 1
+                self._lock.notify_all()
+
+    def checkout(self, env, directory=None):
+        """Take a shell from the pool, or spawn one if none are available,
+        and reset it to the supplied environment and working
+        directory (the current directory if None).
+
+        Returns a tuple of the shell and the time spent waiting for it.
+        """
+        if directory is None:
+            directory = os.getcwd()
+
+        start_time = time.time()
+        with self._lock:
+            is_empty = self._idle.empty() and self._spawning == 0
+        if is_empty:
+            shell = self.shell_class(self.env, self.is_minimal)
+        else:
+            shell = self._idle.get()
+            if isinstance(shell, Exception):
+                raise shell
+
+        if self.is_prewarming:
+            self._replenish()
+
+        shell.reset(directory, env)
+        return shell, time.time() - start_time
+
+    def release(self, shell):
+        """Return a shell to the pool so that it can be reused. It will be
+        reset before it is next checked out."""
+        self._idle.put(shell)
+
+# The available shell backends, selected with config.executor
+EXECUTORS = {
+    "pty": Shell,
+    "pipe": PipeShell
+}
+
+_pool = None
+_inherited_pools = []
+
+def get_pool():
+    """Get the pool of shells for this process, creating it if necessary."""
+    global _pool
+    if _pool is None:
+        _pool = ShellPool()
+    return _pool
+
+def kill_all():
+    """Kill every shell started by this process, and the commands
+    running in them, for example because the process is being
+    terminated. Shells run in sessions of their own so they would
+    otherwise outlive it."""
+    while True:
+        try:
+            shells = list(_shells)
+            break
+        except RuntimeError:
+            # A shell was started by another thread while copying
+            pass
+    for shell in shells:
+        shell.kill()
+
+def discard_inherited_pool():
+    """Called in a process forked from one that may have started shells.
+    Shells in a pool inherited through the fork belong to the parent
+    process. Keep a reference so they are never closed from the child,
+    but never hand them out either."""
+    global _pool, _shells
+    if _pool is not None:
+        _inherited_pools.append(_pool)
+        _pool = None
+    _shells = weakref.WeakSet()
@@ -0,0 +1,261 @@
+# Scoring of actual command output against expected results.
+#
+# Results blocks are scored by a matcher, selected with the `match=`
+# option on the fence line of the block, see MATCHERS. The default
+# "text" matcher is described here.
+#
+# The score is the same ratio that difflib.SequenceMatcher computes,
+# twice the number of matching characters divided by the total number
+# of characters, but the cost of computing it is bounded. Scoring is
+# done in tiers, cheapest first:
+#
+#   1. Identical text scores 1.0.
+#   2. The `real_quick_ratio` and `quick_ratio` upper bounds are checked
+#      against the required similarity, if they are below it the test
+#      has failed and the bound is returned.
+#   3. Small outputs are compared character by character.
+#   4. Large outputs are first compared line by line, using hashed
+#      lines, and only the lines that differ are compared character by
+#      character.
+#
+# The score of large outputs is not the same ratio. Characters are only
+# matched within the runs of lines paired by the line comparison, and
+# lines that were added or removed match nothing, so it may be lower
+# than the ratio of the same text compared character by character. A
+# required similarity that is only just met by a small output may not
+# be met by a larger one with the same kind of differences.
+#
+# Output that was spilled to disk, see `capture.py`, is read through a
+# memory mapped view of the file. Only the hashes of its lines are held
+# in memory, and the lines that differ are read back from the file.
+
+from collections import Counter
+import functools
+import json
+import re
+
+from capture import SpilledOutput
+import config
+
+def is_junk(char):
+    return char in " \t\n\r"
+
+def score(actual, expected, required=None):
+    """Return the similarity, between 0 and 1, of the `actual` and
+    `expected` text. If `required` is supplied and the text is
+    certainly less similar than that then an upper bound on the
+    similarity, which is less than `required`, may be returned instead
+    of the exact value."""
+    if isinstance(actual, SpilledOutput):
+        return score_spilled(actual, expected, required)
+    if actual == expected:
+        return 1.0
+    # difflib is only imported when output needs comparing, it is not
+    # needed to load a document
+    import difflib
+
+    total = len(actual) + len(expected)
+    if total <= config.similarity_line_threshold:
+        seq = difflib.SequenceMatcher(is_junk, actual, expected)
+        if required is not None:
+            bound = seq.real_quick_ratio()
+            if bound < required:
+                return bound
+            bound = seq.quick_ratio()
+            if bound < required:
+                return bound
+        return seq.ratio()
+
+    if required is not None:
+        # quick_ratio is linear in the size of the text, which is always
+        # cheaper than the line based comparison
+        bound = difflib.SequenceMatcher(None, actual, expected).quick_ratio()
+        if bound < required:
+            return bound
+    return 2.0 * line_matches(actual, expected) / total
+
+def score_spilled(actual, expected, required=None):
+    """Return the similarity of spilled output, a SpilledOutput, and the
+    `expected` text, see `score`."""
+    total = len(actual) + len(expected)
+    if required is not None:
+        # The bound `real_quick_ratio` gives, computed from the lengths
+        bound = 2.0 * min(len(actual), len(expected)) / total
+        if bound < required:
+            return bound
+
+    keys = []
+    offsets = [0]
+    for _, end, line in actual.lines():
+        keys.append(hash(line))
+        offsets.append(end)
+    expected_lines = expected.replace("\r\n", "\n").splitlines(True)
+    size = lambda i, j: offsets[j] - offsets[i]
+    read = lambda i, j: actual.read(offsets[i], offsets[j])
+    return 2.0 * compare_lines(keys, size, read, [hash(line) for line in expected_lines], expected_lines) / total
+
+def line_matches(actual, expected):
+    """Return the number of matching characters in `actual` and
+    `expected`, comparing whole lines first. Runs of lines that differ
+    are compared character by character if they are small enough,
+    otherwise line by line in pairs."""
+    actual_lines = actual.splitlines(True)
+    expected_lines = expected.splitlines(True)
+    size = lambda i, j: sum(len(line) for line in actual_lines[i:j])
+    read = lambda i, j: "".join(actual_lines[i:j])
+    return compare_lines(actual_lines, size, read, expected_lines, expected_lines)
+
+def compare_lines(actual_keys, actual_size, read_actual, expected_keys, expected_lines):
+    """Return the number of matching characters in two sequences of
+    lines, see `line_matches`. The lines are compared by their keys,
+    the lines themselves or their hashes. `read_actual(i, j)` returns
+    the text of actual lines i to j and `actual_size(i, j)` its size,
+    or an upper bound on it, without reading it."""
+    import difflib
+    lines = difflib.SequenceMatcher(None, actual_keys, expected_keys)
+
+    matches = 0
+    for tag, i1, i2, j1, j2 in lines.get_opcodes():
+        if tag == "equal":
+            matches += sum(len(line) for line in expected_lines[j1:j2])
+        elif tag == "replace":
+            expected_text = "".join(expected_lines[j1:j2])
+            if actual_size(i1, i2) + len(expected_text) <= config.similarity_line_threshold:
+                matches += char_matches(read_actual(i1, i2), expected_text)
+            else:
+                for i, expected_line in zip(range(i1, i2), expected_lines[j1:j2]):
+                    matches += char_matches(read_actual(i, i + 1), expected_line)
+    return matches
+
+def char_matches(actual, expected):
+    import difflib
+    seq = difflib.SequenceMatcher(is_junk, actual, expected)
+    return sum(block.size for block in seq.get_matching_blocks())
+
+def diff(actual, expected):
+    """Return a unified diff of the `expected` and `actual` text.
+    Spilled output is not compared, a note giving the path of the file
+    holding it is returned instead."""
+    if isinstance(actual, SpilledOutput):
+        return "Output too large to compare, see " + actual.path + "\n"
+    import difflib
+    return "".join(difflib.unified_diff(expected.splitlines(True), actual.splitlines(True), "expected", "actual"))
+
+def match_text(actual, expected, required, options):
+    """Character similarity of the whole text, see `score`."""
+    return score(actual, expected, required)
+
+def match_lines(actual, expected, required, options):
+    """Similarity of the lines in the text, regardless of their order.
+    Lines are stripped and blank lines ignored, each line is then
+    compared by its hash. The score is twice the number of lines in
+    common divided by the total number of lines."""
+    if isinstance(actual, SpilledOutput):
+        actual_lines = Counter(line.strip() for _, _, line in actual.lines() if line.strip())
+    else:
+        actual_lines = Counter(line.strip() for line in actual.splitlines() if line.strip())
+    expected_lines = Counter(line.strip() for line in expected.splitlines() if line.strip())
+    total = sum(actual_lines.values()) + sum(expected_lines.values())
+    if total == 0:
+        return 1.0
+    return 2.0 * sum((actual_lines & expected_lines).values()) / total
+
+def match_regex(actual, expected, required, options):
+    """Scores 1.0 if the regular expression in the results block matches
+    the output, otherwise 0.0. The expression is searched for in the
+    output, `^` and `$` match at the start and end of each line.
+    Spilled output is searched in place, through a memory mapped view
+    of the file. An invalid expression scores 0.0, it is reported when
+    the document is parsed."""
+    try:
+        if isinstance(actual, SpilledOutput):
+            pattern = compile_regex(expected.strip().encode())
+        else:
+            pattern = compile_regex(expected.strip())
+    except re.error:
+        return 0.0
+    if isinstance(actual, SpilledOutput):
+        with actual.open() as view:
+            is_match = pattern.search(view) is not None
+    else:
+        is_match = pattern.search(actual.replace("\r\n", "\n")) is not None
+    if is_match:
+        return 1.0
+    return 0.0
+
+def match_json(actual, expected, required, options):
+    """Similarity of two JSON documents. The documents are flattened
+    into (path, value) pairs and the score is twice the number of pairs
+    in common divided by the total number of pairs. If the `keys`
+    option is given, a comma separated list of dotted key paths such as
+    `name,properties.provisioningState`, only those keys are compared.
+    List indices are ignored when selecting keys, so `name` selects the
+    name of every item in a list. Output that is not valid JSON scores
+    0.0. If the results block is not valid JSON it is scored as text.
+    Note that spilled output has to be read into memory to be parsed."""
+    expected_values = parse_json(expected)
+    if expected_values is None:
+        return score(actual, expected, required)
+    try:
+        if isinstance(actual, SpilledOutput):
+            # json.loads only accepts bytes from Python 3.6, so the
+            # output is read as text
+            actual_values = Counter(flatten_json(json.loads(actual.read())))
+        else:
+            actual_values = Counter(flatten_json(json.loads(actual)))
+    except ValueError:
+        return 0.0
+
+    if "keys" in options:
+        keys = set(options["keys"].split(","))
+        actual_values = Counter({item: count for item, count in actual_values.items() if strip_indices(item[0]) in keys})
+        expected_values = Counter({item: count for item, count in expected_values.items() if strip_indices(item[0]) in keys})
+
+    total = sum(actual_values.values()) + sum(expected_values.values())
+    if total == 0:
+        return 1.0
+    return 2.0 * sum((actual_values & expected_values).values()) / total
+
+def flatten_json(value, path=""):
+    """Yield a (path, value) pair for each scalar value in a parsed JSON
+    document. Object keys are separated by "." and list indices are
+    written as "[n]"."""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from flatten_json(item, path + "." + key if path else key)
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            yield from flatten_json(item, path + "[" + str(index) + "]")
+    else:
+        yield path, json.dumps(value)
+
+INDEX_PATTERN = re.compile(r"\[\d+\]")
+
+def strip_indices(path):
+    return INDEX_PATTERN.sub("", path).lstrip(".")
+
+@functools.lru_cache(maxsize=256)
+def parse_json(text):
+    """Parse and flatten expected results, see `flatten_json`. Results
+    blocks may be scored many times, for example when validating
+    prerequisites, so the result is cached. Returns None if the text is
+    not valid JSON."""
+    try:
+        return Counter(flatten_json(json.loads(text)))
+    except ValueError:
+        return None
+
+@functools.lru_cache(maxsize=256)
+def compile_regex(pattern):
+    """Compile a str, or bytes, pattern."""
+    return re.compile(pattern, re.MULTILINE)
+
+# The matchers available with the `match=` option of a results block.
+# Each takes the actual and expected results, the required similarity
+# and the options of the results block, and returns the similarity.
+MATCHERS = {
+    "text": match_text,
+    "lines": match_lines,
+    "regex": match_regex,
+    "json": match_json
+}
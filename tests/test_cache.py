@@ -0,0 +1,35 @@
+import os
+import pickle
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import cache
+import config
+
+def get_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "SIMDEM_TEMP_DIR", str(tmp_path))
+    return cache.DiskCache("test", 1024 * 1024)
+
+def test_entries_are_readable_by_older_pythons(tmp_path, monkeypatch):
+    disk_cache = get_cache(tmp_path, monkeypatch)
+    disk_cache.set("key", {"value": 1})
+    with open(disk_cache._path("key"), "rb") as f:
+        data = f.read()
+    # Protocol 2 and later start with PROTO and the protocol number
+    assert data[0] == 0x80 and data[1] <= 4
+    assert disk_cache.get("key") == {"value": 1}
+
+def test_unreadable_entry_is_a_miss_and_deleted(tmp_path, monkeypatch):
+    disk_cache = get_cache(tmp_path, monkeypatch)
+    disk_cache.set("key", "value")
+    path = disk_cache._path("key")
+    # As written by a Python that supports a newer protocol
+    with open(path, "wb") as f:
+        f.write(b"\x80\x09" + pickle.dumps("value")[2:])
+    assert disk_cache.get("key") is None
+    assert not os.path.exists(path)
+
+def test_missing_entry_is_a_miss(tmp_path, monkeypatch):
+    disk_cache = get_cache(tmp_path, monkeypatch)
+    assert disk_cache.get("key") is None
@@ -0,0 +1,62 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("colorama")
+
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "main.py")
+
+DOCUMENT = """# Incremental
+
+```bash
+echo $GREETING
+```
+
+Results:
+
+```
+hello
+```
+"""
+
+def write_plan(directory, greeting):
+    with open(os.path.join(directory, "test_plan.txt"), "w") as f:
+        f.write("doc.md\n")
+    with open(os.path.join(directory, "doc.md"), "w") as f:
+        f.write(DOCUMENT)
+    with open(os.path.join(directory, "env.json"), "w") as f:
+        json.dump({"GREETING": greeting}, f)
+
+def run_incremental(home, directory):
+    # SIMDEM_TEMP_DIR, and so the store of results, is under $HOME
+    env = dict(os.environ, HOME=str(home))
+    process = subprocess.run([sys.executable, MAIN, "--norc", "true", "--executor", "pipe", "--incremental", "true", "-p", str(directory), "test"],
+                             cwd=str(home), env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, timeout=120)
+    return process.stdout
+
+def test_unchanged_passing_entry_is_skipped(tmp_path):
+    plan = tmp_path / "plan"
+    plan.mkdir()
+    write_plan(str(plan), "hello")
+
+    output = run_incremental(tmp_path, plan)
+    assert "No failed tests." in output
+    assert "Skipping" not in output
+
+    output = run_incremental(tmp_path, plan)
+    assert "Skipping '" + str(plan / "doc.md") + "'" in output
+    assert "Passed Tests: 1" in output
+
+def test_changed_env_json_forces_rerun(tmp_path):
+    plan = tmp_path / "plan"
+    plan.mkdir()
+    write_plan(str(plan), "hello")
+    run_incremental(tmp_path, plan)
+
+    write_plan(str(plan), "hullo")
+    output = run_incremental(tmp_path, plan)
+    assert "Skipping" not in output
+    assert "$ echo $GREETING" in output
@@ -0,0 +1,42 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from cli import InputCancelled
+from input_channel import InputChannel
+
+def test_cancel_before_request_is_kept():
+    channel = InputChannel("command key")
+    channel.cancel()
+    channel.request()
+    with pytest.raises(InputCancelled, match="disconnected"):
+        channel.get(1)
+
+def test_cancel_wakes_waiting_get():
+    channel = InputChannel("command key")
+    timer = threading.Timer(0.1, channel.cancel)
+    timer.start()
+    start_time = time.time()
+    with pytest.raises(InputCancelled, match="disconnected"):
+        channel.get(5)
+    assert time.time() - start_time < 5
+
+def test_resume_accepts_input_again():
+    channel = InputChannel("command key")
+    channel.cancel()
+    channel.resume()
+    channel.request()
+    channel.put("n")
+    assert channel.get(1) == "n"
+
+def test_input_before_request_is_discarded():
+    channel = InputChannel("input")
+    channel.put("stale")
+    channel.request()
+    with pytest.raises(InputCancelled):
+        channel.get(0.1)
@@ -0,0 +1,115 @@
+import http.server
+import os
+import socketserver
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import config
+import remote
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # http.server only provides this from Python 3.7
+    daemon_threads = True
+
+class DocumentHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the documents in `documents`, by path, with an ETag and
+    answers conditional requests. The headers of each request are
+    recorded in `requests`."""
+    documents = {}
+    requests = []
+
+    def do_GET(self):
+        DocumentHandler.requests.append(dict(self.headers))
+        text = self.documents.get(self.path)
+        if text is None:
+            self.send_error(404)
+            return
+        etag = '"' + str(hash(text)) + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        data = text.encode("utf-8")
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "SIMDEM_TEMP_DIR", str(tmp_path))
+    monkeypatch.setattr(config, "remote_retries", 0)
+    monkeypatch.setattr(config, "is_offline", False)
+    monkeypatch.setattr(remote, "_cache", None)
+    monkeypatch.setattr(remote, "_documents", {})
+    DocumentHandler.documents = {"/README.md": "# Remote\n"}
+    DocumentHandler.requests = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), DocumentHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def get_url(server, path="/README.md"):
+    return "http://127.0.0.1:" + str(server.server_address[1]) + path
+
+def new_process():
+    """Forget the documents fetched by this process, as if SimDem was run
+    again."""
+    remote._documents.clear()
+
+def test_cold_fetch_requests_the_document(server):
+    assert remote.fetch(get_url(server)) == "# Remote\n"
+    assert len(DocumentHandler.requests) == 1
+    assert "If-None-Match" not in DocumentHandler.requests[0]
+
+def test_warm_cache_makes_no_requests(server):
+    remote.fetch(get_url(server))
+    new_process()
+    DocumentHandler.requests = []
+    assert remote.fetch(get_url(server)) == "# Remote\n"
+    assert DocumentHandler.requests == []
+
+def test_expired_entry_is_revalidated(server, monkeypatch):
+    remote.fetch(get_url(server))
+    new_process()
+    monkeypatch.setattr(config, "remote_cache_ttl", 0)
+    DocumentHandler.requests = []
+    assert remote.fetch(get_url(server)) == "# Remote\n"
+    assert len(DocumentHandler.requests) == 1
+    assert "If-None-Match" in DocumentHandler.requests[0]
+
+def test_changed_document_is_downloaded_on_revalidation(server, monkeypatch):
+    remote.fetch(get_url(server))
+    new_process()
+    monkeypatch.setattr(config, "remote_cache_ttl", 0)
+    DocumentHandler.documents["/README.md"] = "# Changed\n"
+    assert remote.fetch(get_url(server)) == "# Changed\n"
+
+def test_offline_uses_only_the_cache(server, monkeypatch):
+    remote.fetch(get_url(server))
+    new_process()
+    monkeypatch.setattr(config, "is_offline", True)
+    monkeypatch.setattr(config, "remote_cache_ttl", 0)
+    DocumentHandler.requests = []
+    assert remote.fetch(get_url(server)) == "# Remote\n"
+    with pytest.raises(remote.FetchError):
+        remote.fetch(get_url(server, "/other.md"))
+    assert DocumentHandler.requests == []
+
+def test_cached_copy_is_served_when_server_is_unreachable(server, monkeypatch):
+    url = get_url(server)
+    remote.fetch(url)
+    new_process()
+    monkeypatch.setattr(config, "remote_cache_ttl", 0)
+    server.shutdown()
+    server.server_close()
+    assert remote.fetch(url) == "# Remote\n"
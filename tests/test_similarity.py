@@ -0,0 +1,23 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from capture import SpilledOutput
+import similarity
+
+def spill(tmp_path, text):
+    path = str(tmp_path / "output")
+    with open(path, "w") as f:
+        f.write(text)
+    return SpilledOutput(path, len(text))
+
+def test_json_matcher_reads_spilled_output(tmp_path):
+    actual = spill(tmp_path, '{"name": "simdem", "id": "3f2a9c41"}\n')
+    expected = '{"id": "0b7e55d2", "name": "simdem"}'
+    assert similarity.match_json(actual, expected, 1.0, {"keys": "name"}) == 1.0
+    assert similarity.match_json(actual, expected, 1.0, {}) == 0.5
+
+def test_json_matcher_scores_invalid_spilled_output_zero(tmp_path):
+    actual = spill(tmp_path, "not json\n")
+    assert similarity.match_json(actual, '{"name": "simdem"}', 1.0, {}) == 0.0
@@ -0,0 +1,47 @@
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+pytest.importorskip("flask_socketio")
+
+from cli import InputCancelled
+import config
+import web
+
+class ConsoleUi(object):
+    """The parts of WebUi used when a browser connects, without starting
+    a server."""
+    ready = True
+
+    def __init__(self):
+        self.connected = threading.Event()
+
+    def clear(self):
+        pass
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(web, "ui", ConsoleUi())
+    monkeypatch.setattr(config, "webui_disconnect_timeout", 0.1)
+    web.ui_created.set()
+    client = web.socketio.test_client(web.app, namespace="/control")
+    yield client
+    if client.is_connected(namespace="/control"):
+        client.disconnect(namespace="/control")
+    web.command_keys.resume()
+    web.input_strings.resume()
+
+def test_command_key_is_received(client):
+    web.command_keys.request()
+    client.emit("command_key", "n", namespace="/control")
+    assert web.command_keys.get(1) == "n"
+
+def test_disconnect_cancels_wait_for_input(client):
+    web.input_strings.request()
+    client.disconnect(namespace="/control")
+    with pytest.raises(InputCancelled, match="disconnected"):
+        web.input_strings.get(5)
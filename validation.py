@@ -0,0 +1,81 @@
+# A persistent record of the prerequisites that passed validation.
+#
+# Validating a prerequisite often means running slow commands, such as
+# `az` queries. When the validation of a prerequisite passes the time
+# is recorded on disk, and for the following
+# `config.validation_cache_ttl` seconds later runs skip the validation
+# (and the prerequisite). Entries are keyed by the path of the
+# prerequisite, a hash of its content, including the options of its
+# code and results blocks, and the values of the variables used by its
+# validation commands, so changing the prerequisite, how its results
+# are compared or the environment it is validated in validates it
+# again. Changes to anything outside SimDem, such as a deleted file, are
+# not detected, so the cache is only used if `validation_cache_ttl` is
+# set and never in test mode.
+
+import time
+
+from cache import DiskCache
+import config
+import document
+import variables
+
+# Maximum size, in bytes, of the cache. Entries are a few hundred bytes.
+MAX_CACHE_SIZE = 1024 * 1024
+
+_cache = None
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = DiskCache("validations", MAX_CACHE_SIZE)
+    return _cache
+
+def is_enabled():
+    """True if validation outcomes are cached. They are not when
+    commands are recorded or replayed, see `cassette.py`, so that
+    every validation command is in the cassette."""
+    return bool(config.validation_cache_ttl) and config.cassette_mode is None
+
+def get_commands(doc):
+    """Return the commands, `document.Command` nodes, in the validation
+    section of `doc`."""
+    commands = []
+    in_validation = False
+    for node in doc.nodes:
+        if node.type == "validation":
+            in_validation = True
+        elif node.type == "heading":
+            in_validation = False
+        elif in_validation and node.type == "executable":
+            commands.append(node)
+    return commands
+
+def get_key(doc, lookup):
+    """Return the key under which the validation of `doc` is recorded.
+    `lookup(name)` returns the value of a variable."""
+    content = document.get_hash(doc)
+    names = set()
+    for command in get_commands(doc):
+        names.update(variables.get_names(command.text))
+    values = [name + "=" + lookup(name) for name in sorted(names)]
+    return "\0".join([doc.path, content] + values)
+
+def get_age(key):
+    """Return the number of seconds since the validation recorded under
+    `key` passed, or None if it has not passed within
+    `config.validation_cache_ttl` seconds or `config.is_revalidate` is
+    set."""
+    if config.is_revalidate:
+        return None
+    passed_at = get_cache().get(key)
+    if passed_at is None:
+        return None
+    age = time.time() - passed_at
+    if age < 0 or age >= config.validation_cache_ttl:
+        return None
+    return age
+
+def record_pass(key):
+    """Record that the validation recorded under `key` passed now."""
+    get_cache().set(key, time.time())
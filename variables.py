@@ -0,0 +1,81 @@
+# Finding and expanding the shell variables used in commands.
+#
+# Commands are tokenized once with precompiled patterns. The tokenizer
+# understands `$NAME` and `${NAME}` references, skips command
+# substitutions such as `$(date)` (but not the variables used inside
+# them), escaped dollars and single quoted strings.
+
+import re
+
+# Patterns used to find the next interesting token outside and inside
+# a double quoted string. Single quotes have no special meaning inside
+# double quotes.
+UNQUOTED_PATTERN = re.compile(r"""
+    (?P<escape>\\.)
+  | (?P<dquote>")
+  | (?P<squote>'[^']*'?)
+  | \$\{(?P<braced>[A-Za-z_]\w*)[^}]*\}?
+  | \$(?P<name>[A-Za-z_]\w*)
+""", re.VERBOSE)
+
+QUOTED_PATTERN = re.compile(r"""
+    (?P<escape>\\.)
+  | (?P<dquote>")
+  | \$\{(?P<braced>[A-Za-z_]\w*)[^}]*\}?
+  | \$(?P<name>[A-Za-z_]\w*)
+""", re.VERBOSE)
+
+# Commands that set a variable, e.g. `NAME=value`, `export NAME=value`
+# or `for NAME in ...`
+ASSIGNMENT_PATTERN = re.compile(r"""
+    (?:^|[;&|(]|\bthen\b|\bdo\b)\s*
+    (?:(?:export|declare|local|readonly)\s+(?:-\w+\s+)*([A-Za-z_]\w*)
+      | ([A-Za-z_]\w*)=
+      | for\s+([A-Za-z_]\w*)\s+in\b
+      | read\s+(?:-\w+\s+)*([A-Za-z_]\w*))
+""", re.VERBOSE)
+
+def tokenize(command):
+    """Yield a (name, start, end) tuple for each variable reference in the
+    command, where start and end are the position of the whole
+    reference, e.g. `${NAME}`, in the command."""
+    pattern = UNQUOTED_PATTERN
+    pos = 0
+    while True:
+        match = pattern.search(command, pos)
+        if match is None:
+            return
+        pos = match.end()
+        if match.group("dquote"):
+            pattern = QUOTED_PATTERN if pattern is UNQUOTED_PATTERN else UNQUOTED_PATTERN
+        elif match.group("braced"):
+            yield match.group("braced"), match.start(), match.end()
+        elif match.group("name"):
+            yield match.group("name"), match.start(), match.end()
+
+def get_names(command):
+    """Return the names of the variables referenced in the command, in
+    the order they first appear."""
+    names = {}
+    for name, _, _ in tokenize(command):
+        names[name] = True
+    return list(names)
+
+def get_assigned_names(command):
+    """Return the names of the variables the command sets."""
+    names = []
+    for match in ASSIGNMENT_PATTERN.finditer(command):
+        names.append(next(group for group in match.groups() if group))
+    return names
+
+def expand(command, lookup):
+    """Replace each variable reference in the command with the value
+    returned by `lookup(name)`."""
+    parts = []
+    pos = 0
+    for name, start, end in tokenize(command):
+        parts.append(command[pos:start])
+        parts.append(lookup(name))
+        pos = end
+    parts.append(command[pos:])
+    return "".join(parts)
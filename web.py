@@ -2,18 +2,22 @@ from flask import Flask, send_from_directory
 from flask import render_template
 from flask_socketio import SocketIO
 import threading
-import time
 
 from cli import Ui
 import config
+from input_channel import InputChannel
 
 ui = None
+ui_created = threading.Event()
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret!'
 socketio = SocketIO(app)
 thread = None
-command_key = None
-in_string = None
+command_keys = InputChannel("command key")
+input_strings = InputChannel("input")
+clients = 0
+clients_lock = threading.Lock()
+disconnect_timer = None
 
 def background_thread():
     while True:
@@ -28,27 +32,51 @@ def background_thread():
 @socketio.on('connect', namespace='/control')
 def connect():
     global thread
-    global ui
-    while ui is None:
-        time.sleep(0.25)
+    global clients
+    ui_created.wait()
+
+    with clients_lock:
+        clients += 1
+        if disconnect_timer is not None:
+            disconnect_timer.cancel()
+        command_keys.resume()
+        input_strings.resume()
 
     ui.clear()
     
     if thread is None:
         thread = socketio.start_background_task(target=background_thread)
-        ui.ready = True
+        ui.connected.set()
 
     print("Connection in /control namespace")
 
+@socketio.on('disconnect', namespace='/control')
+def disconnect(reason=None):
+    """If no browser reconnects within `config.webui_disconnect_timeout`
+    seconds then any wait for input is cancelled."""
+    global clients
+    global disconnect_timer
+    with clients_lock:
+        clients -= 1
+        if clients == 0:
+            disconnect_timer = threading.Timer(config.webui_disconnect_timeout, cancel_input)
+            disconnect_timer.daemon = True
+            disconnect_timer.start()
+
+def cancel_input():
+    with clients_lock:
+        if clients > 0:
+            return
+        command_keys.cancel()
+        input_strings.cancel()
+
 @socketio.on('command_key', namespace='/control')
 def got_command_key(key):
-    global command_key
-    command_key = key
+    command_keys.put(key)
 
 @socketio.on('input_string', namespace='/control')
 def got_input_String(in_str):
-    global in_string            
-    in_string = in_str
+    input_strings.put(in_str)
     
 @app.route('/js/<path:filename>')
 def send_js(filename):
@@ -73,10 +101,21 @@ class WebUi(Ui):
         logging.basicConfig(filename='error.log',level=logging.DEBUG)
         ui = self
         self.port = port
-        self.ready = False
+        self.connected = threading.Event()
+        ui_created.set()
         t = threading.Thread(target=socketio.run, args=(app, '0.0.0.0', port))
         t.start()
 
+    @property
+    def ready(self):
+        """True once a browser has connected."""
+        return self.connected.is_set()
+
+    def wait_for_client(self, timeout=None):
+        """Wait until a browser connects. Returns True if one has connected,
+        False if the wait timed out."""
+        return self.connected.wait(timeout)
+
     def prompt(self):
         """Display the prompt for the user. This is intended to indicate that
         the user is expected to take an action at this point.
@@ -90,6 +129,11 @@ class WebUi(Ui):
     def results(self, text):
         """Display the results of a command execution"""
         self._send_to_console(self.demo.strip_ansi(text), "results", True)
+
+    def output(self, text):
+        """Display a chunk of the output of a command while it is running.
+        Unlike `results` no new line is started."""
+        self._send_to_console(self.demo.strip_ansi(text), "results")
         
     def clear(self):
         """Clears the console and info panel ready for a new section of the script."""
@@ -182,23 +226,20 @@ to select it) and a title (to be displayed).
         relevant keys to respond with.
 
         """
-        global command_key
-        command_key = None
+        command_keys.request()
         socketio.emit('get_command_key',
                       namespace='/control')
-        while command_key is None:
-            pass
-            
-        return command_key
+        key = command_keys.get(config.webui_input_timeout)
+        self.log("debug", "Command key latency: " + str(command_keys.latency))
+        return key
 
     def input_string(self):
         """ Get a string from the user."""
-        global in_string
-        in_string = None
+        input_strings.request()
         socketio.emit('input_string',
                       namespace='/control')
-        while in_string is None:
-            pass
+        in_string = input_strings.get(config.webui_input_timeout)
+        self.log("debug", "Input latency: " + str(input_strings.latency))
         return in_string
 
     def run_special_command(self, command):